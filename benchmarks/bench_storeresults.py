@@ -0,0 +1,67 @@
+"""
+Rows/second of the results db write paths: the old session.merge per row versus the batched upsert, and the
+ResultWriter's path that only writes changed results, with statuses as ranges (and archives what they replace).
+
+    python benchmarks/bench_storeresults.py [--rows N] [--batch N] [--url sqlite:///...]
+
+Every path first writes N fresh rows into an empty table (inserts), then writes them again (updates).
+On the second write a third of the rows (the PTRs) changes.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import sqlalchemy
+
+from rdnsmonitor import storage
+from rdnsmonitor.dbobjects import ResultBase
+from rdnsmonitor.work import LocalWorker
+
+def makeResults(rows, generation):
+    base = 2**24
+    return [(base + i, "NXDOMAIN" if i % 3 else "host-{:d}-{:d}.example.net.".format(i, generation)) for i in range(rows)]
+
+class ChangesPath(object):
+    
+    def __init__(self, batch):
+        self.batch = batch
+        self.index = None
+    
+    def __call__(self, engine, results):
+        if self.index is None:
+            self.index = storage.ChangeIndex(engine)
+        changed = self.index.changed(results)
+        storage.writeResults(engine, changed, self.batch)
+        self.index.update(changed)
+
+def timeit(write, engine, results, batch):
+    start = time.perf_counter()
+    for i in range(0, len(results), batch):
+        write(engine, results[i:i + batch])
+    return len(results) / (time.perf_counter() - start)
+
+def main():
+    argparser = argparse.ArgumentParser(description="Benchmark storing results.")
+    argparser.add_argument("--rows", type=int, default=50000, help="Rows per run. Default: %(default)s")
+    argparser.add_argument("--batch", type=int, default=LocalWorker.SMAX_RESULTBATCH, help="Results per storeResults call. Default: %(default)s")
+    argparser.add_argument("--url", help="Results db url to use instead of a temporary SQLite db. Its ptrrecords table gets dropped!")
+    args = argparser.parse_args()
+
+    paths = [("merge", lambda engine, results: storage.mergeResults(engine, results)),
+             ("upsert", lambda engine, results: storage.upsertResults(engine, results, args.batch)),
+             ("changes", ChangesPath(args.batch))]
+    print("{:8s} {:>14s} {:>14s}".format("path", "insert rows/s", "update rows/s"))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for (name, write) in paths:
+            engine = sqlalchemy.create_engine(args.url or "sqlite:///" + os.path.join(tmpdir, name + ".db"))
+            ResultBase.metadata.drop_all(engine)
+            ResultBase.metadata.create_all(engine)
+            inserts = timeit(write, engine, makeResults(args.rows, 0), args.batch)
+            updates = timeit(write, engine, makeResults(args.rows, 1), args.batch)
+            print("{:8s} {:14.0f} {:14.0f}".format(name, inserts, updates))
+            engine.dispose()
+    return
+
+if __name__ == "__main__":
+    main()
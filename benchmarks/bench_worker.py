@@ -0,0 +1,174 @@
+"""
+End to end throughput of the workers and the C2 server, against a fake DNS server on loopback (see fakedns) instead
+of public resolvers, with temporary SQLite jobs and results dbs.
+
+    python benchmarks/bench_worker.py [--addresses N] [--workers N] [--async-window N] [--latency MS] [--loss F] ...
+
+Fills the jobs db with --addresses addresses from 1.0.0.0 on, runs the workers until every job is finished and the
+result writer has flushed, and reports queries/second (as sent by the workers, and as received by the fake server,
+which includes resends over TCP), results written to the db per second and the p50/p99 latency of the queries.
+"""
+import argparse
+import datetime
+import logging
+import os
+import tempfile
+import time
+
+import dns.resolver
+
+from rdnsmonitor import delegation
+from rdnsmonitor import handy
+from rdnsmonitor.monitor import C2Server
+from rdnsmonitor.ratelimit import RateLimiter
+from rdnsmonitor.work import LocalWorker, AsyncLocalWorker
+
+from fakedns import FakeDNSServer
+
+START_IP = 2**24
+IDLE_TIMEOUT = 2
+OUTCOMES = ("NOERROR", "NXDOMAIN", "TIMEOUT", "ERROR", "SERVFAIL", "NODATA", delegation.REFERRAL)
+# The fake delegation tree of --recursive: in-addr.arpa, /8, /16 and /24 servers
+CHAIN = ["127.0.1.{:d}".format(i + 1) for i in range(4)]
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class Recording(object):
+    """
+    Mixin for a worker that keeps the duration and outcome of every query.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.durations = []
+        self.outcomes = []
+
+    def _report(self, nameserver, start, data, probe=False, late=False):
+        super()._report(nameserver, start, data, probe=probe, late=late)
+        self.durations.append((datetime.datetime.now() - start).total_seconds())
+        self.outcomes.append(("probe " if probe else "") + (data if data in OUTCOMES else "PTR"))
+        return
+
+class RecordingWorker(Recording, LocalWorker):
+    pass
+
+class AsyncRecordingWorker(Recording, AsyncLocalWorker):
+    pass
+
+
+class DrainingServer(object):
+    """
+    Hands the workers the C2 server's jobs, but stops them once no job came up for IDLE_TIMEOUT seconds.
+    Keeps the time the last job was finished.
+    """
+
+    def __init__(self, server):
+        self._server = server
+        self.workers = []
+        self.last_finish = None
+
+    def retrieveNewJob(self, owner=None, timeout=None):
+        job = self._server.retrieveNewJob(owner=owner, timeout=IDLE_TIMEOUT)
+        if job is None:
+            for worker in self.workers:
+                worker.stop()
+        return job
+
+    def finishJob(self, job):
+        result = self._server.finishJob(job)
+        self.last_finish = time.monotonic()
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self._server, name)
+
+
+def main():
+    argparser = argparse.ArgumentParser(description="Benchmark workers and C2 server against a fake DNS server.")
+    argparser.add_argument("--addresses", type=int, default=2**14, help="Addresses to sweep. Default: %(default)s")
+    argparser.add_argument("--block-size", type=int, default=2**12, help="Addresses per job. Default: %(default)s")
+    argparser.add_argument("--workers", type=int, default=2, help="Workers. Default: %(default)s")
+    argparser.add_argument("--async-window", type=int, help="Run asynchronous workers with this many queries in flight.")
+    argparser.add_argument("--tcp", default=False, action="store_true", help="Query over TCP.")
+    argparser.add_argument("--retries", type=int, default=LocalWorker.RETRIES, help="Retries on other nameservers. Default: %(default)s")
+    argparser.add_argument("--no-zone-probe", dest="probe_zones", default=True, action="store_false", help="Do not probe reverse zones.")
+    argparser.add_argument("--recursive", default=False, action="store_true", help="Walk a fake delegation tree instead of asking the nameservers.")
+    argparser.add_argument("--qps", type=float, help="Rate limit of all workers together.")
+    argparser.add_argument("--ns-qps", type=float, help="Rate limit per nameserver.")
+    argparser.add_argument("--nameservers", type=int, default=2, help="Fake nameservers, on 127.0.0.1 and up. Default: %(default)s")
+    argparser.add_argument("--latency", type=float, default=5, help="Milliseconds before every answer. Default: %(default)s")
+    argparser.add_argument("--jitter", type=float, default=5, help="Up to this many more milliseconds, at random. Default: %(default)s")
+    argparser.add_argument("--loss", type=float, default=0.001, help="Share of UDP queries that go unanswered. Default: %(default)s")
+    argparser.add_argument("--nxdomain", type=float, default=0.6, help="Share of addresses without a PTR. Default: %(default)s")
+    argparser.add_argument("--servfail", type=float, default=0.001, help="Share of queries answered with SERVFAIL. Default: %(default)s")
+    argparser.add_argument("--truncate", type=float, default=0.001, help="Share of UDP answers that come back truncated. Default: %(default)s")
+    argparser.add_argument("--empty-zones", type=float, default=0.2, help="Share of /24 reverse zones that do not exist. Default: %(default)s")
+    argparser.add_argument("--seed", type=int, help="Seed for the fake server's dice.")
+    argparser.add_argument("-d", "--debug", action="store_true", help="Log what the workers and the server do.")
+    args = argparser.parse_args()
+
+    logging.basicConfig(format="%(threadName)s|%(levelname)s|%(module)s|%(message)s", level=logging.INFO if args.debug else logging.ERROR)
+
+    hosts = ["127.0.0.{:d}".format(i + 1) for i in range(args.nameservers)]
+    fake = FakeDNSServer(hosts, latency=args.latency / 1000, jitter=args.jitter / 1000, loss=args.loss, nxdomain=args.nxdomain,
+                         servfail=args.servfail, truncate=args.truncate, empty_zones=args.empty_zones,
+                         chain=CHAIN if args.recursive else (), seed=args.seed)
+    fake.start()
+    # Workers always add the system's default nameserver to theirs, so make that a fake one too
+    dns.resolver.default_resolver = dns.resolver.Resolver(configure=False)
+    dns.resolver.default_resolver.nameservers = hosts[:1]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        server = C2Server(newjobsdb=True,
+                          jobsdb_url="sqlite:///" + os.path.join(tmpdir, "jobs.db"),
+                          resultsdb_url="sqlite:///" + os.path.join(tmpdir, "results.db"),
+                          start_ip=handy.intToIp(START_IP), end_ip=handy.intToIp(START_IP + args.addresses),
+                          block_size=args.block_size, exclude="")
+        draining = DrainingServer(server)
+        limiter = RateLimiter(qps=args.qps, ns_qps=args.ns_qps, nameservers=hosts) if args.qps or args.ns_qps else None
+        workers = draining.workers
+        for i in range(args.workers):
+            kwargs = {"name":"Worker{:d}".format(i + 1), "nameservers":hosts[1:], "port":fake.port, "use_tcp":args.tcp,
+                      "retries":args.retries, "probe_zones":args.probe_zones, "limiter":limiter,
+                      "recursive":args.recursive, "roots":CHAIN[:1]}
+            if args.async_window:
+                workers.append(AsyncRecordingWorker(draining, window=args.async_window, **kwargs))
+            else:
+                workers.append(RecordingWorker(draining, **kwargs))
+        start = time.monotonic()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        swept = (draining.last_finish or time.monotonic()) - start
+        flushstart = time.monotonic()
+        server.shutdown()
+        written = swept + time.monotonic() - flushstart
+        stored = server._resultwriter.stored + server._resultwriter.unchanged
+    fake.stop()
+
+    durations = sorted(d for worker in workers for d in worker.durations)
+    outcomes = {}
+    for worker in workers:
+        for outcome in worker.outcomes:
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    print("{:d} addresses, {:d} workers{}, {:d} nameservers{}".format(args.addresses, args.workers,
+                                                                      " (window {:d})".format(args.async_window) if args.async_window else "", args.nameservers,
+                                                                      ", recursive" if args.recursive else ""))
+    print("{:24s} {:12.1f}".format("sweep seconds", swept))
+    print("{:24s} {:12.0f}".format("addresses/s", args.addresses / swept))
+    print("{:24s} {:12.0f}".format("queries/s (workers)", len(durations) / swept))
+    print("{:24s} {:12.0f}".format("queries/s (server)", fake.queries / swept))
+    print("{:24s} {:12.0f}".format("results/s (db)", stored / written))
+    print("{:24s} {:12.1f}".format("p50 latency ms", percentile(durations, 0.5) * 1000))
+    print("{:24s} {:12.1f}".format("p99 latency ms", percentile(durations, 0.99) * 1000))
+    for (outcome, count) in sorted(outcomes.items()):
+        print("{:24s} {:12d}".format(outcome, count))
+    return
+
+if __name__ == "__main__":
+    main()
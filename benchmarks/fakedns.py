@@ -0,0 +1,227 @@
+"""
+A local stand-in for the in-addr.arpa tree, to benchmark against instead of public resolvers.
+
+FakeDNSServer answers PTR and zone (NS) queries over UDP and TCP on one port of one or more loopback addresses, from
+an asyncio loop in a background thread. What it answers is made up from the query name:
+
+    PTR         a-b-c-d.bench.example. for a.b.c.d, NXDOMAIN for a fixed nxdomain share of the addresses
+    NS          NOERROR with ns.bench.example. for a /16 or /24 zone, NXDOMAIN for the empty_zones share of the /24s
+                (every address in an empty /24 is NXDOMAIN too)
+
+Which addresses and zones are NXDOMAIN depends on the name only, so retries and re-sweeps get the same answers.
+
+With chain, a list of some of the hosts, those play the delegation tree instead of a resolver: a PTR query to chain[i]
+(for i < 3) is answered with a referral to the /8, /16 or /24 zone with chain[i + 1] as its server (glued), and the
+last one in the chain answers as above.
+On top of that, every query is delayed by latency plus up to jitter seconds, and per query at random: dropped
+(loss, UDP only), answered with SERVFAIL (servfail) or, over UDP, answered empty with the TC flag set (truncate).
+"""
+import asyncio
+import logging
+import random
+import socket
+import struct
+import threading
+import zlib
+
+log = logging.getLogger(__name__)
+
+TTL = 3600
+TYPE_A = 1
+TYPE_NS = 2
+TYPE_PTR = 12
+RCODE_NOERROR = 0
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+FLAG_TC = 0x0200
+
+def _name(text):
+    return b"".join(bytes([len(label)]) + label.encode("ascii") for label in text.split(".")) + b"\x00"
+
+_NS_NAME = _name("ns.bench.example")
+
+def _share(text):
+    """
+    A fraction in [0, 1) that only depends on text.
+    """
+    return zlib.crc32(text.encode()) / 2**32
+
+def freePort(host="127.0.0.1"):
+    """
+    A port that is free for UDP on host, to serve on. TCP on the same port is free as good as always.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+class _UDPProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, server):
+        self._server = server
+        self._transport = None
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def datagram_received(self, data, addr):
+        self._server._handle(data, False, lambda reply: self._transport.sendto(reply, addr), self._transport.get_extra_info("sockname")[0])
+
+
+class FakeDNSServer(object):
+    """
+    Serves made up reverse DNS on port of every address in hosts. start() returns once it is listening.
+    The counters (queries, dropped, servfails, truncated) are per query received.
+    """
+
+    def __init__(self, hosts=("127.0.0.1",), port=None, latency=0.0, jitter=0.0, loss=0.0, nxdomain=0.5, servfail=0.0, truncate=0.0,
+                 empty_zones=0.0, chain=(), seed=None):
+        self.hosts = list(hosts)
+        self.port = port or freePort(self.hosts[0])
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.nxdomain = nxdomain
+        self.servfail = servfail
+        self.truncate = truncate
+        self.empty_zones = empty_zones
+        self.chain = list(chain)
+        self.queries = 0
+        self.dropped = 0
+        self.servfails = 0
+        self.truncated = 0
+        self._random = random.Random(seed)
+        self._loop = None
+        self._thread = None
+        self._closers = []
+        return
+
+    def start(self):
+        started = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(started,), name="FakeDNSServer", daemon=True)
+        self._thread.start()
+        started.wait()
+        log.info("Fake DNS on %s port %d", ", ".join(self.hosts), self.port)
+        return
+
+    def _run(self, started):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        for host in self.hosts + [host for host in self.chain if host not in self.hosts]:
+            (transport, _) = self._loop.run_until_complete(self._loop.create_datagram_endpoint(lambda: _UDPProtocol(self), local_addr=(host, self.port)))
+            self._closers.append(transport.close)
+            tcpserver = self._loop.run_until_complete(asyncio.start_server(self._serveTCP, host, self.port))
+            self._closers.append(tcpserver.close)
+        started.set()
+        self._loop.run_forever()
+        for close in self._closers:
+            close()
+        # Connections still open
+        tasks = asyncio.all_tasks(self._loop)
+        for task in tasks:
+            task.cancel()
+        self._loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self._loop.close()
+        return
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        return
+
+    async def _serveTCP(self, reader, writer):
+
+        def send(reply):
+            if not writer.is_closing():
+                writer.write(struct.pack("!H", len(reply)) + reply)
+
+        try:
+            while True:
+                (length,) = struct.unpack("!H", await reader.readexactly(2))
+                self._handle(await reader.readexactly(length), True, send, writer.get_extra_info("sockname")[0])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        writer.close()
+        return
+
+    def _handle(self, wire, tcp, send, host):
+        """
+        Sends the reply to a query after the configured delay, unless it gets lost.
+        """
+        self.queries += 1
+        if not tcp and self._random.random() < self.loss:
+            self.dropped += 1
+            return
+        reply = self._answer(wire, tcp, host)
+        if reply is None:
+            return
+        delay = self.latency + self._random.random() * self.jitter
+        if delay > 0:
+            self._loop.call_later(delay, send, reply)
+        else:
+            send(reply)
+        return
+
+    def _answer(self, wire, tcp, host):
+        """
+        The reply to a query, built straight from and into wire format: parsing and building messages with dnspython
+        would make the server the bottleneck long before the workers are.
+        """
+        try:
+            (qid, flags) = struct.unpack_from("!HH", wire)
+            labels = []
+            offset = 12
+            while wire[offset]:
+                labels.append(wire[offset + 1:offset + 1 + wire[offset]].decode("ascii").lower())
+                offset += 1 + wire[offset]
+            (qtype,) = struct.unpack_from("!H", wire, offset + 1)
+            question = wire[12:offset + 5]
+        except (struct.error, IndexError, UnicodeDecodeError) as exc:
+            log.debug("Bad query: %s", repr(exc))
+            return None
+        octets = labels[:-2]
+        octets.reverse()
+        rcode = RCODE_NOERROR
+        tc = 0
+        answer = None
+        depth = self.chain.index(host) if host in self.chain else None
+        if self._random.random() < self.servfail:
+            self.servfails += 1
+            rcode = RCODE_SERVFAIL
+        elif not tcp and self._random.random() < self.truncate:
+            self.truncated += 1
+            tc = FLAG_TC
+        elif labels[-2:] != ["in-addr", "arpa"]:
+            rcode = RCODE_NXDOMAIN
+        elif depth is not None and depth < min(len(self.chain) - 1, 3) and qtype == TYPE_PTR and len(octets) == 4:
+            return self._referral(qid, flags, question, labels[3 - depth:], self.chain[depth + 1])
+        elif len(octets) >= 3 and _share(".".join(octets[:3])) < self.empty_zones:
+            rcode = RCODE_NXDOMAIN
+        elif qtype == TYPE_NS:
+            answer = (TYPE_NS, _NS_NAME)
+        elif qtype == TYPE_PTR and len(octets) == 4:
+            if _share(".".join(octets)) < self.nxdomain:
+                rcode = RCODE_NXDOMAIN
+            else:
+                answer = (TYPE_PTR, _name("-".join(octets) + ".bench.example"))
+        else:
+            rcode = RCODE_NXDOMAIN
+        # QR, the query's RD, RA
+        header = struct.pack("!HHHHHH", qid, 0x8000 | (flags & 0x0100) | 0x0080 | tc | rcode, 1, 1 if answer else 0, 0, 0)
+        reply = header + question
+        if answer:
+            (rtype, rdata) = answer
+            # The owner name points back at the question's
+            reply += struct.pack("!HHHIH", 0xC00C, rtype, 1, TTL, len(rdata)) + rdata
+        return reply
+
+    def _referral(self, qid, flags, question, zone, nameserver):
+        """
+        A referral to the zone (its labels), served by nameserver: NS in the authority section, its address as glue.
+        """
+        nsname = _name("ns{:d}.bench.example".format(len(zone)))
+        header = struct.pack("!HHHHHH", qid, 0x8000 | (flags & 0x0100), 1, 0, 1, 1)
+        reply = header + question
+        reply += _name(".".join(zone)) + struct.pack("!HHIH", TYPE_NS, 1, TTL, len(nsname)) + nsname
+        reply += nsname + struct.pack("!HHIH", TYPE_A, 1, TTL, 4) + socket.inet_aton(nameserver)
+        return reply
@@ -1,11 +1,14 @@
 import configparser
 
-from sqlalchemy.orm import scoped_session, sessionmaker 
 
-
-
-JobdbSession = scoped_session(sessionmaker())
-ResultdbSession = scoped_session(sessionmaker())
+def __getattr__(name):
+    # The sessions are made on first use, so that what does not touch a db (a worker of a remote C2 server) does not
+    # have to import SQLAlchemy
+    if name in ("JobdbSession", "ResultdbSession"):
+        from sqlalchemy.orm import scoped_session, sessionmaker
+        globals().setdefault(name, scoped_session(sessionmaker()))
+        return globals()[name]
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 nameservers = ["8.8.8.8",
                "8.8.4.4",
@@ -23,4 +26,21 @@ nameservers = ["8.8.8.8",
                "4.2.2.5",
                "4.2.2.6"]
 
+# IANA special purpose and other never routed ranges. Default for the server's exclude setting.
+bogons = ["0.0.0.0/8",
+          "10.0.0.0/8",
+          "100.64.0.0/10",
+          "127.0.0.0/8",
+          "169.254.0.0/16",
+          "172.16.0.0/12",
+          "192.0.0.0/24",
+          "192.0.2.0/24",
+          "192.88.99.0/24",
+          "192.168.0.0/16",
+          "198.18.0.0/15",
+          "198.51.100.0/24",
+          "203.0.113.0/24",
+          "224.0.0.0/4",
+          "240.0.0.0/4"]
+
 config = configparser.ConfigParser()
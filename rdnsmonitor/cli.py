@@ -1,35 +1,206 @@
+"""
+The rdnsmonitor command, one subcommand per role:
+
+    serve       run the C2 server, with local workers (-w/-p) and/or an api for remote workers (-l)
+    worker      run workers against a remote C2 server
+    export      write a snapshot of the results db
+    search      build and query the PTR search index
+    status      print the number of jobs by state
+
+Every subcommand imports only the modules it needs, so a status check does not wait for dnspython and a remote worker
+does not wait for SQLAlchemy.
+"""
 import logging
 import argparse
 import random
+import signal
+import threading
 
-from rdnsmonitor import monitor
-from rdnsmonitor import work
+from rdnsmonitor import metrics
 from rdnsmonitor import nameservers as nservers
 from rdnsmonitor import config
 
 log = logging.getLogger()
-    
+
+# Defaults of work.Worker.RETRIES and work.AsyncLocalWorker.NS_CONCURRENCY, so that parsing does not need the work module
+RETRIES = 1
+NS_CONCURRENCY = 256
+
+def _workerOptions():
+    """
+    The options serve and worker share, about the workers. A parser of their own for each: parents share their
+    actions, so the defaults one sets would end up in the other.
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("-w", "--workers", type=int, help="The number of local workers to start (per process with --processes).")
+    parser.add_argument("-p", "--processes", help="Run the workers in this many processes. 'auto' starts one per available core.")
+    parser.add_argument("--pin-cpus", default=False, action="store_true", help="Pin every worker process to a core of its own.")
+    parser.add_argument("-a", "--async-window", type=int, help="Run asynchronous workers, each keeping this many PTR queries in flight.")
+    parser.add_argument("-t", "--tcp", default=False, action="store_true", help="Query over (persistent) TCP connections instead of UDP.")
+    parser.add_argument("--ns-concurrency", type=int, default=NS_CONCURRENCY, help="Max queries in flight per nameserver for asynchronous workers. Default: %(default)s")
+    parser.add_argument("--ns-qps", type=int, help="Max queries per second each worker sends to a single nameserver. Default: no limit")
+    parser.add_argument("--retries", type=int, default=RETRIES, help="Other nameservers to ask when a query times out or fails. Default: %(default)s")
+    parser.add_argument("--no-zone-probe", dest="probe_zones", default=True, action="store_false", help="Query every address, also in reverse zones that are not delegated.")
+    parser.add_argument("-r", "--recursive", default=False, action="store_true", help="Ask the authoritative servers of the reverse zones, the nameservers only when those can not tell.")
+    parser.add_argument("-m", "--metrics", metavar="HOST:PORT", help="Serve metrics (/metrics) and stack sampling (/profile) on this address. Worker processes use the ports after it.")
+    parser.add_argument("--summary", type=int, default=metrics.Summary.INTERVAL, help="Log a metrics summary every this many seconds, 0 for never. Default: %(default)s")
+    return parser
+
 def main():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("-d", "--debug", action="store_true", help="Enable debugging")
+    common.add_argument("-c", "--config", default="/etc/rdnsmonitor/rdnsmonitor.cfg", help="Path to config. Default: %(default)s")
+
     argparser = argparse.ArgumentParser(description="Reverse DNS monitor. Queries and stores PTR records of all IPv4 addresses.")
-    argparser.add_argument("-d", "--debug", action="store_true", help="Enable debugging")
-    argparser.add_argument("-c", "--config", default="/etc/rdnsmonitor/rdnsmonitor.cfg", help="Path to config. Default: %(default)s")
-    argparser.add_argument("-n", "--newdb", default=False, action="store_true", help="Regenerate the jobs database.")
-    argparser.add_argument("-w", "--workers", type=int, help="The number of local workers to start.")
+    commands = argparser.add_subparsers(dest="command", metavar="COMMAND")
+    commands.required = True
+
+    serve = commands.add_parser("serve", parents=[common, _workerOptions()], help="Run the C2 server, and local workers with -w or -p.")
+    serve.add_argument("-n", "--newdb", default=False, action="store_true", help="Regenerate the jobs database.")
+    serve.add_argument("-l", "--listen", metavar="HOST:PORT", help="Serve jobs to remote workers on this address.")
+    serve.set_defaults(run=_work, c2=None)
+
+    worker = commands.add_parser("worker", parents=[common, _workerOptions()], help="Run workers against a remote C2 server.")
+    worker.add_argument("c2", metavar="URL", help="The C2 server to get the jobs from (e.g. http://c2host:8053).")
+    worker.set_defaults(run=_work, workers=1, newdb=False, listen=None)
+
+    export = commands.add_parser("export", parents=[common], help="Write a snapshot of the results db.")
+    export.add_argument("path", metavar="PATH", help="Where to write the snapshot.")
+    export.add_argument("--format", choices=["packed", "parquet"], default="packed", help="Snapshot format. Parquet needs pyarrow. Default: %(default)s")
+    export.set_defaults(run=_export)
+
+    search = commands.add_parser("search", parents=[common], help="Build or query the PTR search index.")
+    search.add_argument("--index", default="ptrindex.db", help="PTR search index file. Default: %(default)s")
+    search.add_argument("--build-index", metavar="SNAPSHOT", help="Build the search index from a packed snapshot.")
+    search.add_argument("--suffix", metavar="DOMAIN", help="Print the ip ranges with a PTR under DOMAIN.")
+    search.add_argument("--contains", metavar="TEXT", help="Print the ip ranges with TEXT in their PTR.")
+    search.set_defaults(run=_search)
+
+    status = commands.add_parser("status", parents=[common], help="Print the number of jobs by state.")
+    status.set_defaults(run=_status)
     args = argparser.parse_args()
-    
+
     logging.basicConfig(format="%(threadName)s|%(levelname)s|%(module)s|%(message)s",level=logging.DEBUG if args.debug else logging.INFO)
-    
+
     config.read(args.config)
-    
-    server = monitor.getServer(newjobsdb=args.newdb, **dict(config["server"]))
-    if(args.workers):
+    args.run(args)
+    return
+
+def _search(args):
+    from rdnsmonitor import handy
+    from rdnsmonitor import search
+    index = search.PTRIndex(args.index)
+    if args.build_index:
+        index.build(args.build_index)
+    for (ipfrom, ipto) in (index.suffix(args.suffix) if args.suffix else index.contains(args.contains) if args.contains else []):
+        print("{}-{}".format(handy.intToIp(ipfrom), handy.intToIp(ipto - 1)))
+    index.close()
+    return
+
+def _export(args):
+    import sqlalchemy
+    from rdnsmonitor import export
+    engine = sqlalchemy.create_engine(config["server"]["resultsdb_url"])
+    export.exportSnapshot(engine, args.path, format=args.format)
+    return
+
+def _status(args):
+    import sqlalchemy
+    from rdnsmonitor import monitor
+    engine = sqlalchemy.create_engine(config["server"]["jobsdb_url"])
+    for (state, count) in monitor.jobCounts(engine).items():
+        print("{:12s} {:12d}".format(state, count))
+    return
+
+def _work(args):
+    """
+    serve and worker, which only differ in where the workers get their jobs.
+    """
+    from rdnsmonitor import ratelimit
+    metricsaddress = None
+    metricsserver = None
+    if args.metrics:
+        (host, _, port) = args.metrics.rpartition(":")
+        metricsaddress = (host or "127.0.0.1", int(port))
+        metricsserver = metrics.MetricsServer(*metricsaddress)
+        metricsserver.start()
+    if args.summary:
+        metrics.Summary(interval=args.summary).start()
+    if args.c2:
+        server = None
+    else:
+        from rdnsmonitor import monitor
+        server = monitor.getServer(newjobsdb=args.newdb, **dict(config["server"]))
+    api = None
+    if args.listen:
+        from rdnsmonitor import remote
+        (host, _, port) = args.listen.rpartition(":")
+        api = remote.C2Api(server, host=host or "0.0.0.0", port=int(port), token=config["server"].get("api_token"))
+        api.start()
+    token = config["worker"].get("api_token") if config.has_section("worker") else None
+    roots = config["worker"].get("roots") if config.has_section("worker") else None
+    roots = [root.strip() for root in roots.split(",")] if roots else None
+    limiter = ratelimit.RateLimiter.fromConfig(config["worker"], nameservers=nservers, shared=bool(args.processes)) if config.has_section("worker") else None
+    workers = []
+    pool = None
+    if(args.processes):
+        from rdnsmonitor import procpool
+        numprocs = len(procpool.availableCpus()) if args.processes == "auto" else int(args.processes)
+        workerkwargs = {"use_tcp":args.tcp, "ns_qps":args.ns_qps, "retries":args.retries, "probe_zones":args.probe_zones,
+                        "limiter":limiter, "recursive":args.recursive, "roots":roots}
+        if args.async_window:
+            workerkwargs.update(window=args.async_window, ns_concurrency=args.ns_concurrency)
+        pool = procpool.ProcessPool(numprocs, workers_per_process=args.workers or 1, workerkwargs=workerkwargs,
+                                    c2server=server, c2url=args.c2, api_token=token, pin_cpus=args.pin_cpus,
+                                    metrics_address=metricsaddress, summary_interval=args.summary)
+        pool.start()
+    elif(args.workers):
         numworkers = args.workers
         log.info("Starting %d workers...", numworkers)
+        if args.c2:
+            from rdnsmonitor import remote
+            workerclass = remote.AsyncRemoteWorker if args.async_window else remote.RemoteWorker
+        else:
+            from rdnsmonitor import work
+            workerclass = work.AsyncLocalWorker if args.async_window else work.LocalWorker
         for i in range(numworkers):
             random.shuffle(nservers)
-            worker = work.LocalWorker(server, name="Worker{:d}".format(i+1), nameservers=nservers, use_tcp=True)
+            kwargs = {"name":"Worker{:d}".format(i+1), "nameservers":nservers, "use_tcp":args.tcp, "ns_qps":args.ns_qps, "retries":args.retries, "probe_zones":args.probe_zones, "limiter":limiter,
+                      "recursive":args.recursive, "roots":roots}
+            if args.async_window:
+                kwargs.update(window=args.async_window, ns_concurrency=args.ns_concurrency)
+            if args.c2:
+                worker = workerclass(args.c2, api_token=token, **kwargs)
+            else:
+                worker = workerclass(server, **kwargs)
             worker.start()
+            workers.append(worker)
         log.info("Workers started!")
-    
+    # Stop like on ctrl-c: workers send what they have with its checkpoint, and the result writer is flushed
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        for worker in workers:
+            worker.join()
+        if pool:
+            pool.join()
+        if api:
+            threading.Event().wait()
+    except KeyboardInterrupt:
+        log.info("Interrupted")
+    finally:
+        for worker in workers:
+            worker.stop()
+        for worker in workers:
+            worker.join()
+        if pool:
+            pool.stop()
+        if api:
+            api.stop()
+        if metricsserver:
+            metricsserver.stop()
+        if server:
+            server.shutdown()
+    return
+
 if __name__=="__main__":
     main()
@@ -1,5 +1,5 @@
 import sqlalchemy.ext.declarative as declarative
-from sqlalchemy import Integer, Column, Boolean, String, DateTime
+from sqlalchemy import Integer, SmallInteger, Column, Boolean, String, DateTime, Float, LargeBinary
 
 from rdnsmonitor import handy
 
@@ -12,11 +12,22 @@ class Job(Base):
     ipfrom = Column(Integer)
     ipto = Column(Integer)
     retrieved = Column(DateTime, nullable=True)
-    started = Column(DateTime, nullable=True)
-    completed = Column(DateTime, nullable=True)
+    # Indexed, like lease_expires and due, so finding and counting jobs by state does not scan the table
+    started = Column(DateTime, nullable=True, index=True)
+    completed = Column(DateTime, nullable=True, index=True)
     nameserver=Column(String(50), nullable=True)
     nxdomain_count=Column(Integer, nullable=True)
     error_count=Column(Integer, nullable=True)
+    skipped_count=Column(Integer, nullable=True)
+    lease_owner=Column(String(50), nullable=True)
+    lease_expires=Column(DateTime, nullable=True, index=True)
+    ptr_count=Column(Integer, nullable=True)
+    changed_count=Column(Integer, nullable=True)
+    churn=Column(Float, nullable=True)
+    digest=Column(LargeBinary, nullable=True)
+    due=Column(DateTime, nullable=True, index=True)
+    # While the job is being worked on: every address before this one has its result stored
+    checkpoint=Column(Integer, nullable=True)
     
     
     def __repr__(self):
@@ -28,13 +39,90 @@ class Job(Base):
                                                                                      str(self.nxdomain_count),
                                                                                      str(self.error_count))
 
+class JobHistory(Base):
+    __tablename__ = "jobhistory"
+    
+    id = Column(Integer, primary_key=True)
+    job_id = Column(Integer, index=True)
+    completed = Column(DateTime)
+    ptr_count=Column(Integer, nullable=True)
+    nxdomain_count=Column(Integer, nullable=True)
+    error_count=Column(Integer, nullable=True)
+    changed_count=Column(Integer, nullable=True)
+    
+    def __repr__(self):
+        return "<JobHistory(job={}, completed={}, ptrcnt={}, changedcnt={})>".format(self.job_id, self.completed,
+                                                                                str(self.ptr_count), str(self.changed_count))
+
+# What gets stored in PTRRecord.status: a PTR, or one of the outcomes the workers report instead of one
+STATUS_PTR = 0
+# NODATA: the name exists, but has no PTR (or only a CNAME that leads nowhere)
+STATUSES = {"NXDOMAIN":1, "TIMEOUT":2, "ERROR":3, "SERVFAIL":4, "NODATA":5}
+STATUS_NAMES = {code:name for (name, code) in STATUSES.items()}
+
+def encodeResult(result):
+    """
+    Returns (status, ptr) for a result as the workers report it, ptr being None unless it is a PTR.
+    """
+    status = STATUSES.get(result)
+    if status is None:
+        return (STATUS_PTR, result)
+    return (status, None)
+
+def decodeResult(status, ptr):
+    """
+    The reverse of encodeResult(). Rows from before status codes have a NULL status and the result in ptr.
+    """
+    if status is None or status == STATUS_PTR:
+        return ptr
+    return STATUS_NAMES[status]
+
 ResultBase = declarative.declarative_base()
 
 class PTRRecord(ResultBase):    
     __tablename__ = "ptrrecords"    
     
     ip = Column(Integer, primary_key=True)
-    ptr = Column(String(128), index=True)
+    status = Column(SmallInteger, nullable=True)
+    ptr = Column(String(128), index=True, nullable=True)
+    first_seen = Column(DateTime, nullable=True)
+    
+    @property
+    def result(self):
+        return decodeResult(self.status, self.ptr)
+    
+    def __repr__(self):
+        return "<ptrrecord(ip={}, ptr={})>".format(handy.intToIp(self.ip),self.result)
+
+class StatusRange(ResultBase):
+    """
+    The addresses from ipfrom up to ipto that all got the same status instead of a PTR. Ranges never overlap.
+    """
+    __tablename__ = "statusranges"
+    
+    ipfrom = Column(Integer, primary_key=True)
+    ipto = Column(Integer)
+    status = Column(SmallInteger)
+    first_seen = Column(DateTime, nullable=True)
+    
+    def __repr__(self):
+        return "<statusrange({}-{}, status={})>".format(handy.intToIp(self.ipfrom), handy.intToIp(self.ipto - 1), STATUS_NAMES.get(self.status))
+
+class PTRChange(ResultBase):
+    """
+    A result that got replaced: what an address resolved to from first_seen until the sweep at last_seen found something else.
+    A replaced part of a status range is one change, for the addresses from ip up to ipto.
+    """
+    __tablename__ = "ptrchanges"
+    
+    id = Column(Integer, primary_key=True)
+    ip = Column(Integer, index=True)
+    ipto = Column(Integer, nullable=True)
+    status = Column(SmallInteger, nullable=True)
+    ptr = Column(String(128), nullable=True)
+    first_seen = Column(DateTime, nullable=True)
+    last_seen = Column(DateTime)
     
     def __repr__(self):
-        return "<ptrrecord(ip={}, ptr={})>".format(handy.intToIp(self.ip),self.ptr)
\ No newline at end of file
+        return "<ptrchange(ip={}, ptr={}, {} to {})>".format(handy.intToIp(self.ip), decodeResult(self.status, self.ptr),
+                                                             self.first_seen, self.last_seen)
@@ -0,0 +1,200 @@
+"""
+Asking the authoritative servers of the reverse zones directly, instead of going through open resolvers.
+
+DelegationCache remembers which servers are authoritative for the /8, /16 and /24 reverse zones it came across, for as
+long as the TTLs of their NS records and glue say (within MIN_TTL and MAX_TTL, and at most MAX_ZONES zones, least
+recently used ones first out). servers() gives the servers of the deepest known zone of an address, or the in-addr.arpa
+servers (the roots) when none is known. A query to one of those comes back with either the answer, or a referral to
+the servers of a deeper zone. check() caches the referral and raises Referral, so the worker asks again and gets there.
+Once a /24 is known, every address in it costs one query.
+
+What a delegation walk can not get to (a CNAME into a classless delegation, RFC 2317, a lame server, NS names without
+glue that do not resolve) raises Unresolvable; the worker then asks its open resolvers instead.
+NS names without glue are looked up through the system's resolver. That blocks, so on an event loop check() is called
+without lookup: it raises MissingGlue with the names instead, for the caller to look up off the loop (hostAddresses())
+before checking again.
+
+There is one cache per process, see getCache().
+"""
+import collections
+import logging
+import threading
+import time
+
+import dns.exception
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+import dns.resolver
+
+log = logging.getLogger(__name__)
+
+# What a referral is booked as with the scheduler and in the metrics
+REFERRAL = "REFERRAL"
+# Referrals to follow for one address before giving up on it: in-addr.arpa, /8, /16, /24 and some slack
+MAX_REFERRALS = 6
+
+# a. to f.in-addr-servers.arpa
+ROOTS = ["199.180.182.53", "199.253.183.183", "196.216.169.10", "200.10.60.53", "203.119.86.101", "193.0.9.1"]
+
+_IN_ADDR_ARPA = dns.name.from_text("in-addr.arpa.")
+
+
+class Referral(Exception):
+    pass
+
+class Unresolvable(Exception):
+    pass
+
+class MissingGlue(Unresolvable):
+    """
+    A referral to NS names without glue whose addresses are not cached yet.
+    """
+
+    def __init__(self, hosts):
+        Unresolvable.__init__(self, "No glue for {}".format(", ".join(hosts)))
+        self.hosts = hosts
+
+
+def _zoneNames(ipint):
+    """
+    The names of the /24, /16 and /8 reverse zones of ipint, deepest first.
+    """
+    (a, b, c) = (ipint >> 24, (ipint >> 16) & 0xff, (ipint >> 8) & 0xff)
+    return ["{:d}.{:d}.{:d}.in-addr.arpa.".format(c, b, a), "{:d}.{:d}.in-addr.arpa.".format(b, a), "{:d}.in-addr.arpa.".format(a)]
+
+
+class DelegationCache(object):
+    """
+    Zone name -> the addresses of its authoritative servers, with expiry. Thread safe.
+    """
+    MIN_TTL = 60
+    MAX_TTL = 86400
+    MAX_ZONES = 2**16
+    HOST_LIFETIME = 2
+
+    def __init__(self, roots=ROOTS):
+        self.roots = list(roots)
+        self._zones = collections.OrderedDict()
+        self._hosts = {}
+        self._lock = threading.Lock()
+        return
+
+    def _get(self, table, name, now):
+        entry = table.get(name)
+        if entry is None:
+            return None
+        (value, expires) = entry
+        if expires <= now:
+            del table[name]
+            return None
+        return value
+
+    def servers(self, ipint):
+        """
+        The servers of the deepest zone of ipint in the cache.
+        """
+        now = time.monotonic()
+        with self._lock:
+            for name in _zoneNames(ipint):
+                servers = self._get(self._zones, name, now)
+                if servers:
+                    self._zones.move_to_end(name)
+                    return servers
+        return self.roots
+
+    def store(self, zone, servers, ttl):
+        ttl = min(max(ttl, DelegationCache.MIN_TTL), DelegationCache.MAX_TTL)
+        with self._lock:
+            self._zones[zone] = (servers, time.monotonic() + ttl)
+            self._zones.move_to_end(zone)
+            while len(self._zones) > DelegationCache.MAX_ZONES:
+                self._zones.popitem(last=False)
+        log.debug("%s is served by %s for %ds", zone, ", ".join(servers), ttl)
+        return
+
+    def hostAddresses(self, host, lookup=True):
+        """
+        The IPv4 addresses of an NS name that came without glue, through the system's resolver. Without lookup, only
+        the cached ones, or None when there are none.
+        """
+        now = time.monotonic()
+        with self._lock:
+            addresses = self._get(self._hosts, host, now)
+        if addresses is not None or not lookup:
+            return addresses
+        try:
+            answer = dns.resolver.resolve(host, "A", lifetime=DelegationCache.HOST_LIFETIME)
+            addresses = [rdata.address for rdata in answer]
+            ttl = answer.rrset.ttl
+        except dns.exception.DNSException as ex:
+            log.debug("No address for nameserver %s: %s", host, repr(ex))
+            addresses = []
+            ttl = DelegationCache.MIN_TTL
+        with self._lock:
+            self._hosts[host] = (addresses, now + min(max(ttl, DelegationCache.MIN_TTL), DelegationCache.MAX_TTL))
+        return addresses
+
+    def check(self, wire, lookup=True):
+        """
+        Looks at the reply of an authoritative server to a PTR query. Returns the parsed reply when it is an answer
+        (or an error) for the worker to handle. Caches and raises Referral for a referral to a deeper zone, and raises
+        Unresolvable when neither is the case. Without lookup, raises MissingGlue rather than looking up NS names.
+        """
+        try:
+            response = dns.message.from_wire(wire)
+        except dns.exception.DNSException:
+            # For the worker to report
+            return None
+        rcode = response.rcode()
+        if rcode in (dns.rcode.REFUSED, dns.rcode.NOTAUTH, dns.rcode.NOTIMP):
+            # A lame delegation, most likely
+            raise Unresolvable("{} from the server".format(dns.rcode.to_text(rcode)))
+        if rcode != dns.rcode.NOERROR:
+            return response
+        qname = response.question[0].name
+        if response.answer:
+            if response.get_rrset(response.answer, qname, dns.rdataclass.IN, dns.rdatatype.PTR) is None:
+                raise Unresolvable("{} has no PTR in the answer, a CNAME probably".format(qname))
+            return response
+        for rrset in response.authority:
+            if rrset.rdtype != dns.rdatatype.NS:
+                continue
+            zone = rrset.name
+            # Referrals go down the tree, towards the name asked for
+            if not qname.is_subdomain(zone) or not zone.is_subdomain(_IN_ADDR_ARPA) or zone == _IN_ADDR_ARPA:
+                raise Unresolvable("Bad referral to {} for {}".format(zone, qname))
+            ttl = rrset.ttl
+            servers = []
+            for ns in rrset:
+                glue = response.get_rrset(response.additional, ns.target, dns.rdataclass.IN, dns.rdatatype.A)
+                if glue is not None:
+                    servers.extend(rdata.address for rdata in glue)
+                    ttl = min(ttl, glue.ttl)
+            if not servers:
+                hosts = [ns.target.to_text() for ns in rrset]
+                found = [self.hostAddresses(host, lookup) for host in hosts]
+                if None in found:
+                    raise MissingGlue([host for (host, addresses) in zip(hosts, found) if addresses is None])
+                servers = [address for addresses in found for address in addresses]
+            if not servers:
+                raise Unresolvable("No addresses for the nameservers of {}".format(zone))
+            self.store(zone.to_text(), sorted(set(servers)), ttl)
+            raise Referral(zone.to_text())
+        raise Unresolvable("No answer and no referral for {}".format(qname))
+
+
+_cache = None
+_cachelock = threading.Lock()
+
+def getCache(roots=None):
+    """
+    The process' DelegationCache, made with roots (default ROOTS) the first time.
+    """
+    global _cache
+    with _cachelock:
+        if _cache is None:
+            _cache = DelegationCache(roots or ROOTS)
+        return _cache
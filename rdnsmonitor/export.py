@@ -0,0 +1,257 @@
+"""
+Columnar snapshots of the results db, for offline analysis.
+
+exportSnapshot() streams ptrrecords and then statusranges in ip order, chunk_size rows at a time (keyset paging, so every
+query is short and cheap for the live db), into a snapshot file. Memory use is bounded by the chunk size.
+
+The packed format is a series of chunks, each holding its columns back to back:
+
+    ips         uint32[n], ascending
+    statuses    uint8[n], the status codes of dbobjects (0 for a PTR), padded to 4 bytes
+    offsets     uint32[n + 1] into the chunk's string data, for the PTRs (empty for the other statuses)
+    strings     the PTRs, utf-8, padded to 4 bytes
+
+then the status ranges as uint32 (ipfrom, ipto, status) triples, followed by a footer with (offset, n, first ip, last ip)
+per chunk, the offset and number of ranges, the chunk count and MAGIC. All numbers are little endian.
+Snapshot memory maps such a file and looks addresses up by bisecting the chunks and their ip column, and then the ranges.
+
+With pyarrow installed, exportSnapshot(format="parquet") writes a Parquet file instead: a row group per chunk, with ip
+and ipto uint32 columns (ipto is ip + 1 for single records), a status uint8 column and a dictionary encoded ptr column.
+"""
+import bisect
+import logging
+import mmap
+import struct
+import sys
+from array import array
+
+from sqlalchemy import select
+
+from rdnsmonitor.dbobjects import PTRRecord, StatusRange, STATUS_PTR, encodeResult, decodeResult
+
+log = logging.getLogger(__name__)
+
+MAGIC = b"RDNSSNP2"
+CHUNK_SIZE = 2**20
+
+_CHUNK = struct.Struct("<QIII")
+_TAIL = struct.Struct("<QII8s")
+_RANGE = struct.Struct("<III")
+
+def _checkPlatform():
+    # The columns are written and mapped as native arrays
+    if sys.byteorder != "little" or array("I").itemsize != 4:
+        raise RuntimeError("Packed snapshots need a little endian machine with 4 byte unsigned ints")
+
+def _pad(data):
+    return data + bytes(-len(data) % 4)
+
+def _records(engine, chunk_size):
+    """
+    Yields lists of up to chunk_size (ip, status, ptr) tuples, in ip order.
+    """
+    table = PTRRecord.__table__
+    last = -1
+    while True:
+        query = select(table.c.ip, table.c.status, table.c.ptr).where(table.c.ip > last).order_by(table.c.ip).limit(chunk_size)
+        with engine.connect() as conn:
+            rows = conn.execute(query).fetchall()
+        if not rows:
+            return
+        # Rows from before status codes have their status in ptr
+        yield [(ip, status, ptr) if status is not None else (ip,) + encodeResult(ptr) for (ip, status, ptr) in rows]
+        last = rows[-1][0]
+
+def _ranges(engine, chunk_size):
+    """
+    Yields lists of up to chunk_size (ipfrom, ipto, status) tuples, in ip order.
+    """
+    table = StatusRange.__table__
+    last = -1
+    while True:
+        query = select(table.c.ipfrom, table.c.ipto, table.c.status).where(table.c.ipfrom > last).order_by(table.c.ipfrom).limit(chunk_size)
+        with engine.connect() as conn:
+            rows = conn.execute(query).fetchall()
+        if not rows:
+            return
+        yield [tuple(row) for row in rows]
+        last = rows[-1][0]
+
+def _packChunk(rows):
+    ips = array("I", (ip for (ip, status, ptr) in rows))
+    statuses = bytes(status for (ip, status, ptr) in rows)
+    offsets = array("I", [0])
+    strings = bytearray()
+    for (ip, status, ptr) in rows:
+        if status == STATUS_PTR and ptr:
+            strings += ptr.encode()
+        offsets.append(len(strings))
+    return ips.tobytes() + _pad(statuses) + offsets.tobytes() + _pad(bytes(strings))
+
+def exportSnapshot(engine, path, chunk_size=CHUNK_SIZE, format="packed"):
+    """
+    Writes all PTR records in the results db at engine to a snapshot at path. Returns the number of records.
+    """
+    if format == "parquet":
+        return _exportParquet(engine, path, chunk_size)
+    _checkPlatform()
+    count = 0
+    chunks = []
+    with open(path, "wb") as fh:
+        fh.write(MAGIC)
+        for rows in _records(engine, chunk_size):
+            chunks.append((fh.tell(), len(rows), rows[0][0], rows[-1][0]))
+            fh.write(_packChunk(rows))
+            count += len(rows)
+            log.info("Exported %d records", count)
+        rangesoffset = fh.tell()
+        numranges = 0
+        for rows in _ranges(engine, chunk_size):
+            fh.write(array("I", (value for row in rows for value in row)).tobytes())
+            numranges += len(rows)
+        for chunk in chunks:
+            fh.write(_CHUNK.pack(*chunk))
+        fh.write(_TAIL.pack(rangesoffset, numranges, len(chunks), MAGIC))
+    log.info("Snapshot of %d records in %d chunks and %d status ranges written to %s", count, len(chunks), numranges, path)
+    return count
+
+def _exportParquet(engine, path, chunk_size):
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("Parquet snapshots need pyarrow (pip install pyarrow)")
+    schema = pyarrow.schema([("ip", pyarrow.uint32()), ("ipto", pyarrow.uint32()), ("status", pyarrow.uint8()),
+                             ("ptr", pyarrow.dictionary(pyarrow.int32(), pyarrow.string()))])
+    
+    def table(ips, iptos, statuses, ptrs):
+        columns = [pyarrow.array(ips, pyarrow.uint32()), pyarrow.array(iptos, pyarrow.uint32()), pyarrow.array(statuses, pyarrow.uint8()),
+                   pyarrow.array(ptrs, pyarrow.string()).dictionary_encode()]
+        return pyarrow.Table.from_arrays(columns, schema=schema)
+    
+    count = 0
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        for rows in _records(engine, chunk_size):
+            (ips, statuses, ptrs) = zip(*rows)
+            writer.write_table(table(ips, [ip + 1 for ip in ips], statuses, ptrs))
+            count += len(rows)
+            log.info("Exported %d records", count)
+        for rows in _ranges(engine, chunk_size):
+            (ips, iptos, statuses) = zip(*rows)
+            writer.write_table(table(ips, iptos, statuses, [None] * len(rows)))
+    log.info("Parquet snapshot of %d records written to %s", count, path)
+    return count
+
+
+class _Chunk(object):
+
+    def __init__(self, buf, offset, count):
+        self.count = count
+        self.ips = buf[offset:offset + 4 * count].cast("I")
+        offset += 4 * count
+        self.statuses = buf[offset:offset + count]
+        offset += count + (-count % 4)
+        self.offsets = buf[offset:offset + 4 * (count + 1)].cast("I")
+        offset += 4 * (count + 1)
+        self.strings = buf[offset:offset + self.offsets[count]]
+        return
+
+    def result(self, i):
+        status = self.statuses[i]
+        if status != STATUS_PTR:
+            return decodeResult(status, None)
+        return bytes(self.strings[self.offsets[i]:self.offsets[i + 1]]).decode()
+
+
+class _Column(object):
+    """
+    Every stride-th item of an array from start on, as a sequence bisect can search.
+    """
+
+    def __init__(self, view, stride, start):
+        self._view = view
+        self._stride = stride
+        self._start = start
+
+    def __len__(self):
+        return len(self._view) // self._stride
+
+    def __getitem__(self, i):
+        return self._view[i * self._stride + self._start]
+
+
+class Snapshot(object):
+    """
+    Read only view of a packed snapshot, memory mapped, so only the pages that get looked at are read from disk.
+    """
+
+    def __init__(self, path):
+        _checkPlatform()
+        self._fh = open(path, "rb")
+        self._mmap = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self._buf = buf = memoryview(self._mmap)
+        (rangesoffset, numranges, numchunks, magic) = _TAIL.unpack_from(buf, len(buf) - _TAIL.size)
+        if buf[:len(MAGIC)] != MAGIC or magic != MAGIC:
+            raise ValueError("{} is not a packed snapshot".format(path))
+        footer = len(buf) - _TAIL.size - numchunks * _CHUNK.size
+        self._chunks = []
+        self._firstips = []
+        for i in range(numchunks):
+            (offset, count, firstip, lastip) = _CHUNK.unpack_from(buf, footer + i * _CHUNK.size)
+            self._chunks.append(_Chunk(buf, offset, count))
+            self._firstips.append(firstip)
+        self.count = sum(chunk.count for chunk in self._chunks)
+        self._ranges = buf[rangesoffset:rangesoffset + _RANGE.size * numranges].cast("I")
+        self.numranges = numranges
+        return
+
+    def __len__(self):
+        return self.count
+
+    def lookup(self, ipint):
+        """
+        The result stored for ipint, or None if the snapshot has none.
+        """
+        c = bisect.bisect_right(self._firstips, ipint) - 1
+        if c >= 0:
+            chunk = self._chunks[c]
+            i = bisect.bisect_left(chunk.ips, ipint)
+            if i < chunk.count and chunk.ips[i] == ipint:
+                return chunk.result(i)
+        r = bisect.bisect_right(_Column(self._ranges, 3, 0), ipint) - 1
+        if r >= 0 and self._ranges[3 * r + 1] > ipint:
+            return decodeResult(self._ranges[3 * r + 2], None)
+        return None
+
+    def ranges(self):
+        """
+        Yields (ipfrom, ipto, result) for every status range, in ip order.
+        """
+        for r in range(self.numranges):
+            yield (self._ranges[3 * r], self._ranges[3 * r + 1], decodeResult(self._ranges[3 * r + 2], None))
+
+    def __iter__(self):
+        """
+        Yields (ipint, result) for every record (not the status ranges), in ip order.
+        """
+        for chunk in self._chunks:
+            for i in range(chunk.count):
+                yield (chunk.ips[i], chunk.result(i))
+
+    def close(self):
+        for chunk in self._chunks:
+            for view in (chunk.ips, chunk.statuses, chunk.offsets, chunk.strings):
+                view.release()
+        self._chunks = []
+        self._ranges.release()
+        self._buf.release()
+        self._mmap.close()
+        self._fh.close()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
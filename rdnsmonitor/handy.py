@@ -6,3 +6,12 @@ def ipToInt(ipstr):
 
 def intToIp(ipInt):
     return socket.inet_ntoa(struct.pack("!I", ipInt))
+
+def cidrToRange(cidr):
+    """
+    "10.0.0.0/8" -> (start, end) as ints, end exclusive.
+    """
+    (ipstr, _, prefixlen) = cidr.partition("/")
+    size = 2**(32 - int(prefixlen or 32))
+    start = ipToInt(ipstr) & ~(size - 1) & 0xffffffff
+    return (start, start + size)
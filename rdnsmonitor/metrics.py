@@ -0,0 +1,294 @@
+"""
+Counters, gauges and histograms for what workers and the C2 server are doing, while they are doing it.
+
+Metrics live in a Registry (REGISTRY by default) and are updated from any thread. MetricsServer exposes them over
+HTTP in the Prometheus text format:
+
+    GET /metrics                the registry
+    GET /profile?seconds=N      samples the stacks of all threads for N seconds (default 10) and returns the hottest
+
+The profile is a sampling one: cProfile only sees the thread that turns it on, which would miss every worker.
+Sampling costs nothing while nobody asks for a profile.
+
+Summary logs a line every interval seconds with the rate of every counter and the value of every gauge.
+"""
+import bisect
+import collections
+import http.server
+import logging
+import sys
+import threading
+import time
+import traceback
+import urllib.parse
+
+log = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _labelText(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"')) for (name, value) in pairs) + "}"
+
+
+class _Metric(object):
+    TYPE = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        return
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.TYPE)]
+        with self._lock:
+            items = sorted(self._values.items())
+        for (key, value) in items:
+            lines.append("{}{} {}".format(self.name, _labelText(self.labelnames, key), value))
+        return lines
+
+    def total(self):
+        with self._lock:
+            return sum(self._values.values())
+
+
+class Counter(_Metric):
+    TYPE = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        return
+
+
+class Gauge(_Metric):
+    """
+    A value that is set, or, with a function, read whenever the gauge is rendered.
+    """
+    TYPE = "gauge"
+
+    def __init__(self, name, help, labelnames=(), function=None):
+        _Metric.__init__(self, name, help, labelnames)
+        self.function = function
+        return
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+        return
+
+    def _refresh(self):
+        if self.function is not None:
+            try:
+                self.set(self.function())
+            except Exception as ex:
+                log.debug("Gauge %s failed: %s", self.name, repr(ex))
+        return
+
+    def render(self):
+        self._refresh()
+        return _Metric.render(self)
+
+    def total(self):
+        self._refresh()
+        return _Metric.total(self)
+
+
+class Histogram(_Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        _Metric.__init__(self, name, help, labelnames)
+        self.buckets = tuple(buckets)
+        return
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+        return
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.TYPE)]
+        with self._lock:
+            items = sorted((key, list(counts)) for (key, counts) in self._values.items())
+        for (key, counts) in items:
+            cumulative = 0
+            for (bound, count) in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(self.name, _labelText(self.labelnames, key, [("le", bound)]), cumulative))
+            lines.append("{}_sum{} {}".format(self.name, _labelText(self.labelnames, key), counts[-1]))
+            lines.append("{}_count{} {}".format(self.name, _labelText(self.labelnames, key), cumulative))
+        return lines
+
+    def total(self):
+        with self._lock:
+            return sum(sum(counts[:-1]) for counts in self._values.values())
+
+
+class Registry(object):
+
+    def __init__(self):
+        self._metrics = collections.OrderedDict()
+        self._lock = threading.Lock()
+        return
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=(), function=None):
+        gauge = self._register(Gauge, name, help, labelnames)
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram, name, help, labelnames, buckets=buckets)
+
+    def metrics(self):
+        with self._lock:
+            return list(self._metrics.values())
+
+    def render(self):
+        lines = []
+        for metric in self.metrics():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+
+def sampleStacks(seconds, interval=0.005, top=40):
+    """
+    Samples the stacks of all other threads every interval seconds for the given number of seconds. Returns a report of
+    the top stacks (innermost frame last) and functions by the share of samples they showed up in.
+    """
+    me = threading.get_ident()
+    names = {thread.ident:thread.name for thread in threading.enumerate()}
+    stacks = collections.Counter()
+    functions = collections.Counter()
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for (ident, frame) in sys._current_frames().items():
+            if ident == me:
+                continue
+            entries = traceback.extract_stack(frame)
+            stack = ";".join("{}:{}".format(entry.filename.rsplit("/", 1)[-1], entry.name) for entry in entries[-8:])
+            stacks[(names.get(ident, str(ident)).rstrip("0123456789"), stack)] += 1
+            for name in set("{}:{}".format(entry.filename.rsplit("/", 1)[-1], entry.name) for entry in entries):
+                functions[name] += 1
+            samples += 1
+        time.sleep(interval)
+    lines = ["{:d} samples over {:.1f}s".format(samples, seconds), "", "Functions (share of samples they are on the stack in):"]
+    lines += ["{:6.1%}  {}".format(count / max(samples, 1), name) for (name, count) in functions.most_common(top)]
+    lines += ["", "Stacks:"]
+    lines += ["{:6.1%}  {}  {}".format(count / max(samples, 1), thread, stack) for ((thread, stack), count) in stacks.most_common(top)]
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path == "/metrics":
+            return self._reply(200, self.server.registry.render(), "text/plain; version=0.0.4")
+        if url.path == "/profile":
+            query = urllib.parse.parse_qs(url.query)
+            seconds = min(float(query.get("seconds", ["10"])[0]), MetricsServer.MAX_PROFILE)
+            return self._reply(200, sampleStacks(seconds), "text/plain")
+        return self._reply(404, "no such endpoint\n", "text/plain")
+
+    def _reply(self, status, text, contenttype):
+        body = text.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", contenttype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return
+
+    def log_message(self, format, *args):
+        log.debug("%s %s", self.address_string(), format % args)
+
+
+class MetricsServer(object):
+    """
+    Serves a registry over HTTP. start() runs the HTTP server in a background thread.
+    """
+    MAX_PROFILE = 300
+
+    def __init__(self, host="127.0.0.1", port=9153, registry=REGISTRY):
+        self._httpd = http.server.ThreadingHTTPServer((host, port), _MetricsHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.registry = registry
+        self.address = self._httpd.server_address
+        self._thread = None
+        return
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="MetricsServer", daemon=True)
+        self._thread.start()
+        log.info("Metrics on http://%s:%d/metrics", *self.address)
+        return
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        return
+
+
+class Summary(threading.Thread):
+    """
+    Logs the rate of every counter and histogram and the value of every gauge every interval seconds, on one line.
+    """
+    INTERVAL = 60
+
+    def __init__(self, registry=REGISTRY, interval=INTERVAL):
+        threading.Thread.__init__(self, name="MetricsSummary", daemon=True)
+        self.registry = registry
+        self.interval = interval
+        self._stopping = threading.Event()
+        return
+
+    def run(self):
+        last = {}
+        lasttime = time.monotonic()
+        while not self._stopping.wait(self.interval):
+            now = time.monotonic()
+            parts = []
+            for metric in self.registry.metrics():
+                total = metric.total()
+                if isinstance(metric, Gauge):
+                    parts.append("{}={:g}".format(metric.name, total))
+                else:
+                    parts.append("{}={:.1f}/s".format(metric.name, (total - last.get(metric.name, 0)) / (now - lasttime)))
+                last[metric.name] = total
+            lasttime = now
+            if parts:
+                log.info("Metrics: %s", ", ".join(parts))
+        return
+
+    def stop(self):
+        self._stopping.set()
+        return
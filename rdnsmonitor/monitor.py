@@ -1,18 +1,31 @@
+import collections
 import logging
 import queue
 import threading
 import datetime
+import itertools
+import time
+import uuid
 
 import sqlalchemy
-from sqlalchemy import and_, or_
+from sqlalchemy import and_, or_, select, update, func
 
-from rdnsmonitor import JobdbSession, ResultdbSession
-from rdnsmonitor.dbobjects import Job,Base,PTRRecord, ResultBase
+from rdnsmonitor import JobdbSession, ResultdbSession, bogons
+from rdnsmonitor.dbobjects import Job, JobHistory, Base, ResultBase
 from rdnsmonitor import handy
-from rdnsmonitor.work import LocalWorker
+from rdnsmonitor import metrics
+from rdnsmonitor import storage
+from rdnsmonitor import resweep
 
 log = logging.getLogger(__name__)
 
+JOBS_LEASED = metrics.REGISTRY.counter("rdns_jobs_leased_total", "Jobs handed out to workers")
+JOB_WAIT_SECONDS = metrics.REGISTRY.histogram("rdns_job_wait_seconds", "Time retrieveNewJob took, waiting for a job included")
+JOBS_FINISHED = metrics.REGISTRY.counter("rdns_jobs_finished_total", "Jobs finished by workers")
+JOB_FINISH_SECONDS = metrics.REGISTRY.histogram("rdns_job_finish_seconds", "Time finishJob took to store a finished job")
+RESULTS_QUEUED = metrics.REGISTRY.counter("rdns_results_queued_total", "Results handed to the result writer")
+RESULT_PUT_SECONDS = metrics.REGISTRY.histogram("rdns_result_put_seconds", "Time storeResults was blocked on a full result queue")
+
 c2server = None
 
 def getServer(**kwargs):
@@ -20,10 +33,73 @@ def getServer(**kwargs):
     if not c2server:
         c2server = C2Server(**kwargs)
     return c2server
+
+def _addMissingColumns(db, metadata):
+    """
+    create_all() does not touch existing tables, so add columns that were introduced later on by hand.
+    Only works for nullable columns, which is what new columns should be anyway.
+    """
+    inspector = sqlalchemy.inspect(db)
+    with db.begin() as conn:
+        for table in metadata.sorted_tables:
+            existing = [col["name"] for col in inspector.get_columns(table.name)]
+            for column in table.columns:
+                if column.name not in existing:
+                    log.info("Adding column %s.%s", table.name, column.name)
+                    coltype = column.type.compile(dialect=db.dialect)
+                    conn.execute(sqlalchemy.text("ALTER TABLE {} ADD COLUMN {} {}".format(table.name, column.name, coltype)))
+    return
+
+def _addMissingIndexes(db, metadata):
+    """
+    Same as _addMissingColumns(), for indexes.
+    """
+    inspector = sqlalchemy.inspect(db)
+    for table in metadata.sorted_tables:
+        existing = [index["name"] for index in inspector.get_indexes(table.name)]
+        for index in table.indexes:
+            if index.name not in existing:
+                log.info("Adding index %s, which takes a while on a big table", index.name)
+                index.create(db)
+    return
+
+def _backfillDue(db):
+    """
+    Jobs finished before due dates were kept are due right after completion, and jobs reset before resetting cleared
+    the due date have none. Only the rows without one, or with one and no completion, are touched (both indexed).
+    """
+    with db.begin() as conn:
+        backfilled = conn.execute(update(Job.__table__).where(and_(Job.due == None, Job.completed != None))
+                                  .values(due=Job.completed)).rowcount
+        cleared = conn.execute(update(Job.__table__).where(and_(Job.completed == None, Job.due != None))
+                               .values(due=None)).rowcount
+    if backfilled or cleared:
+        log.info("Set the due date of %d completed jobs, cleared it on %d open ones", backfilled, cleared)
+    return
+
+def jobCounts(db):
+    """
+    The number of jobs by state: all, open (not finished, or due again and reset; leased ones included), leased,
+    completed and due for another sweep. Only looks at the ends of the primary key and ranges of the indexes on the
+    state columns, so it stays fast on millions of jobs. Jobs are never deleted, so their ids have no gaps.
+    """
+    now = datetime.datetime.now()
+    with db.connect() as conn:
+        # Separately: SQLite only looks up a min() or max() on its own, both at once is a scan
+        first = conn.execute(select(func.min(Job.id))).scalar()
+        last = conn.execute(select(func.max(Job.id))).scalar()
+        counts = {"jobs":last - first + 1 if last is not None else 0}
+        counts["completed"] = conn.execute(select(func.count()).where(Job.completed != None)).scalar()
+        counts["open"] = counts["jobs"] - counts["completed"]
+        # Finishing and releasing a job clear its lease
+        counts["leased"] = conn.execute(select(func.count()).where(Job.lease_expires > now)).scalar()
+        counts["due"] = conn.execute(select(func.count()).where(Job.due <= now)).scalar()
+    return counts
     
 class C2Server(object):
     
     JOB_BATCH_SIZE = 1024
+    LEASE_TIME = 3600
     
     def __init__(self, newjobsdb=False, **kwargs):
         self.config = {}
@@ -32,9 +108,29 @@ class C2Server(object):
         logging.getLogger('sqlalchemy.engine').setLevel(logging.getLogger().level + 1)
         self._jobsdb = self._initJobsDb(newjobsdb)
         self._resultsdb = self._initResultsDb(False)
+        self._resultwriter = storage.ResultWriter(self._resultsdb,
+                                                  int(self.config.get("result_batch_size", storage.ResultWriter.BATCH_SIZE)),
+                                                  queue_size=int(self.config.get("result_queue_size", storage.ResultWriter.QUEUE_SIZE)),
+                                                  txn_size=int(self.config.get("result_txn_size", storage.ResultWriter.TXN_SIZE)))
+        self._resultwriter.start()
+        self._lease_time = datetime.timedelta(seconds=int(self.config.get("lease_time", C2Server.LEASE_TIME)))
+        self._job_prefetch = int(self.config.get("job_prefetch", C2Server.JOB_BATCH_SIZE))
+        self._resweep_min = datetime.timedelta(seconds=int(self.config.get("resweep_min_interval", resweep.MIN_INTERVAL.total_seconds())))
+        self._resweep_max = datetime.timedelta(seconds=int(self.config.get("resweep_max_interval", resweep.MAX_INTERVAL.total_seconds())))
         self._jobqueue = queue.Queue()
         self._joblock = threading.Lock()
-        self._fillJobQueue()  
+        # Ids of the jobs in the queue: their claims may lapse before a worker gets them, and they must not be claimed twice
+        self._queued = set()
+        # Per job: result batches queued and not written yet, and the first address of the earliest batch that failed
+        self._batches = collections.Counter()
+        self._lostfrom = {}
+        self._batchcond = threading.Condition()
+        self._refill = threading.Event()
+        self._stopping = threading.Event()
+        self._prefetcher = threading.Thread(target=self._prefetchJobs, name="JobPrefetcher", daemon=True)
+        self._prefetcher.start()
+        metrics.REGISTRY.gauge("rdns_job_queue_depth", "Leased jobs waiting to be handed out", function=self._jobqueue.qsize)
+        metrics.REGISTRY.gauge("rdns_result_queue_depth", "Result batches waiting for the result writer", function=self._resultwriter.qsize)
         return
 
     def configure(self, **kwargs):
@@ -47,68 +143,304 @@ class C2Server(object):
                            "start_ip":2**24,
                            "end_ip":2**32,
                            "block_size":2**12,
+                           "result_batch_size":storage.ResultWriter.BATCH_SIZE,
+                           "result_queue_size":storage.ResultWriter.QUEUE_SIZE,
+                           "result_txn_size":storage.ResultWriter.TXN_SIZE,
+                           "lease_time":C2Server.LEASE_TIME,
+                           "job_prefetch":C2Server.JOB_BATCH_SIZE,
+                           "resweep_min_interval":int(resweep.MIN_INTERVAL.total_seconds()),
+                           "resweep_max_interval":int(resweep.MAX_INTERVAL.total_seconds()),
                            }
             log.info("Set default config:\n%s", self.config)
             
         return True        
         
     def watchdog(self):
-        # check workers are alive
-        # check for neglected jobs
-        return True
+        """
+        Jobs whose lease ran out (the worker died or hung) are handed out again by the next claim.
+        This only reports how many of those there are.
+        """
+        with self._joblock:
+            queued = list(self._queued)
+        session = JobdbSession()
+        # Finishing a job clears its lease, so this is a range of the lease_expires index and not a scan of the open jobs
+        stale = session.query(Job).filter(and_(Job.lease_expires < datetime.datetime.now(), Job.id.not_in(queued))).count()
+        session.close()
+        if stale:
+            log.warning("%d jobs have an expired lease and will be requeued", stale)
+        return stale
+
+    def _claimJobs(self, count):
+        """
+        Leases up to count open jobs (never finished, and not leased or with an expired lease) in one statement.
+        The lease is made out to a fresh claim token; retrieveNewJob() hands it over to the worker. Jobs still in the
+        queue are left alone, also when their claim ran out.
+        """
+        now = datetime.datetime.now()
+        token = "claim-" + uuid.uuid4().hex[:16]
+        with self._joblock:
+            queued = list(self._queued)
+        openjobs = (select(Job.id)
+                    .where(and_(Job.started == None, or_(Job.lease_expires == None, Job.lease_expires < now), Job.id.not_in(queued)))
+                    .order_by(Job.id).limit(count)
+                    .with_for_update(skip_locked=True))
+        stmt = (update(Job.__table__)
+                .where(Job.id.in_(openjobs.scalar_subquery()))
+                .values(retrieved=now, lease_owner=token, lease_expires=now + self._lease_time))
+        with self._jobsdb.begin() as conn:
+            if getattr(self._jobsdb.dialect, "update_returning", False):
+                rows = conn.execute(stmt.returning(*Job.__table__.c)).fetchall()
+            else:
+                conn.execute(stmt)
+                rows = conn.execute(select(*Job.__table__.c).where(Job.lease_owner == token)).fetchall()
+        return [Job(**row._mapping) for row in rows]
+
+    def _resetOldJobs(self, count):
+        """
+        Puts up to count completed jobs that are due for another sweep back in the open state, most overdue first.
+        Only completed jobs have a due date (see finishJob() and _backfillDue()), so this is a range of the due index.
+        """
+        oldjobs = (select(Job.id)
+                   .where(and_(Job.due <= datetime.datetime.now(), Job.completed != None))
+                   .order_by(Job.due).limit(count))
+        stmt = (update(Job.__table__)
+                .where(Job.id.in_(oldjobs.scalar_subquery()))
+                .values(started=None, completed=None, due=None, lease_owner=None, lease_expires=None, checkpoint=None))
+        with self._jobsdb.begin() as conn:
+            return conn.execute(stmt).rowcount
 
     def _fillJobQueue(self):
         log.info("Filling jobs queue...")
-        session = JobdbSession()
-        added = 0
-        for job in session.query(Job).filter(Job.started == None)[:C2Server.JOB_BATCH_SIZE]:
+        wanted = self._job_prefetch - self._jobqueue.qsize()
+        jobs = self._claimJobs(wanted)
+        log.info("Added %d open jobs", len(jobs))
+        if len(jobs) < wanted: 
+            log.info("Open jobs depleted, adding completed jobs that are due again")
+            reset = self._resetOldJobs(wanted - len(jobs))
+            oldjobs = self._claimJobs(wanted - len(jobs))
+            log.info("Added %d old jobs (%d reset)", len(oldjobs), reset)
+            jobs += oldjobs
+        with self._joblock:
+            self._queued.update(job.id for job in jobs)
+        for job in jobs:
             self._jobqueue.put(job)
-            added += 1
-        log.info("Added %d open jobs", added)
-        oldadded = 0
-        if added < C2Server.JOB_BATCH_SIZE: 
-            log.info("Open jobs depleted, adding old completed jobs")
-            for job in session.query(Job).filter(Job.completed != None)[:C2Server.JOB_BATCH_SIZE - added]:
-                job.started = job.completed = None
-                self._jobqueue.put(job)
-                oldadded += 1
-            log.info("Added %d old jobs", oldadded)
-        session.close()
         log.info("Jobs queue filled!")
-        return True
+        return len(jobs)
+
+    def _prefetchJobs(self):
+        """
+        Keeps the job queue topped up in the background, so workers never wait for a claim.
+        """
+        while not self._stopping.is_set():
+            try:
+                if self._jobqueue.qsize() < self._job_prefetch // 2 + 1 and not self._fillJobQueue():
+                    log.warning("No jobs available, retrying in 10s")
+                    self._stopping.wait(10)
+                    continue
+                self.watchdog()
+            except Exception as ex:
+                log.error("Error prefetching jobs: %s", repr(ex))
+                self._stopping.wait(10)
+                continue
+            self._refill.wait(self._lease_time.total_seconds() / 2)
+            self._refill.clear()
+        return
         
-    def retrieveNewJob(self):
-        session = JobdbSession()
-        job = self._jobqueue.get()
-        job.retrieved = datetime.datetime.now()
-        session.commit()
-        if self._jobqueue.qsize() == 0:
-            log.info("Uhoh, jobqueue is empty...")
-            self._fillJobQueue()
-            
+    def retrieveNewJob(self, owner=None, timeout=None):
+        """
+        Returns the next job, leased to owner for lease_time, or None if no job came up within timeout seconds.
+        Jobs whose lease lapsed while they were queued (and might have been claimed again elsewhere) are skipped.
+        The job's lease_owner is owner with a token of this lease added (owner/token), so that workers of the same name
+        (on other hosts, or an earlier run) can not renew, store for or finish each other's jobs.
+        """
+        lease = "{}/{}".format((owner or "anonymous")[:33], uuid.uuid4().hex[:16])
+        start = time.monotonic()
+        while True:
+            try:
+                job = self._jobqueue.get(timeout=timeout)
+            except queue.Empty:
+                JOB_WAIT_SECONDS.observe(time.monotonic() - start)
+                return None
+            with self._joblock:
+                self._queued.discard(job.id)
+            if self._jobqueue.qsize() < self._job_prefetch // 2:
+                self._refill.set()
+            now = datetime.datetime.now()
+            stmt = (update(Job.__table__)
+                    .where(and_(Job.id == job.id, Job.lease_owner == job.lease_owner))
+                    .values(retrieved=now, lease_owner=lease, lease_expires=now + self._lease_time))
+            with self._jobsdb.begin() as conn:
+                if conn.execute(stmt).rowcount == 1:
+                    break
+            log.info("Lost the lease on %s, skipping it", repr(job))
+        job.retrieved = now
+        job.lease_owner = lease
+        job.lease_expires = now + self._lease_time
+        JOBS_LEASED.inc()
+        JOB_WAIT_SECONDS.observe(time.monotonic() - start)
         return job
+    
+    def renewLease(self, job):
+        """
+        Extends the lease on a job that is being worked on. Returns False if the job is not leased to its worker anymore.
+        """
+        expires = datetime.datetime.now() + self._lease_time
+        stmt = (update(Job.__table__)
+                .where(and_(Job.id == job.id, Job.lease_owner == job.lease_owner))
+                .values(lease_expires=expires))
+        with self._jobsdb.begin() as conn:
+            renewed = conn.execute(stmt).rowcount == 1
+        if renewed:
+            job.lease_expires = expires
+        else:
+            log.warning("Lease of %s on job %d was lost", job.lease_owner, job.id)
+        return renewed
         
-    def storeResults(self, results):
-        log.debug("Storing %d results...", len(results))
-        session = ResultdbSession()
+    def releaseJob(self, job):
+        """
+        Gives up the lease on a job that was not finished (its worker is shutting down), so it can be claimed again
+        right away. The next worker picks it up at its checkpoint.
+        """
+        released = self._releaseLease(job)
+        log.info("Released %s at checkpoint %s", repr(job), handy.intToIp(job.checkpoint) if job.checkpoint else "-")
+        return released
+
+    def _releaseLease(self, job):
+        stmt = (update(Job.__table__)
+                .where(and_(Job.id == job.id, Job.lease_owner == job.lease_owner))
+                .values(lease_owner=None, lease_expires=None))
+        with self._jobsdb.begin() as conn:
+            return conn.execute(stmt).rowcount == 1
+
+    def _saveCheckpoint(self, jobid, checkpoint):
+        stmt = (update(Job.__table__)
+                .where(and_(Job.id == jobid, Job.completed == None, or_(Job.checkpoint == None, Job.checkpoint < checkpoint)))
+                .values(checkpoint=checkpoint))
+        with self._jobsdb.begin() as conn:
+            conn.execute(stmt)
+        return
+
+    def storeResults(self, results, job=None, checkpoint=None):
+        """
+        Queues the results for the result writer. Blocks while the writer is behind.
+        With a job and a checkpoint, the job's checkpoint is moved up to it once the results are committed.
+        Once a batch of a job failed, its checkpoint stays before that batch until a later one covers it again, and the
+        job is not finished but given back (see finishJob()).
+        """
+        log.debug("Queueing %d results...", len(results))
+        start = time.monotonic()
+        done = failed = None
+        if job is not None:
+            jobid = job.id
+            batchfrom = min((ipint for (ipint, result) in results), default=checkpoint)
+            done = lambda: self._batchStored(jobid, batchfrom, checkpoint)
+            failed = lambda: self._batchLost(jobid, batchfrom)
+            with self._batchcond:
+                self._batches[jobid] += 1
         try:
-            for ptrr in [PTRRecord(ip=ipint, ptr=ptrstr) for (ipint, ptrstr) in results]:
-                session.merge(ptrr)
-            session.commit()
-        except Exception as ex:
-            session.rollback()
-            log.error("Error storing results: %s", str(ex))
-            log.error("rolled back.")
-        else:
-            log.debug("%d results stored!", len(results))
-        session.close()
+            self._resultwriter.put(results, done, failed)
+        except Exception:
+            if job is not None:
+                self._batchDone(jobid)
+            raise
+        RESULT_PUT_SECONDS.observe(time.monotonic() - start)
+        RESULTS_QUEUED.inc(len(results))
+        return
+
+    def _batchStored(self, jobid, batchfrom, checkpoint):
+        try:
+            with self._batchcond:
+                lostfrom = self._lostfrom.get(jobid)
+                if lostfrom is not None and checkpoint is not None and batchfrom <= lostfrom < checkpoint:
+                    log.info("Lost results of job %d stored again", jobid)
+                    del self._lostfrom[jobid]
+                    lostfrom = None
+            if checkpoint is not None:
+                self._saveCheckpoint(jobid, checkpoint if lostfrom is None else min(checkpoint, lostfrom))
+        finally:
+            self._batchDone(jobid)
+        return
+
+    def _batchLost(self, jobid, batchfrom):
+        try:
+            with self._batchcond:
+                self._lostfrom[jobid] = min(batchfrom, self._lostfrom.get(jobid, batchfrom))
+            log.warning("Results of job %d from %s were not stored", jobid, handy.intToIp(batchfrom))
+            # A later batch may have moved the checkpoint past it already
+            stmt = (update(Job.__table__)
+                    .where(and_(Job.id == jobid, Job.completed == None, Job.checkpoint > batchfrom))
+                    .values(checkpoint=batchfrom))
+            with self._jobsdb.begin() as conn:
+                conn.execute(stmt)
+        finally:
+            self._batchDone(jobid)
+        return
+
+    def _batchDone(self, jobid):
+        with self._batchcond:
+            self._batches[jobid] -= 1
+            if self._batches[jobid] <= 0:
+                del self._batches[jobid]
+            self._batchcond.notify_all()
         return
     
+    def shutdown(self):
+        self._stopping.set()
+        self._refill.set()
+        self._releaseQueuedJobs()
+        log.info("Shutting down, flushing %d queued result batches...", self._resultwriter.qsize())
+        self._resultwriter.close()
+        log.info("Server shut down")
+        return True
+    
+    def _releaseQueuedJobs(self):
+        """
+        Gives up the leases on the jobs claimed in advance that no worker got, so a restart does not have to wait them out.
+        """
+        count = 0
+        while True:
+            try:
+                job = self._jobqueue.get_nowait()
+            except queue.Empty:
+                break
+            with self._joblock:
+                self._queued.discard(job.id)
+            count += self._releaseLease(job)
+        log.info("Released %d queued jobs", count)
+        return count
+
     def finishJob(self, job):
+        """
+        Stores the finished job and its sweep in the job history, and sets the date its block is due again.
+        Waits for the job's result batches to be written first. If one of them failed, the job is given back instead,
+        to be picked up again before the lost results, and False is returned. So it is when the job is not leased to
+        its worker anymore (the lease ran out and someone else got it).
+        """
         log.info("Updating job %s for finish...", repr(job))
+        start = time.monotonic()
+        with self._batchcond:
+            self._batchcond.wait_for(lambda: not self._batches[job.id])
+            lostfrom = self._lostfrom.get(job.id)
+        if lostfrom is not None:
+            log.warning("Results of %s from %s were lost, giving it back", repr(job), handy.intToIp(lostfrom))
+            self._releaseLease(job)
+            return False
         session = JobdbSession()
+        (olddigest, churn, owner) = session.query(Job.digest, Job.churn, Job.lease_owner).filter(Job.id == job.id).one()
+        if owner != job.lease_owner:
+            log.warning("%s is leased to %s, not to %s, not finishing it", repr(job), owner, job.lease_owner)
+            session.close()
+            return False
+        job.lease_owner = job.lease_expires = job.checkpoint = None
+        job.changed_count = resweep.changedSlices(olddigest, job.digest)
+        job.churn = resweep.updateChurn(churn, job.changed_count, len(job.digest or b"") // 4)
+        job.due = resweep.nextDue(job, self._resweep_min, self._resweep_max) if job.completed else None
         session.merge(job)
+        session.add(JobHistory(job_id=job.id, completed=job.completed, ptr_count=job.ptr_count, nxdomain_count=job.nxdomain_count,
+                               error_count=job.error_count, changed_count=job.changed_count))
         session.commit()
+        JOBS_FINISHED.inc()
+        JOB_FINISH_SECONDS.observe(time.monotonic() - start)
         log.info("Job updated!")
         return True
 
@@ -120,6 +452,8 @@ class C2Server(object):
         if delete_if_exists:
             ResultBase.metadata.drop_all(db, checkfirst=True)
         ResultBase.metadata.create_all(db, checkfirst=True)
+        _addMissingColumns(db, ResultBase.metadata)
+        _addMissingIndexes(db, ResultBase.metadata)
         log.info("Database initialized")
         return db
     
@@ -131,76 +465,84 @@ class C2Server(object):
         if delete_if_exists:
             Base.metadata.drop_all(db, checkfirst=True)
         Base.metadata.create_all(db, checkfirst=True)
+        _addMissingColumns(db, Base.metadata)
+        _addMissingIndexes(db, Base.metadata)
+        _backfillDue(db)
         log.info("Database initialized")
         
         session = JobdbSession()
-        numjobs = session.query(Job).filter(Job.started == None).count()
-        if not numjobs:
-            log.info("No more open jobs in jobs db") 
+        # Only a new (or regenerated) jobs db is filled. Once it is, completed jobs are swept again when they are due.
+        # Whether there is any, not how many: that would be a scan of millions of rows before the server can start
+        if session.execute(select(Job.id).limit(1)).first() is None:
+            log.info("No jobs in jobs db") 
             self._fillJobsDb(session)
             session.commit()
         else:
-            log.info("%d open jobs left", numjobs)
+            log.info("Jobs db has jobs")
         session.close()
         return db
     
     def _fillJobsDb(self,session):
         log.info("Filling jobs db...")
-        commit_size = 2*16
+        commit_size = 2**14
         count = 0
+        blocks = self._IPv4spaceToBlocks()
         try:
-            for (ipstart, ipend) in self._IPv4spaceToBlocks():
-                session.add(Job(ipfrom=ipstart, ipto=ipend))
-                count += 1
-                if not count % commit_size:
-                    log.debug("Committing jobs to db...")
-                    session.commit()
-                    log.debug("Jobs commited!")
-            log.info("Done filling jobs db")
+            while True:
+                chunk = [{"ipfrom":ipstart, "ipto":ipend} for (ipstart, ipend) in itertools.islice(blocks, commit_size)]
+                if not chunk:
+                    break
+                session.execute(Job.__table__.insert(), chunk)
+                count += len(chunk)
+                log.debug("%d jobs added", count)
+            session.commit()
+            log.info("Done filling jobs db: %d jobs", count)
         except:
             log.error("Exception occured, rolling back")
             session.rollback()
             raise
         return 
+    
+    def _exclusions(self):
+        """
+        Sorted, merged (start, end) ranges that never become jobs. Configurable as a comma separated list of CIDRs
+        in the exclude setting, the IANA special purpose and bogon ranges by default.
+        """
+        cidrs = self.config.get("exclude")
+        cidrs = [c.strip() for c in cidrs.split(",") if c.strip()] if cidrs is not None else bogons
+        merged = []
+        for (start, end) in sorted(handy.cidrToRange(cidr) for cidr in cidrs):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
            
     def _IPv4spaceToBlocks(self):
         """
-        24-bit block    10.0.0.0 - 10.255.255.255    16,777,216    single class A network    10.0.0.0/8 (255.0.0.0)    24 bits    8 bits
-        20-bit block    172.16.0.0 - 172.31.255.255    1,048,576    16 contiguous class B networks    172.16.0.0/12 (255.240.0.0)    20 bits    12 bits
-        16-bit block    192.168.0.0 - 192.168.255.255    65,536    256 contiguous class C networks    192.168.0.0/16 (255.255.0.0)    16 bits    16 bits
-        
-        Perhaps make this a generator function? So we don't need store the blocks in memory?
+        Generates the (ipfrom, ipto) jobs of block_size addresses between start_ip and end_ip, aligned on start_ip.
+        Addresses in excluded ranges are cut out, so a block overlapping one yields the parts around it (or nothing).
         """
         start = handy.ipToInt(self.config["start_ip"])
         end = handy.ipToInt(self.config["end_ip"])
         blocksize = int(self.config["block_size"])
         log.info("Converting IPv4 space from %s to %s into blocks of %d addresses", handy.intToIp(start), handy.intToIp(end-1), blocksize)
-        private_ranges = [range(handy.ipToInt("10.0.0.0"), handy.ipToInt("10.0.0.0") + 16777216),
-                          range(handy.ipToInt("172.16.0.0"), handy.ipToInt("172.16.0.0") + 1048576),
-                          range(handy.ipToInt("192.168.0.0"), handy.ipToInt("192.168.0.0") + 65536)]
+        exclusions = self._exclusions()
+        log.info("Excluding %d ranges", len(exclusions))
         
-        blocks = []
-        for i in range(start, end, blocksize):
-            inforbidden = False    
-            for prange in private_ranges:
-                if i in prange and i + blocksize -1 in prange:
-                    log.debug("range %s to %s completely in private range", handy.intToIp(i), handy.intToIp(i + blocksize))
-                    inforbidden=True
-                    break
-                elif i in prange and i + blocksize -1 not in prange:
-                    log.debug("range %s to %s partly in private range", handy.intToIp(i), handy.intToIp(i + blocksize))
-                    blocks.append((prange[-1] + 1, i + blocksize))
-                    inforbidden=True
-                    break
-                elif i not in prange and i + blocksize - 1 in prange:
-                    log.debug("range %s to %s partly in private range", handy.intToIp(i), handy.intToIp(i + blocksize))
-                    blocks.append((i, prange[0]))
-                    inforbidden=True
-                    break
-            
-            if not inforbidden:
-                blocks.append((i, i + blocksize))
-        log.info("Done: %d blocks", len(blocks))
-        return blocks  
-
-
+        count = 0
+        allowed_start = start
+        # Walk the allowed stretches in between exclusions and chop them up at block boundaries
+        for (exstart, exend) in exclusions + [(end, end)]:
+            allowed_end = min(exstart, end)
+            i = allowed_start
+            while i < allowed_end:
+                blockend = min(start + ((i - start) // blocksize + 1) * blocksize, allowed_end)
+                yield (i, blockend)
+                count += 1
+                i = blockend
+            allowed_start = max(allowed_start, exend)
+            if allowed_start >= end:
+                break
+        log.info("Done: %d blocks", count)
+        return
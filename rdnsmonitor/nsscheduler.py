@@ -0,0 +1,228 @@
+"""
+Picking the nameserver for the next query.
+
+Every nameserver keeps an EWMA of its latency and of its success rate. Queries are spread over all healthy servers,
+weighted by success rate over latency, so fast and reliable resolvers do most of the work without the others being
+dropped altogether. A server that keeps failing (a streak of comm errors, or a success rate that sinks too low) is
+benched for a cool-down, which doubles every time it gets benched again, and then comes back with a clean slate.
+The last healthy one of the servers the scheduler was made with is never benched: when they all fail, the fault is
+more likely ours (a congested link, an overloaded worker) than theirs, and benching them all would stop the work.
+Optionally every server is held to max_qps queries per second by this scheduler, and a RateLimiter (see ratelimit)
+shared with other workers gets a say in every pick and hears about every outcome.
+
+Servers can also be learned on the way (the authoritative servers of a zone, see delegation): acquire() among a
+list of servers adds the ones it does not know yet. Of those, the MAX_LEARNED most recently used are kept; the state of
+the others is dropped, in the limiter too, and forget (if given) is called with them so their owner can let go of theirs.
+
+Every server also gets its own query timeout, computed from the round trip times of its answers like TCP does
+(SRTT + K * RTTVAR, RFC 6298, but at least twice SRTT), so a dead address does not cost the full timeout on a fast
+server. Those come in through measured(), from the transport, so they leave out whatever kept the worker from sending
+or reading in time.
+"""
+import collections
+import logging
+import random
+import time
+
+log = logging.getLogger(__name__)
+
+class _ServerState(object):
+
+    def __init__(self, cooldown):
+        self.cooldown = cooldown
+        self.cooldown_until = 0
+        self.reset()
+        return
+
+    def reset(self):
+        self.latency = NameserverScheduler.INITIAL_LATENCY
+        self.success = 1.0
+        self.samples = 0
+        self.commerrs = 0
+        self.window_start = 0
+        self.window_count = 0
+        self.srtt = None
+        self.rttvar = None
+        return
+
+    def __repr__(self):
+        return "<ns(latency={:.3f}s, srtt={}, success={:.2f}, samples={:d}{})>".format(self.latency,
+                                                                                     "{:.3f}s".format(self.srtt) if self.srtt is not None else "-",
+                                                                                     self.success, self.samples,
+                                                                                     ", benched" if self.cooldown_until else "")
+
+
+class NameserverScheduler(object):
+    ALPHA = 0.05
+    INITIAL_LATENCY = 0.1
+    MIN_SUCCESS = 0.5
+    MIN_SAMPLES = 20
+    COMMERR_TRESH = 10
+    COOLDOWN = 60
+    MAX_COOLDOWN = 3600
+    RTT_ALPHA = 0.125
+    RTT_BETA = 0.25
+    RTT_K = 4
+    MIN_TIMEOUT = 0.2
+    MAX_TIMEOUT = 3
+    MAX_LEARNED = 4096
+
+    # How much an outcome counts as a success
+    SCORES = {"TIMEOUT":0.0, "ERROR":0.0, "SERVFAIL":0.5}
+
+    def __init__(self, nameservers, max_qps=None, commerr_tresh=COMMERR_TRESH, max_timeout=MAX_TIMEOUT, limiter=None, forget=None):
+        self.max_qps = max_qps
+        self.limiter = limiter
+        self.max_timeout = max_timeout
+        self.commerr_tresh = commerr_tresh
+        self.forget = forget
+        self._servers = {ns:_ServerState(NameserverScheduler.COOLDOWN) for ns in nameservers}
+        # Learned servers, least recently used first
+        self._learned = collections.OrderedDict()
+        return
+
+    def _state(self, ns):
+        state = self._servers.get(ns)
+        if state is None:
+            state = self._servers[ns] = _ServerState(NameserverScheduler.COOLDOWN)
+            self._learned[ns] = True
+            while len(self._learned) > NameserverScheduler.MAX_LEARNED:
+                self._forget(self._learned.popitem(last=False)[0])
+        elif ns in self._learned:
+            self._learned.move_to_end(ns)
+        return state
+
+    def _forget(self, ns):
+        del self._servers[ns]
+        if self.limiter:
+            self.limiter.forget(ns)
+        if self.forget:
+            self.forget(ns)
+        return
+
+    def acquire(self, exclude=(), among=None):
+        """
+        Returns (nameserver, 0) for the server the next query should go to, or (None, wait) if all servers are benched
+        or at their rate limit, wait being the seconds until one is available again.
+        Servers in exclude are only picked when no other server is healthy. Servers the limiter holds back are skipped.
+        With among, only those servers are considered.
+        """
+        now = time.monotonic()
+        candidates = []
+        weights = []
+        wait = None
+        for ns in (among if among is not None else list(self._servers)):
+            state = self._state(ns)
+            if state.cooldown_until:
+                if state.cooldown_until > now:
+                    wait = min(wait, state.cooldown_until - now) if wait is not None else state.cooldown_until - now
+                    continue
+                log.info("Reinstating nameserver %s after its cool-down", ns)
+                state.cooldown_until = 0
+                state.reset()
+            if self.max_qps:
+                if now - state.window_start >= 1:
+                    state.window_start = now
+                    state.window_count = 0
+                if state.window_count >= self.max_qps:
+                    wait = min(wait, state.window_start + 1 - now) if wait is not None else state.window_start + 1 - now
+                    continue
+            if ns in exclude:
+                continue
+            candidates.append(ns)
+            weights.append(state.success / max(state.latency, 0.001) + 1e-6)
+        if not candidates and exclude:
+            # Rather an excluded server now than waiting for a benched one to come back
+            (ns, excludedwait) = self.acquire(among=among)
+            if ns:
+                return (ns, 0)
+            wait = min(wait, excludedwait) if wait is not None else excludedwait
+        while candidates:
+            i = random.choices(range(len(candidates)), weights)[0]
+            ns = candidates[i]
+            held = self.limiter.acquire(ns, learned=ns in self._learned) if self.limiter else 0
+            if not held:
+                self._servers[ns].window_count += 1
+                return (ns, 0)
+            wait = min(wait, held) if wait is not None else held
+            del candidates[i]
+            del weights[i]
+        return (None, max(wait, 0.001))
+
+    def report(self, ns, duration, data):
+        """
+        Books the outcome of a query: its duration in seconds and what got stored for it (a PTR, NXDOMAIN, TIMEOUT, ...).
+        """
+        state = self._state(ns)
+        if self.limiter:
+            self.limiter.report(ns, data, learned=ns in self._learned)
+        alpha = NameserverScheduler.ALPHA
+        score = NameserverScheduler.SCORES.get(data, 1.0)
+        state.samples += 1
+        state.success += alpha * (score - state.success)
+        # A timeout costs its full duration, which is what makes slow servers lose weight
+        state.latency += alpha * (duration - state.latency)
+        state.commerrs = state.commerrs + 1 if data == "ERROR" else 0
+        if state.cooldown_until:
+            return
+        if state.commerrs > self.commerr_tresh:
+            self._bench(ns, state, "comm error count exceeded threshold")
+        elif state.samples >= NameserverScheduler.MIN_SAMPLES:
+            if state.success < NameserverScheduler.MIN_SUCCESS:
+                self._bench(ns, state, "success rate too low")
+            elif state.success > 0.9 and state.cooldown > NameserverScheduler.COOLDOWN:
+                state.cooldown = NameserverScheduler.COOLDOWN
+        return
+
+    def measured(self, ns, rtt):
+        """
+        Books the round trip time of a reply from ns, from sending the query to receiving the reply. Only replies
+        tell the round trip time, like Karn's algorithm.
+        """
+        state = self._state(ns)
+        if state.srtt is None:
+            state.srtt = rtt
+            state.rttvar = rtt / 2
+        else:
+            state.rttvar += NameserverScheduler.RTT_BETA * (abs(state.srtt - rtt) - state.rttvar)
+            state.srtt += NameserverScheduler.RTT_ALPHA * (rtt - state.srtt)
+        return
+
+    def _bench(self, ns, state, reason):
+        if ns not in self._learned and not any(other != ns and other not in self._learned and not self._benched(other_state)
+                                               for (other, other_state) in self._servers.items()):
+            log.info("Not benching nameserver %s, the last healthy one: %s. stats: %s", ns, reason, repr(state))
+            # Judged again on the next MIN_SAMPLES outcomes
+            state.samples = 0
+            state.commerrs = 0
+            state.success = 1.0
+            return
+        log.warning("Benching nameserver %s for %ds: %s. stats: %s", ns, state.cooldown, reason, repr(state))
+        state.cooldown_until = time.monotonic() + state.cooldown
+        state.cooldown = min(state.cooldown * 2, NameserverScheduler.MAX_COOLDOWN)
+        return
+
+    def _benched(self, state):
+        return state.cooldown_until > time.monotonic()
+
+    def timeout(self, ns):
+        """
+        The number of seconds to wait for an answer from ns: SRTT + max(K * RTTVAR, SRTT), clamped to
+        [MIN_TIMEOUT, max_timeout].
+        Servers that have not answered anything yet get max_timeout.
+        """
+        state = self._state(ns)
+        if state.srtt is None:
+            return self.max_timeout
+        # RTTVAR all but vanishes when round trips are steady, and then any hiccup is a timeout: wait at least 2 * SRTT
+        rto = state.srtt + max(NameserverScheduler.RTT_K * state.rttvar, state.srtt)
+        return min(max(rto, NameserverScheduler.MIN_TIMEOUT), self.max_timeout)
+
+    def healthy(self):
+        return [ns for (ns, state) in self._servers.items() if not state.cooldown_until]
+
+    def summary(self, learned=True):
+        """
+        The state of every server, or without learned, of the ones it was made with.
+        """
+        return {ns:repr(state) for (ns, state) in self._servers.items() if learned or ns not in self._learned}
@@ -0,0 +1,200 @@
+"""
+Running workers in several processes, to get past the GIL.
+
+Every worker thread in a child process gets its own pipe to the parent. In the parent a thread per pipe makes the
+worker's calls on the C2Server and sends back what they return, or the exception they raised, which the child raises
+in turn. When the result writer is behind, storing a batch blocks in the parent, which throttles the worker just like
+in-process. Jobs cross the pipe as dicts.
+
+A child process stops its workers gracefully on SIGTERM (which is what stop() sends) or SIGINT: they send the batch they
+are on with its checkpoint and give their job back.
+
+With a C2 url the children run remote workers instead and no pipes are needed.
+
+Metrics are per process: with a metrics address every child serves its own on the port after the parent's, plus its
+index.
+"""
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import threading
+
+from rdnsmonitor import nameservers
+from rdnsmonitor import metrics
+from rdnsmonitor import remote
+from rdnsmonitor import work
+
+log = logging.getLogger(__name__)
+
+LOG_FORMAT = "%(processName)s|%(threadName)s|%(levelname)s|%(module)s|%(message)s"
+
+def availableCpus():
+    """
+    The cores this process may run on, which is what the process count should be pinned to.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+class _PipeC2Proxy(object):
+    """
+    Stands in for the C2Server inside a child process.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+        return
+
+    def _call(self, method, *args):
+        self._conn.send((method, args))
+        reply = self._conn.recv()
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    def retrieveNewJob(self, owner=None, timeout=None):
+        data = self._call("retrieveNewJob", owner, timeout)
+        return remote.dictToJob(data) if data else None
+
+    def storeResults(self, results, job=None, checkpoint=None):
+        return self._call("storeResults", results, remote.jobToDict(job) if job is not None else None, checkpoint)
+
+    def releaseJob(self, job):
+        return self._call("releaseJob", remote.jobToDict(job))
+
+    def renewLease(self, job):
+        return self._call("renewLease", remote.jobToDict(job))
+
+    def finishJob(self, job):
+        return self._call("finishJob", remote.jobToDict(job))
+
+
+def _serve(c2server, conn):
+    while True:
+        try:
+            (method, args) = conn.recv()
+        except (EOFError, OSError):
+            break
+        try:
+            if method == "storeResults":
+                (results, job, checkpoint) = args
+                reply = c2server.storeResults(results, job=remote.dictToJob(job) if job else None, checkpoint=checkpoint)
+            elif method == "retrieveNewJob":
+                job = c2server.retrieveNewJob(*args)
+                reply = remote.jobToDict(job) if job is not None else None
+            elif method == "renewLease":
+                reply = c2server.renewLease(remote.dictToJob(args[0]))
+            elif method == "finishJob":
+                reply = c2server.finishJob(remote.dictToJob(args[0]))
+            elif method == "releaseJob":
+                reply = c2server.releaseJob(remote.dictToJob(args[0]))
+            else:
+                reply = ValueError("Unknown call {}".format(method))
+        except Exception as ex:
+            log.error("Error handling %s from worker process: %s", method, repr(ex))
+            reply = ex
+        try:
+            conn.send(reply)
+        except (EOFError, OSError):
+            break
+    conn.close()
+    return
+
+def _processMain(index, conns, numworkers, nservers, workerkwargs, c2url, api_token, loglevel, cpu, metrics_address, summary_interval):
+    logging.basicConfig(format=LOG_FORMAT, level=loglevel)
+    if cpu is not None:
+        os.sched_setaffinity(0, {cpu})
+        log.info("Pinned to cpu %d", cpu)
+    if metrics_address:
+        metrics.MetricsServer(metrics_address[0], metrics_address[1] + index + 1).start()
+    if summary_interval:
+        metrics.Summary(interval=summary_interval).start()
+    asyncmode = "window" in workerkwargs
+    workers = []
+    for i in range(numworkers):
+        random.shuffle(nservers)
+        kwargs = dict(workerkwargs, name="P{:d}Worker{:d}".format(index + 1, i + 1), nameservers=nservers)
+        if c2url:
+            workerclass = remote.AsyncRemoteWorker if asyncmode else remote.RemoteWorker
+            workers.append(workerclass(c2url, api_token=api_token, **kwargs))
+        else:
+            workerclass = work.AsyncLocalWorker if asyncmode else work.LocalWorker
+            workers.append(workerclass(_PipeC2Proxy(conns[i]), **kwargs))
+    
+    def stop(signum, frame):
+        log.info("Stopping workers...")
+        for worker in workers:
+            worker.stop()
+    
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return
+
+
+class ProcessPool(object):
+    """
+    processes child processes running workers_per_process workers each, on the nameservers given (by default
+    rdnsmonitor.nameservers). workerkwargs are passed on to the workers; a window in there makes them asynchronous
+    workers. Either c2server (this process serves them) or c2url (they are remote workers) has to be given.
+    With pin_cpus every process gets a core of its own. With metrics_address (host, port) the processes serve their
+    metrics on the ports after port, and with summary_interval they log a metrics summary that often.
+    """
+
+    def __init__(self, processes, workers_per_process=1, nameservers=nameservers, workerkwargs=None, c2server=None, c2url=None, api_token=None, pin_cpus=False,
+                 metrics_address=None, summary_interval=None):
+        self.processes = processes
+        self.workers_per_process = workers_per_process
+        self.nameservers = list(nameservers)
+        self.workerkwargs = dict(workerkwargs or {})
+        self._c2server = c2server
+        self._c2url = c2url
+        self._api_token = api_token
+        self._cpus = availableCpus() if pin_cpus else None
+        self._metrics_address = metrics_address
+        self._summary_interval = summary_interval
+        # Fork would copy the server's threads' locks in whatever state they are in
+        self._context = multiprocessing.get_context("spawn")
+        self._procs = []
+        self._servers = []
+        return
+
+    def start(self):
+        log.info("Starting %d worker processes with %d workers each...", self.processes, self.workers_per_process)
+        for p in range(self.processes):
+            childconns = []
+            if not self._c2url:
+                for i in range(self.workers_per_process):
+                    (parentconn, childconn) = self._context.Pipe()
+                    childconns.append(childconn)
+                    server = threading.Thread(target=_serve, args=(self._c2server, parentconn), name="Pipe{:d}.{:d}".format(p + 1, i + 1), daemon=True)
+                    server.start()
+                    self._servers.append(server)
+            cpu = self._cpus[p % len(self._cpus)] if self._cpus else None
+            proc = self._context.Process(target=_processMain, name="WorkerProcess{:d}".format(p + 1),
+                                         args=(p, childconns, self.workers_per_process, self.nameservers, self.workerkwargs, self._c2url,
+                                               self._api_token, logging.getLogger().level, cpu, self._metrics_address, self._summary_interval))
+            proc.start()
+            for conn in childconns:
+                conn.close()
+            self._procs.append(proc)
+        log.info("Worker processes started!")
+        return
+
+    def join(self):
+        for proc in self._procs:
+            proc.join()
+        return
+
+    def stop(self):
+        for proc in self._procs:
+            if proc.is_alive():
+                proc.terminate()
+        self.join()
+        return
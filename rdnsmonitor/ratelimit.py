@@ -0,0 +1,223 @@
+"""
+Keeping all workers together under a query rate, so resolvers do not throttle or block us.
+
+RateLimiter holds a token bucket for all queries (qps) and one per nameserver (ns_qps), each refilling at its rate and
+holding at most burst tokens. A query takes a token from its nameserver's bucket and from the global one. Workers share
+one limiter: threads through the same object, worker processes through buckets in shared memory (shared=True, create it
+before the processes and hand it to them when they start). Remote workers on other hosts have limiters of their own.
+
+When the share of timeouts and comm errors of a bucket rises above backoff_errors, its rate is halved (at most once per
+BACKOFF_INTERVAL) down to MIN_FACTOR of the configured rate, and it creeps back up while queries succeed again.
+A bucket without a rate (None) does not limit, and so does not back off either.
+
+The metrics label the buckets of learned nameservers (the authoritative servers of the zones, see delegation) all
+AUTHORITATIVE, like the workers' metrics do: there are far too many of them to give each a series of its own.
+"""
+import logging
+import multiprocessing
+import threading
+import time
+
+from rdnsmonitor import metrics
+
+log = logging.getLogger(__name__)
+
+BACKOFFS = metrics.REGISTRY.counter("rdns_ratelimit_backoffs_total", "Rate limits halved because of errors, by nameserver (or all)", ("bucket",))
+WAITS = metrics.REGISTRY.counter("rdns_ratelimit_waits_total", "Queries held back by the rate limiter, by nameserver (or all)", ("bucket",))
+
+AUTHORITATIVE = "authoritative"
+
+# Outcomes that look like being throttled
+ERRORS = ("TIMEOUT", "ERROR")
+
+# Slots of a bucket's state
+_TOKENS, _STAMP, _FACTOR, _ERRORS, _CUT = range(5)
+
+
+class TokenBucket(object):
+    """
+    rate tokens per second, at most burst of them saved up. rate None means unlimited. state holds the bucket's
+    numbers and lock guards them; pass a multiprocessing.Array("d", 5) and its lock to share the bucket between processes.
+    label is what the metrics call it, name by default. now is the time.monotonic() it starts filling up at.
+    """
+    ALPHA = 0.02
+    BACKOFF_INTERVAL = 1.0
+    MIN_FACTOR = 1 / 64
+    RECOVER = 0.01
+
+    def __init__(self, name, rate, burst, backoff_errors, state=None, lock=None, label=None, now=None):
+        self.name = name
+        self.label = label or name
+        self.rate = rate
+        self.burst = burst
+        self.backoff_errors = backoff_errors
+        self._state = state if state is not None else [0.0] * 5
+        self._lock = lock if lock is not None else threading.Lock()
+        with self._lock:
+            if not self._state[_STAMP]:
+                self._state[_TOKENS] = burst
+                self._state[_STAMP] = now or time.monotonic()
+                self._state[_FACTOR] = 1.0
+        return
+
+    def take(self, now):
+        """
+        Takes a token and returns 0, or returns the seconds until there is one.
+        """
+        state = self._state
+        with self._lock:
+            if self.rate is None:
+                return 0
+            rate = self.rate * state[_FACTOR]
+            # Other processes may have stamped a later now than ours
+            tokens = min(state[_TOKENS] + max(now - state[_STAMP], 0) * rate, self.burst)
+            state[_STAMP] = max(now, state[_STAMP])
+            if tokens >= 1:
+                state[_TOKENS] = tokens - 1
+                return 0
+            state[_TOKENS] = tokens
+            return (1 - tokens) / rate
+
+    def giveBack(self):
+        with self._lock:
+            self._state[_TOKENS] = min(self._state[_TOKENS] + 1, self.burst)
+        return
+
+    def report(self, failed, now):
+        """
+        Books the outcome of a query. Halves the rate when errors pile up, restores it bit by bit when they do not.
+        """
+        if self.rate is None:
+            return
+        state = self._state
+        with self._lock:
+            state[_ERRORS] += TokenBucket.ALPHA * ((1.0 if failed else 0.0) - state[_ERRORS])
+            if state[_ERRORS] > self.backoff_errors:
+                if now - state[_CUT] < TokenBucket.BACKOFF_INTERVAL or state[_FACTOR] <= TokenBucket.MIN_FACTOR:
+                    return
+                state[_FACTOR] = max(state[_FACTOR] / 2, TokenBucket.MIN_FACTOR)
+                state[_CUT] = now
+                factor = state[_FACTOR]
+            else:
+                if state[_FACTOR] < 1 and state[_ERRORS] < self.backoff_errors / 2:
+                    state[_FACTOR] = min(state[_FACTOR] + TokenBucket.RECOVER * state[_FACTOR], 1.0)
+                return
+        log.warning("Backing off %s to %.1f%% of its rate: %.0f%% errors", self.name, factor * 100, state[_ERRORS] * 100)
+        BACKOFFS.inc(bucket=self.label)
+        return
+
+    def factor(self):
+        return self._state[_FACTOR]
+
+
+class RateLimiter(object):
+    """
+    Global and per nameserver token buckets. The per nameserver ones of the given nameservers are created up front (and
+    shared, with shared=True); others are created when first used and only live in the process that uses them.
+    clock is what tells the time, time.monotonic() unless a test steps it by hand; it stays in the process it was made in.
+    """
+    BACKOFF_ERRORS = 0.2
+    # Default burst, in seconds worth of tokens: short, so the limit is a steady rate rather than bursts
+    BURST_SECONDS = 0.1
+
+    def __init__(self, qps=None, ns_qps=None, burst=None, backoff_errors=BACKOFF_ERRORS, nameservers=(), shared=False, clock=time.monotonic):
+        self.qps = qps
+        self.clock = clock
+        self.ns_qps = ns_qps
+        self.burst = burst
+        self.backoff_errors = backoff_errors
+        self._shared = {}
+        if shared:
+            # Spawn, like the worker processes: the arrays' locks have to be made for the processes they go to
+            context = multiprocessing.get_context("spawn")
+            for name in ["all"] + list(nameservers):
+                self._shared[name] = context.Array("d", 5)
+        self._setup()
+        for ns in nameservers:
+            self._bucket(ns)
+        return
+
+    @staticmethod
+    def fromConfig(section, nameservers=(), shared=False):
+        """
+        A limiter from the qps, ns_qps, burst and backoff_errors settings of a config section, or None when the
+        section does not ask for any limit.
+        """
+        qps = section.getfloat("qps", fallback=None)
+        ns_qps = section.getfloat("ns_qps", fallback=None)
+        if not qps and not ns_qps:
+            return None
+        return RateLimiter(qps=qps or None, ns_qps=ns_qps or None, burst=section.getfloat("burst", fallback=None),
+                           backoff_errors=section.getfloat("backoff_errors", fallback=RateLimiter.BACKOFF_ERRORS),
+                           nameservers=nameservers, shared=shared)
+
+    def _setup(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._global = self._makeBucket("all", self.qps)
+        return
+
+    def _makeBucket(self, name, rate, label=None):
+        burst = self.burst or max(1.0, (rate or 0) * RateLimiter.BURST_SECONDS)
+        state = self._shared.get(name)
+        if state is None:
+            return TokenBucket(name, rate, burst, self.backoff_errors, label=label, now=self.clock())
+        return TokenBucket(name, rate, burst, self.backoff_errors, state=state, lock=state.get_lock(), label=label, now=self.clock())
+
+    def _bucket(self, ns, learned=False):
+        bucket = self._buckets.get(ns)
+        if bucket is None:
+            with self._lock:
+                bucket = self._buckets.setdefault(ns, self._makeBucket(ns, self.ns_qps, label=AUTHORITATIVE if learned else None))
+        return bucket
+
+    def forget(self, ns):
+        """
+        Drops the bucket of a nameserver that is not used anymore. The shared ones are kept, as other processes use them.
+        """
+        if ns not in self._shared:
+            with self._lock:
+                self._buckets.pop(ns, None)
+        return
+
+    def __getstate__(self):
+        # The buckets and locks are rebuilt around the shared state in the worker process
+        return {"qps":self.qps, "ns_qps":self.ns_qps, "burst":self.burst, "backoff_errors":self.backoff_errors, "_shared":self._shared}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.clock = time.monotonic
+        self._setup()
+        return
+
+    def acquire(self, ns, learned=False):
+        """
+        Takes a token for a query to ns from its bucket and the global one and returns 0, or returns the seconds to wait
+        before trying again. learned tells that ns is not one of the worker's own nameservers (see NameserverScheduler).
+        """
+        now = self.clock()
+        bucket = self._bucket(ns, learned)
+        wait = bucket.take(now)
+        if wait:
+            WAITS.inc(bucket=bucket.label)
+            return wait
+        wait = self._global.take(now)
+        if wait:
+            bucket.giveBack()
+            WAITS.inc(bucket="all")
+        return wait
+
+    def report(self, ns, data, learned=False):
+        now = self.clock()
+        failed = data in ERRORS
+        self._bucket(ns, learned).report(failed, now)
+        self._global.report(failed, now)
+        return
+
+    def summary(self):
+        """
+        The share of its rate every bucket is at: the global one, and the ones that are backed off.
+        """
+        with self._lock:
+            buckets = [(name, bucket) for (name, bucket) in self._buckets.items() if bucket.factor() < 1]
+        return {name:"{:.0%}".format(bucket.factor()) for (name, bucket) in [("all", self._global)] + buckets}
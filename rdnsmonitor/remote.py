@@ -0,0 +1,309 @@
+"""
+Running workers on other hosts than the C2 server.
+
+C2Api exposes a C2Server over HTTP:
+
+    POST /job/lease     {"owner":name}                  -> job, or 204 when none came up in time. Its lease_owner is
+                                                           a token of the lease, which the other calls have to bring
+    POST /job/finish    job                             -> {"ok":true}
+    POST /job/release   job                             -> {"released":bool}
+    POST /heartbeat     {"id":jobid, "lease_owner":..}  -> {"renewed":bool}
+    POST /results       encoded results, X-Job-Id and X-Lease-Owner headers -> {"stored":count, "renewed":bool}
+                        and optionally X-Checkpoint, the job's checkpoint once these results are stored. Nothing is
+                        stored when the job is not leased to X-Lease-Owner (anymore)
+
+Jobs travel as JSON. Results are zlib compressed: the number of results, the ip deltas as uint32 and the PTRs joined by newlines.
+Job blocks are contiguous, so the deltas are nearly all 1 and a batch of results compresses to little more than its PTRs.
+If the server has an api_token configured, requests must carry it in the X-Auth-Token header.
+
+C2Client talks to it, and RemoteWorker is a LocalWorker that uses a C2Client as its server.
+"""
+import base64
+import datetime
+import http.server
+import json
+import logging
+import struct
+import threading
+import time
+import urllib.error
+import urllib.request
+import zlib
+from array import array
+
+from rdnsmonitor.work import LocalWorker, AsyncLocalWorker
+
+log = logging.getLogger(__name__)
+
+LEASE_WAIT = 30
+JOB_FIELDS = ["id", "ipfrom", "ipto", "retrieved", "started", "completed", "nameserver",
+              "nxdomain_count", "error_count", "skipped_count", "lease_owner", "lease_expires", "ptr_count", "digest", "checkpoint"]
+DATE_FIELDS = ["retrieved", "started", "completed", "lease_expires"]
+BINARY_FIELDS = ["digest"]
+
+def jobToDict(job):
+    data = {field:getattr(job, field) for field in JOB_FIELDS}
+    for field in DATE_FIELDS:
+        if data[field] is not None:
+            data[field] = data[field].isoformat()
+    for field in BINARY_FIELDS:
+        if data[field] is not None:
+            data[field] = base64.b64encode(data[field]).decode("ascii")
+    return data
+
+def dictToJob(data):
+    data = {field:data.get(field) for field in JOB_FIELDS}
+    for field in DATE_FIELDS:
+        if data[field] is not None:
+            data[field] = datetime.datetime.fromisoformat(data[field])
+    for field in BINARY_FIELDS:
+        if data[field] is not None:
+            data[field] = base64.b64decode(data[field])
+    # Here rather than at the top: remote workers should not have to import SQLAlchemy before their first job
+    from rdnsmonitor.dbobjects import Job
+    return Job(**data)
+
+def encodeResults(results):
+    deltas = array("I")
+    previous = 0
+    for (ipint, ptr) in results:
+        deltas.append((ipint - previous) & 0xffffffff)
+        previous = ipint
+    if struct.pack("=I", 1) != struct.pack("!I", 1):
+        deltas.byteswap()
+    ptrs = "\n".join(ptr for (ipint, ptr) in results).encode("utf-8")
+    return zlib.compress(struct.pack("!I", len(results)) + deltas.tobytes() + ptrs)
+
+def decodeResults(data):
+    data = zlib.decompress(data)
+    (count,) = struct.unpack_from("!I", data)
+    deltas = array("I", data[4:4 + 4*count])
+    if struct.pack("=I", 1) != struct.pack("!I", 1):
+        deltas.byteswap()
+    ptrs = data[4 + 4*count:].decode("utf-8").split("\n") if count else []
+    if len(ptrs) != count:
+        raise ValueError("Got {:d} PTRs for {:d} addresses".format(len(ptrs), count))
+    results = []
+    ipint = 0
+    for (delta, ptr) in zip(deltas, ptrs):
+        ipint = (ipint + delta) & 0xffffffff
+        results.append((ipint, ptr))
+    return results
+
+
+class _ApiHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        api = self.server.api
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if api.token and self.headers.get("X-Auth-Token") != api.token:
+            return self._reply(403, {"error":"bad token"})
+        route = {"/job/lease":api.leaseJob,
+                 "/job/finish":api.finishJob,
+                 "/job/release":api.releaseJob,
+                 "/heartbeat":api.heartbeat,
+                 "/results":api.storeResults}.get(self.path)
+        if not route:
+            return self._reply(404, {"error":"no such endpoint"})
+        try:
+            (status, data) = route(self.headers, body)
+        except Exception as ex:
+            log.error("Error handling %s: %s", self.path, repr(ex))
+            return self._reply(500, {"error":str(ex)})
+        return self._reply(status, data)
+
+    def _reply(self, status, data):
+        body = json.dumps(data).encode() if data is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return
+
+    def log_message(self, format, *args):
+        log.debug("%s %s", self.address_string(), format % args)
+
+
+class C2Api(object):
+    """
+    Serves a C2Server to remote workers. start() runs the HTTP server in a background thread.
+    """
+
+    def __init__(self, c2server, host="0.0.0.0", port=8053, token=None):
+        self.c2server = c2server
+        self.token = token
+        self.workers = {}
+        self._httpd = http.server.ThreadingHTTPServer((host, port), _ApiHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.api = self
+        self.address = self._httpd.server_address
+        self._thread = None
+        return
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="C2Api", daemon=True)
+        self._thread.start()
+        log.info("C2 api listening on %s:%d", *self.address)
+        return
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        return
+
+    def _seen(self, owner):
+        # A lease_owner is the worker's name and the lease token
+        self.workers[owner.rpartition("/")[0] or owner] = datetime.datetime.now()
+        return
+
+    def leaseJob(self, headers, body):
+        owner = json.loads(body)["owner"]
+        self._seen(owner)
+        job = self.c2server.retrieveNewJob(owner=owner, timeout=LEASE_WAIT)
+        if job is None:
+            return (204, None)
+        return (200, jobToDict(job))
+
+    def finishJob(self, headers, body):
+        job = dictToJob(json.loads(body))
+        self._seen(job.lease_owner)
+        return (200, {"ok":self.c2server.finishJob(job)})
+
+    def releaseJob(self, headers, body):
+        job = dictToJob(json.loads(body))
+        self._seen(job.lease_owner)
+        return (200, {"released":self.c2server.releaseJob(job)})
+
+    def heartbeat(self, headers, body):
+        job = dictToJob(json.loads(body))
+        self._seen(job.lease_owner)
+        return (200, {"renewed":self.c2server.renewLease(job)})
+
+    def storeResults(self, headers, body):
+        from rdnsmonitor.dbobjects import Job
+        results = decodeResults(body)
+        job = Job(id=int(headers["X-Job-Id"]), lease_owner=headers["X-Lease-Owner"])
+        self._seen(job.lease_owner)
+        checkpoint = int(headers["X-Checkpoint"]) if headers.get("X-Checkpoint") else None
+        if not self.c2server.renewLease(job):
+            log.warning("Dropping %d results for job %d, it is not leased to %s", len(results), job.id, job.lease_owner)
+            return (200, {"stored":0, "renewed":False})
+        self.c2server.storeResults(results, job=job, checkpoint=checkpoint)
+        return (200, {"stored":len(results), "renewed":True})
+
+
+class C2Client(object):
+    """
+    The worker's side of C2Api. Offers the same calls a LocalWorker makes on a C2Server, plus uploadResults().
+    Calls are retried for a while when the server can not be reached.
+    """
+    RETRIES = 10
+    HTTP_TIMEOUT = LEASE_WAIT + 30
+
+    def __init__(self, url, token=None):
+        self.url = url.rstrip("/")
+        self.token = token
+        return
+
+    def _call(self, path, body, headers=None):
+        headers = dict(headers or {})
+        if self.token:
+            headers["X-Auth-Token"] = self.token
+        for attempt in range(C2Client.RETRIES):
+            request = urllib.request.Request(self.url + path, data=body, headers=headers, method="POST")
+            try:
+                with urllib.request.urlopen(request, timeout=C2Client.HTTP_TIMEOUT) as response:
+                    data = response.read()
+                    return (response.status, json.loads(data) if data else None)
+            except urllib.error.HTTPError as ex:
+                if ex.code < 500:
+                    raise
+                log.warning("C2 server error on %s: %s", path, str(ex))
+            except (urllib.error.URLError, OSError) as ex:
+                log.warning("Could not reach C2 server for %s: %s", path, str(ex))
+            time.sleep(min(2**attempt, 60))
+        raise ConnectionError("Giving up on C2 server {} for {}".format(self.url, path))
+
+    def _callJson(self, path, data):
+        return self._call(path, json.dumps(data).encode(), {"Content-Type":"application/json"})
+
+    def retrieveNewJob(self, owner=None, timeout=None):
+        """
+        Asks for a job until one comes up, or with a timeout, only once (the server waits up to LEASE_WAIT seconds).
+        """
+        while True:
+            (status, data) = self._callJson("/job/lease", {"owner":owner})
+            if status == 200:
+                return dictToJob(data)
+            if timeout is not None:
+                return None
+            log.info("No job available yet, asking again")
+
+    def uploadResults(self, job, results, checkpoint=None):
+        headers = {"Content-Type":"application/octet-stream",
+                   "X-Job-Id":str(job.id),
+                   "X-Lease-Owner":job.lease_owner}
+        if checkpoint is not None:
+            headers["X-Checkpoint"] = str(checkpoint)
+        (status, data) = self._call("/results", encodeResults(results), headers)
+        return data["renewed"]
+
+    def releaseJob(self, job):
+        return self._callJson("/job/release", jobToDict(job))[1]["released"]
+
+    def renewLease(self, job):
+        return self._callJson("/heartbeat", jobToDict(job))[1]["renewed"]
+
+    def finishJob(self, job):
+        return self._callJson("/job/finish", jobToDict(job))[1]["ok"]
+
+
+class RemoteWorker(LocalWorker):
+    """
+    Worker that gets its jobs from, and sends its results to, a C2Api at c2url.
+    Result batches go up in one compressed request which also renews the job's lease. In between, a heartbeat renews it
+    every HEARTBEAT_INTERVAL seconds.
+    """
+    HEARTBEAT_INTERVAL = 60
+
+    def __init__(self, c2url, api_token=None, **kwargs):
+        super().__init__(C2Client(c2url, api_token), **kwargs)
+        self._heartbeat = threading.Thread(target=self._beat, name=self.name + "-heartbeat", daemon=True)
+        return
+
+    def run(self):
+        self._heartbeat.start()
+        super().run()
+
+    def _beat(self):
+        while self.is_alive():
+            time.sleep(RemoteWorker.HEARTBEAT_INTERVAL)
+            job = self.current_job
+            if job is not None:
+                try:
+                    self._c2server.renewLease(job)
+                except Exception as ex:
+                    log.warning("Heartbeat failed: %s", repr(ex))
+        return
+
+    def _sendResults(self, results, checkpoint=None):
+        log.info("Uploading %d results to server... jobstats:%s", len(results), repr(self.jobstats))
+        if not self._c2server.uploadResults(self.current_job, results, checkpoint=checkpoint):
+            log.warning("Lease on %s was lost", repr(self.current_job))
+        log.info("Results sent!")
+        return True
+
+    def __repr__(self):
+        return "<RemoteWorker(c2={}, nameserver={}, name={}, use_tcp={:b})".format(self._c2server.url, self.cur_nameserver, self.name, self.use_tcp)
+
+
+class AsyncRemoteWorker(RemoteWorker, AsyncLocalWorker):
+    """
+    RemoteWorker that resolves like an AsyncLocalWorker.
+    """
+
+    def __repr__(self):
+        return "<AsyncRemoteWorker(c2={}, window={}, name={}, use_tcp={:b})".format(self._c2server.url, self.window, self.name, self.use_tcp)
@@ -0,0 +1,50 @@
+"""
+When to sweep a job's block again.
+
+Once every job has been done, blocks are not simply rescanned in the order they were finished. Every finished job
+gets a due date: completed plus an interval that shrinks with how much the block changed (churn) and how many of its
+addresses have a PTR (density). Dense and volatile blocks come round every min_interval, dead space only every
+max_interval.
+
+Churn is measured per /24: the worker sends a digest of its results per /24 (see work.JobDigest), which is compared
+to the one of the previous sweep. It is kept as an EWMA over the sweeps of the block.
+"""
+import datetime
+from array import array
+
+MIN_INTERVAL = datetime.timedelta(days=1)
+MAX_INTERVAL = datetime.timedelta(days=30)
+CHURN_ALPHA = 0.5
+CHURN_WEIGHT = 20
+DENSITY_WEIGHT = 10
+
+def changedSlices(olddigest, newdigest):
+    """
+    The number of /24s whose digest differs, or None if there is nothing (comparable) to compare with.
+    """
+    if not olddigest or not newdigest or len(olddigest) != len(newdigest):
+        return None
+    old = array("I", olddigest)
+    new = array("I", newdigest)
+    return sum(1 for (a, b) in zip(old, new) if a != b)
+
+def updateChurn(churn, changed, slices):
+    """
+    Folds the fraction of changed /24s of the last sweep into the EWMA churn.
+    """
+    if changed is None or not slices:
+        return churn
+    fraction = changed / slices
+    if churn is None:
+        return fraction
+    return churn + CHURN_ALPHA * (fraction - churn)
+
+def nextDue(job, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL):
+    """
+    The date job's block should be swept again, going by its churn, ptr_count and completed.
+    """
+    size = max(job.ipto - job.ipfrom, 1)
+    density = (job.ptr_count or 0) / size
+    churn = job.churn or 0.0
+    interval = max_interval / (1 + CHURN_WEIGHT * churn + DENSITY_WEIGHT * density)
+    return job.completed + max(interval, min_interval)
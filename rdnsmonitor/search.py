@@ -0,0 +1,116 @@
+"""
+Searching PTRs: which addresses have a PTR under some domain, or with some text in it.
+
+PTRIndex is an SQLite file built from a packed snapshot (see export). It has two indexes over the PTRs, ignoring
+addresses without one:
+
+    rnames      the PTR with its labels reversed ("host.example.net." -> "net.example.host."), clustered on that.
+                Everything under a domain is one contiguous range of it, so suffix searches are a range scan.
+    trigrams    an FTS5 trigram index of the PTRs, keyed by ip, for searches on any 3 or more characters in them.
+                Shorter texts (or an index built without trigrams) fall back to scanning rnames.
+
+Searches return (ipfrom, ipto) ranges, ipto exclusive, with consecutive addresses joined.
+"""
+import logging
+import sqlite3
+
+from rdnsmonitor import export
+from rdnsmonitor.dbobjects import STATUSES
+
+log = logging.getLogger(__name__)
+
+INSERT_BATCH = 100000
+
+def reverseName(name):
+    """
+    "Host.Example.net." -> "net.example.host."
+    """
+    labels = name.lower().rstrip(".").split(".")
+    return ".".join(reversed(labels)) + "."
+
+def toRanges(ips):
+    """
+    Joins ascending ips into (ipfrom, ipto) ranges of consecutive addresses.
+    """
+    ranges = []
+    for ip in ips:
+        if ranges and ranges[-1][1] == ip:
+            ranges[-1][1] = ip + 1
+        elif not ranges or ranges[-1][1] < ip:
+            ranges.append([ip, ip + 1])
+    return [tuple(r) for r in ranges]
+
+
+class PTRIndex(object):
+    """
+    Search index over the PTRs of a snapshot, in the SQLite file at path. Build it with build().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path)
+        # Reversing is its own inverse, so this turns an rname back into the PTR
+        self._db.create_function("ptrname", 1, reverseName, deterministic=True)
+        return
+
+    def build(self, snapshot_path, trigrams=True):
+        """
+        (Re)builds the index from the packed snapshot at snapshot_path. The trigram index takes several times the space
+        of the rnames one; without it, contains() scans.
+        """
+        db = self._db
+        db.execute("DROP TABLE IF EXISTS rnames")
+        db.execute("DROP TABLE IF EXISTS trigrams")
+        db.execute("CREATE TABLE rnames (rname TEXT NOT NULL, ip INTEGER NOT NULL, PRIMARY KEY (rname, ip)) WITHOUT ROWID")
+        if trigrams:
+            db.execute("CREATE VIRTUAL TABLE trigrams USING fts5(ptr, tokenize='trigram', content='')")
+        count = 0
+        batch = []
+        with export.Snapshot(snapshot_path) as snapshot:
+            for (ip, result) in snapshot:
+                if result in STATUSES:
+                    continue
+                batch.append((ip, result))
+                if len(batch) >= INSERT_BATCH:
+                    count += self._insert(batch, trigrams)
+                    batch = []
+            count += self._insert(batch, trigrams)
+        if trigrams:
+            db.execute("INSERT INTO trigrams(trigrams) VALUES ('optimize')")
+        db.commit()
+        log.info("Indexed %d PTRs from %s", count, snapshot_path)
+        return count
+
+    def _insert(self, batch, trigrams):
+        self._db.executemany("INSERT OR REPLACE INTO rnames (rname, ip) VALUES (?, ?)", [(reverseName(ptr), ip) for (ip, ptr) in batch])
+        if trigrams:
+            self._db.executemany("INSERT INTO trigrams (rowid, ptr) VALUES (?, ?)", [(ip, ptr.lower()) for (ip, ptr) in batch])
+        return len(batch)
+
+    def _hasTrigrams(self):
+        return self._db.execute("SELECT 1 FROM sqlite_master WHERE name = 'trigrams'").fetchone() is not None
+
+    def suffix(self, domain):
+        """
+        Ranges of the addresses with a PTR that is domain or under it.
+        """
+        rname = reverseName(domain)
+        # Everything under the domain sorts between "<rname>" and "<rname minus its dot>/", '/' following '.'
+        rows = self._db.execute("SELECT ip FROM rnames WHERE rname = ? OR (rname > ? AND rname < ?)",
+                                (rname, rname, rname[:-1] + "/"))
+        return toRanges(sorted(ip for (ip,) in rows))
+
+    def contains(self, text):
+        """
+        Ranges of the addresses with a PTR that has text in it.
+        """
+        text = text.lower()
+        if len(text) >= 3 and self._hasTrigrams():
+            rows = self._db.execute("SELECT rowid FROM trigrams WHERE trigrams MATCH ? ORDER BY rowid", ('"' + text.replace('"', '""') + '"',))
+            return toRanges(ip for (ip,) in rows)
+        rows = self._db.execute("SELECT ip FROM rnames WHERE instr(ptrname(rname), ?) > 0", (text,))
+        return toRanges(sorted(ip for (ip,) in rows))
+
+    def close(self):
+        self._db.close()
+        return
@@ -0,0 +1,456 @@
+"""
+Writing results to the results db.
+
+Only PTRs are stored per address, in ptrrecords. Contiguous runs of addresses with the same status (NXDOMAIN, TIMEOUT,
+ERROR, SERVFAIL) are stored as one (ipfrom, ipto, status) row in statusranges, which makes the bulk of the address
+space, NXDOMAIN, take next to no space. lookupResult() and lookupResults() answer per address from both.
+(Records from before status ranges may still hold a status in ptrrecords; they take precedence over the ranges,
+and get moved into ranges as their addresses are written again.)
+
+Results that did not change since the last sweep are not written at all: ChangeIndex keeps a CRC32 of the current
+result of every address of recently written /16s, so the writer can tell without reading the db back.
+Whatever did change is written with writeResults(), which first copies what it replaces to ptrchanges (a replaced
+part of a status range as one row, with ipto set), so the history of every address is kept.
+
+PTRs are written with the dialect's native batched upsert:
+INSERT ... ON CONFLICT on SQLite and PostgreSQL (or COPY into a staging table for large batches on psycopg2),
+ON DUPLICATE KEY UPDATE on MySQL. Other dialects fall back to a DELETE plus INSERT.
+
+ResultWriter does those writes from a single background thread, so workers only ever wait on the db when it falls behind.
+"""
+import collections
+import csv
+import datetime
+import io
+import logging
+import queue
+import threading
+import time
+import zlib
+from array import array
+
+from sqlalchemy import and_, literal, select
+from sqlalchemy.orm import Session
+
+from rdnsmonitor import metrics
+from rdnsmonitor.dbobjects import PTRRecord, PTRChange, StatusRange, STATUS_PTR, encodeResult, decodeResult
+
+log = logging.getLogger(__name__)
+
+DB_ROWS = metrics.REGISTRY.counter("rdns_db_rows_total", "Results the result writer got, by outcome (stored, unchanged, failed)", ("outcome",))
+DB_WRITE_SECONDS = metrics.REGISTRY.histogram("rdns_db_write_seconds", "Time a result writer transaction took")
+
+COPY_THRESHOLD = 10000
+# Results further apart than this are written as separate windows
+GROUP_GAP = 4096
+
+def _chunks(rows, size):
+    for i in range(0, len(rows), size):
+        yield rows[i:i + size]
+
+def _records(results, seen):
+    records = []
+    for (ipint, result) in results:
+        (status, ptr) = encodeResult(result)
+        records.append({"ip":ipint, "status":status, "ptr":ptr, "first_seen":seen})
+    return records
+
+def _archiveStatement(ips, seen):
+    table = PTRRecord.__table__
+    current = select(table.c.ip, table.c.status, table.c.ptr, table.c.first_seen, literal(seen)).where(table.c.ip.in_(ips))
+    return PTRChange.__table__.insert().from_select(["ip", "status", "ptr", "first_seen", "last_seen"], current)
+
+def upsertResults(engine, results, batch_size, seen=None, archive=False):
+    """
+    Inserts or overwrites the PTR records for results in one transaction, batch_size rows per statement.
+    The records get seen (default: now) as their first_seen. With archive, the records being overwritten are copied
+    to ptrchanges first, with seen as their last_seen.
+    """
+    if not results:
+        return 0
+    with engine.begin() as conn:
+        _upsert(conn, results, batch_size, seen or datetime.datetime.now(), archive)
+    return len(results)
+
+def _upsert(conn, results, batch_size, seen, archive):
+    dialect = conn.dialect.name
+    stmt = _upsertStatement(dialect)
+    if archive:
+        for chunk in _chunks(results, batch_size):
+            conn.execute(_archiveStatement([ipint for (ipint, result) in chunk], seen))
+    if dialect == "postgresql" and len(results) >= COPY_THRESHOLD and conn.dialect.driver == "psycopg2":
+        _copyUpsertPostgres(conn, _records(results, seen))
+        return
+    table = PTRRecord.__table__
+    for chunk in _chunks(results, batch_size):
+        if stmt is None:
+            conn.execute(table.delete().where(table.c.ip.in_([ipint for (ipint, result) in chunk])))
+            conn.execute(table.insert(), _records(chunk, seen))
+        else:
+            conn.execute(stmt, _records(chunk, seen))
+    return
+
+def _upsertStatement(dialect):
+    table = PTRRecord.__table__
+    if dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    elif dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "mysql":
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(table)
+        return stmt.on_duplicate_key_update(status=stmt.inserted.status, ptr=stmt.inserted.ptr, first_seen=stmt.inserted.first_seen)
+    else:
+        return None
+    stmt = insert(table)
+    return stmt.on_conflict_do_update(index_elements=[table.c.ip],
+                                      set_={"status":stmt.excluded.status, "ptr":stmt.excluded.ptr, "first_seen":stmt.excluded.first_seen})
+
+def _copyUpsertPostgres(conn, records):
+    """
+    COPYs records into a staging table and upserts from there, within conn's transaction.
+    """
+    buf = io.StringIO()
+    csv.writer(buf).writerows((r["ip"], r["status"], r["ptr"], r["first_seen"].isoformat()) for r in records)
+    buf.seek(0)
+    cursor = conn.connection.cursor()
+    cursor.execute("CREATE TEMP TABLE ptrrecords_staging (LIKE ptrrecords INCLUDING DEFAULTS) ON COMMIT DROP")
+    cursor.copy_expert("COPY ptrrecords_staging (ip, status, ptr, first_seen) FROM STDIN WITH (FORMAT csv)", buf)
+    cursor.execute("INSERT INTO ptrrecords (ip, status, ptr, first_seen) SELECT ip, status, ptr, first_seen FROM ptrrecords_staging "
+                   "ON CONFLICT (ip) DO UPDATE SET status = EXCLUDED.status, ptr = EXCLUDED.ptr, first_seen = EXCLUDED.first_seen")
+    return
+
+def _groups(results):
+    """
+    Splits results into ip ordered groups of nearby addresses, each to be written as one window.
+    """
+    group = []
+    for row in sorted(results):
+        if group and row[0] - group[-1][0] > GROUP_GAP:
+            yield group
+            group = []
+        group.append(row)
+    if group:
+        yield group
+
+def _rangesAround(conn, ipfrom, ipto):
+    """
+    The status ranges overlapping or adjoining [ipfrom, ipto), in ip order.
+    """
+    table = StatusRange.__table__
+    columns = (table.c.ipfrom, table.c.ipto, table.c.status, table.c.first_seen)
+    # Ranges do not overlap, so only the last one starting before ipfrom can reach into it
+    before = conn.execute(select(*columns).where(table.c.ipfrom < ipfrom).order_by(table.c.ipfrom.desc()).limit(1)).fetchall()
+    inside = conn.execute(select(*columns).where(and_(table.c.ipfrom >= ipfrom, table.c.ipfrom <= ipto)).order_by(table.c.ipfrom)).fetchall()
+    return [tuple(row) for row in before if row[1] >= ipfrom] + [tuple(row) for row in inside]
+
+def _runs(values, offset):
+    """
+    Run length encodes values, a list with an item per address from offset on, into (ipfrom, ipto, item) for the items
+    that are not None. Items are (status, first_seen); runs are on equal status, keeping the earliest first_seen.
+    """
+    runs = []
+    for (i, value) in enumerate(values):
+        if value is None:
+            continue
+        if runs and runs[-1][1] == offset + i and runs[-1][2][0] == value[0]:
+            runs[-1] = (runs[-1][0], offset + i + 1, (value[0], min(runs[-1][2][1], value[1], key=_seenKey)))
+        else:
+            runs.append((offset + i, offset + i + 1, value))
+    return runs
+
+def _seenKey(seen):
+    return seen or datetime.datetime.min
+
+def _writeWindow(conn, group, batch_size, seen):
+    """
+    Writes the results of group, ip ordered and close together, in conn's transaction.
+    """
+    lo = group[0][0]
+    hi = group[-1][0] + 1
+    records = PTRRecord.__table__
+    ranges = _rangesAround(conn, lo, hi)
+    stored = {ip:decodeResult(status, ptr) for (ip, status, ptr) in
+              conn.execute(select(records.c.ip, records.c.status, records.c.ptr).where(and_(records.c.ip >= lo, records.c.ip < hi)))}
+    # The status (and since when) of every address in the window, as far as ranges go
+    current = [None] * (hi - lo)
+    for (ipfrom, ipto, status, first_seen) in ranges:
+        for i in range(max(ipfrom, lo), min(ipto, hi)):
+            current[i - lo] = (status, first_seen)
+    painted = list(current)
+    replaced = [None] * (hi - lo)
+    ptrs = []
+    archive = []
+    delete = []
+    for (ipint, result) in group:
+        (status, ptr) = encodeResult(result)
+        k = ipint - lo
+        if ipint in stored:
+            if status != STATUS_PTR:
+                delete.append(ipint)
+                if stored[ipint] != result:
+                    archive.append(ipint)
+        if status == STATUS_PTR:
+            ptrs.append((ipint, result))
+            painted[k] = None
+        elif current[k] is None or current[k][0] != status:
+            painted[k] = (status, seen)
+        if current[k] is not None and current[k][0] != status:
+            replaced[k] = current[k]
+    
+    for chunk in _chunks(archive, batch_size):
+        conn.execute(_archiveStatement(chunk, seen))
+    for chunk in _chunks(delete, batch_size):
+        conn.execute(records.delete().where(records.c.ip.in_(chunk)))
+    if ptrs:
+        _upsert(conn, ptrs, batch_size, seen, archive=True)
+    history = [{"ip":ipfrom, "ipto":ipto, "status":status, "ptr":None, "first_seen":first_seen, "last_seen":seen}
+               for (ipfrom, ipto, (status, first_seen)) in _runs(replaced, lo)]
+    if history:
+        conn.execute(PTRChange.__table__.insert(), history)
+    
+    # The window's new ranges, plus the parts of the old ones sticking out of it, joined where they meet
+    newranges = [(ipfrom, min(ipto, lo), (status, first_seen)) for (ipfrom, ipto, status, first_seen) in ranges if ipfrom < lo]
+    newranges += _runs(painted, lo)
+    newranges += [(max(ipfrom, hi), ipto, (status, first_seen)) for (ipfrom, ipto, status, first_seen) in ranges if ipto > hi]
+    joined = []
+    for (ipfrom, ipto, (status, first_seen)) in newranges:
+        if joined and joined[-1]["ipto"] == ipfrom and joined[-1]["status"] == status:
+            joined[-1]["ipto"] = ipto
+            joined[-1]["first_seen"] = min(joined[-1]["first_seen"], first_seen, key=_seenKey)
+        else:
+            joined.append({"ipfrom":ipfrom, "ipto":ipto, "status":status, "first_seen":first_seen})
+    if [(r["ipfrom"], r["ipto"], r["status"], r["first_seen"]) for r in joined] != ranges:
+        table = StatusRange.__table__
+        if ranges:
+            conn.execute(table.delete().where(table.c.ipfrom.in_([ipfrom for (ipfrom, ipto, status, first_seen) in ranges])))
+        if joined:
+            conn.execute(table.insert(), joined)
+    return
+
+def writeResults(engine, results, batch_size, seen=None):
+    """
+    Stores results in one transaction: PTRs in ptrrecords, statuses in status ranges. Whatever they replace goes to
+    ptrchanges, with seen (default: now) as its last_seen.
+    """
+    if not results:
+        return 0
+    seen = seen or datetime.datetime.now()
+    with engine.begin() as conn:
+        for group in _groups(results):
+            _writeWindow(conn, group, batch_size, seen)
+    return len(results)
+
+def lookupResults(engine, ipfrom, ipto):
+    """
+    (ipint, result) for every address from ipfrom up to ipto that has one stored, in ip order.
+    """
+    records = PTRRecord.__table__
+    results = {}
+    with engine.connect() as conn:
+        for (rangefrom, rangeto, status, first_seen) in _rangesAround(conn, ipfrom, ipto):
+            for ipint in range(max(rangefrom, ipfrom), min(rangeto, ipto)):
+                results[ipint] = decodeResult(status, None)
+        for (ipint, status, ptr) in conn.execute(select(records.c.ip, records.c.status, records.c.ptr)
+                                                 .where(and_(records.c.ip >= ipfrom, records.c.ip < ipto))):
+            results[ipint] = decodeResult(status, ptr)
+    return sorted(results.items())
+
+def lookupResult(engine, ipint):
+    """
+    The result stored for ipint, or None.
+    """
+    results = lookupResults(engine, ipint, ipint + 1)
+    return results[0][1] if results else None
+
+def mergeResults(engine, results, seen=None, archive=False):
+    """
+    The slow path: a SELECT plus INSERT/UPDATE per row.
+    """
+    seen = seen or datetime.datetime.now()
+    session = Session(bind=engine)
+    try:
+        if archive:
+            session.execute(_archiveStatement([ipint for (ipint, result) in results], seen))
+        for ptrr in [PTRRecord(**record) for record in _records(results, seen)]:
+            session.merge(ptrr)
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    return
+
+
+class ChangeIndex(object):
+    """
+    CRC32s of the current result of every address in the BLOCKS most recently written /16s, loaded from the db the first
+    time a block comes by. changed() tells which results differ from what is stored without touching the db.
+    A CRC collision lets a change go unnoticed until the address changes again; at 1 in 2**32 per change that is accepted.
+    """
+    BLOCKS = 64
+    
+    def __init__(self, engine, blocks=BLOCKS):
+        self._engine = engine
+        self._maxblocks = blocks
+        self._blocks = collections.OrderedDict()
+        return
+    
+    @staticmethod
+    def _crc(result):
+        # 0 marks an address without a record
+        return zlib.crc32(result.encode()) or 1
+    
+    def _block(self, blockid):
+        crcs = self._blocks.get(blockid)
+        if crcs is not None:
+            self._blocks.move_to_end(blockid)
+            return crcs
+        crcs = array("I", bytes(4 * 2**16))
+        (blockfrom, blockto) = (blockid << 16, (blockid + 1) << 16)
+        table = PTRRecord.__table__
+        query = select(table.c.ip, table.c.status, table.c.ptr).where(and_(table.c.ip >= blockfrom, table.c.ip < blockto))
+        with self._engine.connect() as conn:
+            for (ipfrom, ipto, status, first_seen) in _rangesAround(conn, blockfrom, blockto):
+                crc = ChangeIndex._crc(decodeResult(status, None))
+                for ipint in range(max(ipfrom, blockfrom), min(ipto, blockto)):
+                    crcs[ipint & 0xffff] = crc
+            for (ipint, status, ptr) in conn.execute(query):
+                crcs[ipint & 0xffff] = ChangeIndex._crc(decodeResult(status, ptr))
+        self._blocks[blockid] = crcs
+        if len(self._blocks) > self._maxblocks:
+            self._blocks.popitem(last=False)
+        return crcs
+    
+    def changed(self, results):
+        """
+        The results that differ from the stored ones.
+        """
+        return [(ipint, result) for (ipint, result) in results if self._block(ipint >> 16)[ipint & 0xffff] != ChangeIndex._crc(result)]
+    
+    def update(self, results):
+        """
+        Records that results got stored.
+        """
+        for (ipint, result) in results:
+            crcs = self._blocks.get(ipint >> 16)
+            if crcs is not None:
+                crcs[ipint & 0xffff] = ChangeIndex._crc(result)
+        return
+
+
+class ResultWriter(threading.Thread):
+    """
+    Single thread that owns all writes to the results db.
+    Workers put() their result batches on a bounded queue; put() blocks while the queue is full, which slows the workers
+    down to what the db can take. The writer coalesces whatever is queued into transactions of up to txn_size rows,
+    and only writes the results that changed.
+    A batch can come with a done callable, which is called once its results are committed, and a failed callable, which
+    is called instead when they could not be.
+    close() writes out everything that was queued before returning.
+    """
+    # Results per batch, as the local workers send them (LocalWorker.SMAX_RESULTBATCH)
+    BATCH_SIZE = 1024
+    QUEUE_SIZE = 64
+    TXN_SIZE = 16384
+    
+    _STOP = object()
+    
+    def __init__(self, engine, batch_size, queue_size=QUEUE_SIZE, txn_size=TXN_SIZE):
+        threading.Thread.__init__(self, name="ResultWriter", daemon=True)
+        self._engine = engine
+        self._batch_size = batch_size
+        self._txn_size = txn_size
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._index = ChangeIndex(engine)
+        self.stored = 0
+        self.unchanged = 0
+        self.failed = 0
+        return
+    
+    def put(self, results, done=None, failed=None):
+        if not self.is_alive():
+            raise RuntimeError("Result writer is not running")
+        self._queue.put((results, done, failed))
+        return
+    
+    def run(self):
+        log.info("Result writer started")
+        stopping = False
+        while not stopping:
+            rows = []
+            callbacks = []
+            taken = 0
+            item = self._queue.get()
+            while True:
+                taken += 1
+                if item is ResultWriter._STOP:
+                    stopping = True
+                    break
+                (results, done, failed) = item
+                rows.extend(results)
+                callbacks.append((done, failed))
+                if len(rows) >= self._txn_size:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            written = self._write(rows)
+            for callback in (done if written else failed for (done, failed) in callbacks):
+                if callback is None:
+                    continue
+                try:
+                    callback()
+                except Exception as ex:
+                    log.error("Error after storing results: %s", repr(ex))
+            for i in range(taken):
+                self._queue.task_done()
+        log.info("Result writer stopped. %d rows stored, %d unchanged, %d failed", self.stored, self.unchanged, self.failed)
+        return
+    
+    def _write(self, rows):
+        """
+        Writes rows in one go. Returns whether they made it.
+        """
+        if not rows:
+            return True
+        # The last result for an address wins, as it would with one upsert after the other
+        rows = list(dict(rows).items())
+        log.debug("Writing %d results...", len(rows))
+        start = time.monotonic()
+        try:
+            changed = self._index.changed(rows)
+            writeResults(self._engine, changed, self._batch_size)
+        except Exception as ex:
+            self.failed += len(rows)
+            DB_ROWS.inc(len(rows), outcome="failed")
+            log.error("Error storing results: %s", str(ex))
+            log.error("rolled back.")
+            return False
+        else:
+            self._index.update(changed)
+            self.stored += len(changed)
+            self.unchanged += len(rows) - len(changed)
+            DB_ROWS.inc(len(changed), outcome="stored")
+            DB_ROWS.inc(len(rows) - len(changed), outcome="unchanged")
+            DB_WRITE_SECONDS.observe(time.monotonic() - start)
+            log.debug("%d results stored, %d unchanged", len(changed), len(rows) - len(changed))
+        return True
+    
+    def qsize(self):
+        return self._queue.qsize()
+    
+    def flush(self):
+        """
+        Blocks until everything queued so far is written.
+        """
+        self._queue.join()
+        return
+    
+    def close(self):
+        if self.is_alive():
+            self._queue.put(ResultWriter._STOP)
+            self.join()
+        return
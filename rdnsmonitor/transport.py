@@ -0,0 +1,417 @@
+"""
+Long-lived sockets for PTR lookups.
+
+Instead of opening a socket per lookup, every nameserver gets a small pool of connected UDP sockets.
+Queries are pre-built PTR packets; replies are matched to their query by transaction ID (and question).
+TCP is only used for truncated answers, or for everything if asked to, over one persistent pipelined connection per nameserver.
+At most MAX_CHANNELS nameservers keep their sockets; the least recently used idle ones are closed to make room for others
+(with recursive, every authoritative server is a nameserver of its own).
+
+Both transports hand back the raw reply; parsing it is up to the worker. Given an rtt callable, they call it with the
+nameserver and the seconds from sending a query to receiving its reply, which leaves out the time the worker took to
+get to either. An asyncio timeout that went off more than LOOP_LATE late (the event loop was busy) raises LateTimeout:
+the nameserver may have been fine, and the worker should not hold it against it.
+With a prefixlen below 32 they ask for the NS records of the reverse zone of the address' /prefixlen instead, which
+tells whether anything is delegated in there at all.
+"""
+import asyncio
+import collections
+import logging
+import random
+import socket
+import struct
+import time
+
+import dns.exception
+
+log = logging.getLogger(__name__)
+
+EDNS_PAYLOAD = 1232
+UDP_SOCKETS = 4
+MAX_CHANNELS = 64
+LOOP_LATE = 0.05
+
+FLAG_TC = 0x0200
+
+def _label(text):
+    text = text.encode("ascii")
+    return bytes([len(text)]) + text
+
+_OCTETS = [_label(str(i)) for i in range(256)]
+_ARPA = _label("in-addr") + _label("arpa") + b"\x00"
+_SUFFIX = _ARPA + struct.pack("!HH", 12, 1) # QTYPE PTR, QCLASS IN
+_ZONE_SUFFIX = _ARPA + struct.pack("!HH", 2, 1) # QTYPE NS, QCLASS IN
+
+def makePTRQuery(ipint, qid, payload=EDNS_PAYLOAD, prefixlen=32):
+    """
+    Returns (packet, question) for a recursive PTR query of ipint with transaction id qid.
+    question is the wire form of the question section, which a reply has to echo back.
+    For a prefixlen of 8, 16 or 24 it is an NS query for the reverse zone of ipint's /prefixlen.
+    """
+    if prefixlen == 32:
+        question = (_OCTETS[ipint & 0xff] + _OCTETS[(ipint >> 8) & 0xff] +
+                    _OCTETS[(ipint >> 16) & 0xff] + _OCTETS[ipint >> 24] + _SUFFIX)
+    else:
+        question = b"".join(_OCTETS[(ipint >> shift) & 0xff] for shift in range(32 - prefixlen, 32, 8)) + _ZONE_SUFFIX
+    packet = struct.pack("!HHHHHH", qid, 0x0100, 1, 0, 0, 1 if payload else 0) + question
+    if payload:
+        packet += b"\x00" + struct.pack("!HHIH", 41, payload, 0, 0) # OPT pseudo-RR
+    return packet, question
+
+def _matches(reply, qid, question):
+    return len(reply) >= 12 + len(question) and struct.unpack_from("!H", reply)[0] == qid and reply[12:12 + len(question)] == question
+
+def isTruncated(reply):
+    return bool(struct.unpack_from("!H", reply, 2)[0] & FLAG_TC)
+
+class LateTimeout(dns.exception.Timeout):
+    pass
+
+async def _wait(future, timeout):
+    """
+    The result of future, which the protocols set to (reply, time received). Raises dns.exception.Timeout when it did
+    not come in time, LateTimeout if the loop only got to that late.
+    """
+    due = time.monotonic() + timeout
+    try:
+        return await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        if time.monotonic() - due > LOOP_LATE:
+            raise LateTimeout(timeout=timeout)
+        raise dns.exception.Timeout(timeout=timeout)
+
+def _newId(pending):
+    qid = random.getrandbits(16)
+    while qid in pending:
+        qid = random.getrandbits(16)
+    return qid
+
+
+class _UDPProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self):
+        self.transport = None
+        self.pending = {}
+        return
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 12:
+            return
+        entry = self.pending.get(struct.unpack_from("!H", data)[0])
+        if entry is None: # late answer to a query we already gave up on
+            return
+        question, future = entry
+        if data[12:12 + len(question)] != question:
+            log.debug("Dropping reply with mismatching question from %s", addr)
+            return
+        if not future.done():
+            future.set_result((data, time.monotonic()))
+
+    def error_received(self, exc):
+        self._failAll(exc)
+
+    def connection_lost(self, exc):
+        self._failAll(exc or EOFError("UDP socket closed"))
+        self.transport = None
+
+    def _failAll(self, exc):
+        for (question, future) in self.pending.values():
+            if not future.done():
+                future.set_exception(exc)
+        return
+
+
+class _TCPPipeline(object):
+    """
+    One persistent TCP connection to a nameserver. Queries are written back to back and replies are demultiplexed by id,
+    so many lookups can share the connection at the same time. Reconnects on the next query after the connection died.
+    """
+
+    def __init__(self, nameserver, port, rtt=None):
+        self.nameserver = nameserver
+        self.port = port
+        self.rtt = rtt
+        self._writer = None
+        self._reader_task = None
+        self._pending = {}
+        self._connect_lock = asyncio.Lock()
+        return
+
+    async def _connect(self):
+        async with self._connect_lock:
+            if self._writer and not self._writer.is_closing():
+                return
+            log.debug("Opening TCP connection to %s", self.nameserver)
+            reader, self._writer = await asyncio.open_connection(self.nameserver, self.port)
+            self._reader_task = asyncio.ensure_future(self._readLoop(reader))
+        return
+
+    async def _readLoop(self, reader):
+        try:
+            while True:
+                (length,) = struct.unpack("!H", await reader.readexactly(2))
+                reply = await reader.readexactly(length)
+                entry = self._pending.get(struct.unpack_from("!H", reply)[0]) if length >= 12 else None
+                if entry and reply[12:12 + len(entry[0])] == entry[0] and not entry[1].done():
+                    entry[1].set_result((reply, time.monotonic()))
+        except (asyncio.IncompleteReadError, OSError) as exc:
+            log.debug("TCP connection to %s lost: %s", self.nameserver, repr(exc))
+            for (question, future) in self._pending.values():
+                if not future.done():
+                    future.set_exception(EOFError("TCP connection to {} lost".format(self.nameserver)))
+        finally:
+            if self._writer:
+                self._writer.close()
+            self._writer = None
+        return
+
+    async def query(self, ipint, timeout, payload, prefixlen=32):
+        if not self._writer or self._writer.is_closing():
+            await asyncio.wait_for(self._connect(), timeout)
+        qid = _newId(self._pending)
+        packet, question = makePTRQuery(ipint, qid, payload, prefixlen)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[qid] = (question, future)
+        try:
+            sent = time.monotonic()
+            self._writer.write(struct.pack("!H", len(packet)) + packet)
+            (reply, received) = await _wait(future, timeout)
+        finally:
+            del self._pending[qid]
+        if self.rtt:
+            self.rtt(self.nameserver, received - sent)
+        return reply
+
+    async def close(self):
+        if self._writer:
+            self._writer.close()
+        if self._reader_task:
+            self._reader_task.cancel()
+        return
+
+
+class _AsyncChannel(object):
+
+    def __init__(self, nameserver, port, sockets, payload, rtt=None):
+        self.nameserver = nameserver
+        self.port = port
+        self.payload = payload
+        self.rtt = rtt
+        self._numsockets = sockets
+        self._udp = []
+        self._next = 0
+        self._tcp = _TCPPipeline(nameserver, port, rtt=rtt)
+        self._inflight = 0
+        return
+
+    async def _udpSocket(self):
+        self._next = (self._next + 1) % self._numsockets
+        while len(self._udp) <= self._next:
+            (transport, protocol) = await asyncio.get_running_loop().create_datagram_endpoint(_UDPProtocol, remote_addr=(self.nameserver, self.port))
+            self._udp.append(protocol)
+        protocol = self._udp[self._next]
+        if protocol.transport is None: # closed after an error, replace it
+            (transport, protocol) = await asyncio.get_running_loop().create_datagram_endpoint(_UDPProtocol, remote_addr=(self.nameserver, self.port))
+            self._udp[self._next] = protocol
+        return protocol
+
+    def busy(self):
+        return self._inflight > 0
+
+    async def query(self, ipint, timeout, tcp=False, prefixlen=32):
+        self._inflight += 1
+        try:
+            if tcp:
+                return await self._tcp.query(ipint, timeout, self.payload, prefixlen)
+            start = time.monotonic()
+            protocol = await self._udpSocket()
+            qid = _newId(protocol.pending)
+            packet, question = makePTRQuery(ipint, qid, self.payload, prefixlen)
+            future = asyncio.get_running_loop().create_future()
+            protocol.pending[qid] = (question, future)
+            try:
+                sent = time.monotonic()
+                protocol.transport.sendto(packet)
+                (reply, received) = await _wait(future, timeout)
+            finally:
+                del protocol.pending[qid]
+            if self.rtt:
+                self.rtt(self.nameserver, received - sent)
+            if isTruncated(reply):
+                log.debug("Truncated answer from %s, retrying over TCP", self.nameserver)
+                reply = await self._tcp.query(ipint, max(timeout - (time.monotonic() - start), 0.1), self.payload, prefixlen)
+            return reply
+        except asyncio.TimeoutError:
+            raise dns.exception.Timeout(timeout=timeout)
+        finally:
+            self._inflight -= 1
+
+    async def close(self):
+        for protocol in self._udp:
+            if protocol.transport:
+                protocol.transport.close()
+        await self._tcp.close()
+        return
+
+
+class AsyncTransport(object):
+    """
+    PTR lookups for an asyncio worker. Must be used (and closed) from the event loop it was first used in.
+    query() returns the raw reply, raises dns.exception.Timeout (or LateTimeout) when none came in time, and
+    OSError/EOFError on socket trouble.
+    """
+
+    def __init__(self, port=53, sockets=UDP_SOCKETS, payload=EDNS_PAYLOAD, max_channels=MAX_CHANNELS, rtt=None):
+        self.port = port
+        self.sockets = sockets
+        self.payload = payload
+        self.max_channels = max_channels
+        self.rtt = rtt
+        # Least recently used first
+        self._channels = collections.OrderedDict()
+        return
+
+    async def query(self, ipint, nameserver, timeout, tcp=False, prefixlen=32):
+        channel = self._channels.get(nameserver)
+        if channel is None:
+            await self._makeRoom()
+            channel = self._channels.get(nameserver)
+        if channel is None:
+            channel = self._channels[nameserver] = _AsyncChannel(nameserver, self.port, self.sockets, self.payload, rtt=self.rtt)
+        else:
+            self._channels.move_to_end(nameserver)
+        return await channel.query(ipint, timeout, tcp=tcp, prefixlen=prefixlen)
+
+    async def _makeRoom(self):
+        """
+        Closes the least recently used channels without queries in flight until there is room for one more.
+        Busy ones are left alone, so there can be more than max_channels for a while.
+        """
+        for nameserver in list(self._channels):
+            if len(self._channels) < self.max_channels:
+                break
+            channel = self._channels.get(nameserver)
+            if channel and not channel.busy():
+                del self._channels[nameserver]
+                await channel.close()
+        return
+
+    async def close(self):
+        for channel in self._channels.values():
+            await channel.close()
+        self._channels = collections.OrderedDict()
+        return
+
+
+class BlockingTransport(object):
+    """
+    PTR lookups for a synchronous worker: one connected UDP socket per nameserver, kept until MAX_CHANNELS others were used since,
+    and a persistent TCP connection that is only opened once a truncated answer (or tcp=True) calls for it.
+    Replies to earlier, timed out queries are recognized by id and skipped.
+    """
+
+    def __init__(self, port=53, payload=EDNS_PAYLOAD, max_channels=MAX_CHANNELS, rtt=None):
+        self.port = port
+        self.payload = payload
+        self.max_channels = max_channels
+        self.rtt = rtt
+        # Least recently used first
+        self._udp = collections.OrderedDict()
+        self._tcp = collections.OrderedDict()
+        return
+
+    def _socket(self, socks, nameserver):
+        """
+        The socket to nameserver in socks, or None, after making room for a new one when there is none.
+        """
+        sock = socks.get(nameserver)
+        if sock is not None:
+            socks.move_to_end(nameserver)
+            return sock
+        while len(socks) >= self.max_channels:
+            self._drop(socks, next(iter(socks)))
+        return None
+
+    def query(self, ipint, nameserver, timeout, tcp=False, prefixlen=32):
+        if tcp:
+            return self._queryTCP(ipint, nameserver, timeout, prefixlen)
+        sock = self._socket(self._udp, nameserver)
+        if sock is None:
+            sock = self._udp[nameserver] = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.connect((nameserver, self.port))
+        qid = random.getrandbits(16)
+        packet, question = makePTRQuery(ipint, qid, self.payload, prefixlen)
+        sent = time.monotonic()
+        deadline = sent + timeout
+        try:
+            sock.send(packet)
+            reply = self._receive(sock, deadline, lambda: sock.recv(65535), qid, question)
+        except OSError:
+            self._drop(self._udp, nameserver)
+            raise
+        if self.rtt:
+            self.rtt(nameserver, time.monotonic() - sent)
+        if isTruncated(reply):
+            reply = self._queryTCP(ipint, nameserver, max(deadline - time.monotonic(), 0.1), prefixlen)
+        return reply
+
+    def _queryTCP(self, ipint, nameserver, timeout, prefixlen=32):
+        sock = self._socket(self._tcp, nameserver)
+        deadline = time.monotonic() + timeout
+        try:
+            if sock is None:
+                sock = self._tcp[nameserver] = socket.create_connection((nameserver, self.port), timeout)
+            qid = random.getrandbits(16)
+            packet, question = makePTRQuery(ipint, qid, self.payload, prefixlen)
+            sent = time.monotonic()
+            sock.sendall(struct.pack("!H", len(packet)) + packet)
+            reply = self._receive(sock, deadline, lambda: self._readTCP(sock), qid, question)
+        except (OSError, EOFError, dns.exception.Timeout):
+            # A stream we gave up on half way can not be reused
+            self._drop(self._tcp, nameserver)
+            raise
+        if self.rtt:
+            self.rtt(nameserver, time.monotonic() - sent)
+        return reply
+
+    def _readTCP(self, sock):
+        (length,) = struct.unpack("!H", self._readExactly(sock, 2))
+        return self._readExactly(sock, length)
+
+    def _readExactly(self, sock, count):
+        data = b""
+        while len(data) < count:
+            chunk = sock.recv(count - len(data))
+            if not chunk:
+                raise EOFError("Connection closed by nameserver")
+            data += chunk
+        return data
+
+    def _receive(self, sock, deadline, read, qid, question):
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise dns.exception.Timeout(timeout=remaining)
+            sock.settimeout(remaining)
+            try:
+                reply = read()
+            except socket.timeout:
+                raise dns.exception.Timeout(timeout=remaining)
+            if _matches(reply, qid, question):
+                return reply
+            log.debug("Skipping stale or mismatching reply")
+
+    def _drop(self, socks, nameserver):
+        sock = socks.pop(nameserver, None)
+        if sock:
+            sock.close()
+        return
+
+    def close(self):
+        for socks in (self._udp, self._tcp):
+            for nameserver in list(socks):
+                self._drop(socks, nameserver)
+        return
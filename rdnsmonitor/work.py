@@ -2,54 +2,185 @@ import threading
 import logging
 import datetime
 import socket
+import asyncio
+import time
+import zlib
+import collections
+from array import array
 
 import dns.resolver
 import dns.reversename
 import dns.exception
 from dns.exception import Timeout
 
+from rdnsmonitor import delegation
 from rdnsmonitor import handy
+from rdnsmonitor import metrics
+from rdnsmonitor import transport
+from rdnsmonitor.nsscheduler import NameserverScheduler
 
 log = logging.getLogger(__name__)
 
+QUERIES = metrics.REGISTRY.counter("rdns_queries_total", "PTR queries answered or given up on, by nameserver and result", ("nameserver", "result"))
+ZONE_PROBES = metrics.REGISTRY.counter("rdns_zone_probes_total", "Reverse zone probes, by nameserver and rcode", ("nameserver", "result"))
+QUERY_SECONDS = metrics.REGISTRY.histogram("rdns_query_seconds", "Time until an answer or a timeout, by nameserver", ("nameserver",))
+# The label of all authoritative servers (see recursive), as there are far too many to give each a series of its own
+AUTHORITATIVE = "authoritative"
+
 class SERVFAIL(dns.exception.DNSException):
     pass
 
 class CommException(dns.exception.DNSException):
     pass
 
+def _zoneSlices(ipfrom, ipto, prefixlen):
+    """
+    Splits [ipfrom, ipto) along the /prefixlen boundaries, yielding (from, to) for every reverse zone it touches.
+    """
+    size = 1 << (32 - prefixlen)
+    start = ipfrom
+    while start < ipto:
+        end = min((start // size + 1) * size, ipto)
+        yield (start, end)
+        start = end
+
+def _mergePlan(plan):
+    """
+    Joins adjacent (from, to, delegated) ranges with the same delegated flag.
+    """
+    merged = []
+    for (rangefrom, rangeto, delegated) in plan:
+        if merged and merged[-1][2] == delegated and merged[-1][1] == rangefrom:
+            merged[-1] = (merged[-1][0], rangeto, delegated)
+        else:
+            merged.append((rangefrom, rangeto, delegated))
+    return merged
+
+class JobDigest(object):
+    """
+    Fingerprint of a job's results per /24: the XOR of a CRC32 of every (ip, result) in it. The server compares it with
+    the one of the previous sweep to tell how much of the block changed. A result that gets replaced later on (by the
+    retry pass) is swapped out by passing its old value.
+    Also counts the PTRs, that is the results that are not NXDOMAIN or some failure.
+    """
+    STATUSES = ("NXDOMAIN", "TIMEOUT", "ERROR", "SERVFAIL", "NODATA")
+    
+    def __init__(self, ipfrom, ipto):
+        self.ipfrom = ipfrom
+        self.ptr_count = 0
+        self._slices = array("I", [0] * len(list(_zoneSlices(ipfrom, ipto, 24))))
+        return
+    
+    def _slot(self, ipint):
+        return (ipint >> 8) - (self.ipfrom >> 8)
+    
+    def add(self, ipint, ptr, old=None):
+        slot = self._slot(ipint)
+        if old is not None:
+            self._slices[slot] ^= zlib.crc32(old.encode(), ipint & 0xffffffff)
+            self.ptr_count -= old not in JobDigest.STATUSES
+        self._slices[slot] ^= zlib.crc32(ptr.encode(), ipint & 0xffffffff)
+        self.ptr_count += ptr not in JobDigest.STATUSES
+        return
+    
+    def resume(self, olddigest, oldptrs, ipint):
+        """
+        For a job picked up again at ipint (on a /24 boundary): the part before it is not swept again, so take it to be
+        what the previous sweep found, olddigest and (a pro rata share of) its oldptrs PTRs.
+        """
+        slots = self._slot(ipint)
+        if olddigest and len(olddigest) == len(self._slices) * self._slices.itemsize:
+            old = array("I")
+            old.frombytes(olddigest)
+            self._slices[:slots] = old[:slots]
+        if oldptrs:
+            self.ptr_count += round(oldptrs * slots / len(self._slices))
+        return
+    
+    def pack(self):
+        return self._slices.tobytes()
+
+
 class Worker():    
     
     COMMERR_TRESH = 10
+    RETRIES = 1
+    # Outcomes worth asking another nameserver about
+    RETRY_ON = ("TIMEOUT", "ERROR")
+    # Seconds to wait for a benched authoritative server before asking the resolvers instead
+    DIRECT_WAIT = 1.0
     
-    def __init__(self, nameservers=[], use_tcp=False):
+    def __init__(self, nameservers=[], use_tcp=False, port=None, ns_qps=None, retries=RETRIES, probe_zones=True, limiter=None, recursive=False, roots=None):
         self.current_job = None
         self.default_nameserver = dns.resolver.get_default_resolver().nameservers[0]
         self.nameservers = nameservers + [self.default_nameserver]
         self.cur_nameserver = None
         self.resolver = dns.resolver.Resolver()
-        self.nameserver_stats = {nsname:{"good":True} for nsname in self.nameservers}
-        self._switchDNS()
+        if port:
+            self.resolver.port = port
+        self.nameserver_stats = collections.defaultdict(Worker._newStats, {nsname:Worker._newStats() for nsname in self.nameservers})
         self.timeout = 3
-        self.jobstats = {"timeoutcnt":0, 
-                         "resolvecnt":0,
-                         "nxdcnt":0,
-                         "tot_duration":datetime.timedelta(0),
-                         "errcnt":0}
+        self.retries = retries
+        self.probe_zones = probe_zones
+        self.scheduler = NameserverScheduler(self.nameservers, max_qps=ns_qps, commerr_tresh=Worker.COMMERR_TRESH, max_timeout=self.timeout,
+                                            limiter=limiter, forget=self._forgetNameserver)
+        self._transport = transport.BlockingTransport(port=self.resolver.port, rtt=self.scheduler.measured)
+        self.jobstats = Worker._newStats()
+        self.digest = None
         self.use_tcp = use_tcp
+        # With recursive, PTRs are asked of the authoritative servers, and the nameservers are only the fallback
+        self.delegations = delegation.getCache(roots) if recursive else None
+        self._stopping = threading.Event()
         return
     
+    @staticmethod
+    def _newStats():
+        return {"timeoutcnt":0, 
+                "resolvecnt":0,
+                "servfailcnt":0,
+                "nxdcnt":0,
+                "tot_duration":datetime.timedelta(0),
+                "errcnt":0,
+                "retrycnt":0,
+                "probecnt":0,
+                "skipcnt":0}
+    
     def work(self):
         self._fetchJob()
         while self.current_job:
-            self._workJob()
+            if not self._workJob():
+                self._releaseJob()
+                break
             self._finishJob()
+            if self._stopping.is_set():
+                break
             self._fetchJob()
         return
     
+    def stop(self):
+        """
+        Makes the worker stop after the result batch it is working on: the batch is sent, with the job's checkpoint, and
+        the job is given back unfinished.
+        """
+        self._stopping.set()
+        return
+    
+    def _resumePoint(self):
+        """
+        Where to start on the current job: at the /24 its checkpoint is in, or at the start if it has none.
+        Starting on a /24 boundary keeps the job's digest right.
+        """
+        job = self.current_job
+        if not job.checkpoint or job.checkpoint <= job.ipfrom:
+            return job.ipfrom
+        return max(job.ipfrom, min(job.checkpoint, job.ipto) & ~0xff)
+    
     def _fetchJob(self):
         raise NotImplementedError
     
+    def _releaseJob(self):
+        raise NotImplementedError
+    
     def _finishJob(self):
         raise NotImplementedError
     
@@ -59,118 +190,239 @@ class Worker():
     def _sendResults(self):
         return
     
-    def _resolveIP(self, ipAddress):
+    def _resolveIP(self, ipAddress, retries=None):
+        """
+        Resolves ipAddress, asking up to retries (default: the worker's retries) other nameservers when one times out or fails.
+        """
         log.debug("Resolving %s...", ipAddress)
         addr =  dns.reversename.from_address(ipAddress)
-        try:
+        ipint = handy.ipToInt(ipAddress)
+        retries = self.retries if retries is None else retries
+        tried = []
+        direct = self.delegations is not None
+        referrals = 0
+        while True:
+            nameserver = self._pickNameserver(exclude=tried, among=self.delegations.servers(ipint) if direct else None)
+            start = datetime.datetime.now()
+            late = False
+            try:
+                data = self.query(ipint, nameserver, tcp=self.use_tcp, direct=direct)[0].to_text()
+            except (delegation.Referral, delegation.Unresolvable) as exc:
+                direct = self._followReferral(exc, nameserver, addr, start, referrals)
+                referrals += 1
+                continue
+            except Exception as exc:
+                data = self._handleFailure(exc, nameserver, addr, start)
+                late = isinstance(exc, transport.LateTimeout)
+            else:
+                self._countResolved(nameserver, datetime.datetime.now() - start)
+            self._report(nameserver, start, data, late=late)
+            if data not in Worker.RETRY_ON or len(tried) >= retries:
+                break
+            tried.append(nameserver)
+            self.jobstats["retrycnt"] += 1
+        
+        log.debug("Got %s", data)
+        return data
+    
+    def _followReferral(self, exc, nameserver, addr, start, referrals):
+        """
+        Books a referral from an authoritative server. Returns whether to keep on asking authoritative servers,
+        which is not the case when they can not tell or after MAX_REFERRALS.
+        """
+        self._report(nameserver, start, delegation.REFERRAL)
+        if isinstance(exc, delegation.Unresolvable):
+            log.debug("%s: %s, asking the resolvers", addr, str(exc))
+            return False
+        if referrals >= delegation.MAX_REFERRALS:
+            log.warning("%s: too many referrals, asking the resolvers", addr)
+            return False
+        return True
+    
+    def _report(self, nameserver, start, data, probe=False, late=False):
+        """
+        Books the outcome of a query with the scheduler and in the metrics. A late timeout (see transport.LateTimeout)
+        was the worker's doing, so only goes in the metrics.
+        """
+        duration = (datetime.datetime.now() - start).total_seconds()
+        if not late:
+            self.scheduler.report(nameserver, duration, data)
+        label = nameserver if nameserver in self.nameservers else AUTHORITATIVE
+        if probe:
+            ZONE_PROBES.inc(nameserver=label, result=data)
+        else:
+            QUERIES.inc(nameserver=label, result=data if data in JobDigest.STATUSES or data == delegation.REFERRAL else "PTR")
+        QUERY_SECONDS.observe(duration, nameserver=label)
+        return
+    
+    def _forgetNameserver(self, nameserver):
+        """
+        Called by the scheduler when it drops a learned (authoritative) server.
+        """
+        self.nameserver_stats.pop(nameserver, None)
+        return
+    
+    def _among(self, among):
+        """
+        The servers to pick from: among, or the worker's nameservers. Not whichever the scheduler knows, as that includes
+        the authoritative servers of every zone seen in recursive mode.
+        """
+        if among is None and self.delegations is not None:
+            return self.nameservers
+        return among
+    
+    def _pickNameserver(self, exclude=(), among=None):
+        among = self._among(among)
+        while True:
+            (nameserver, wait) = self.scheduler.acquire(exclude=exclude, among=among)
+            if nameserver:
+                self.cur_nameserver = nameserver
+                return nameserver
+            if wait > Worker.DIRECT_WAIT and among is not self.nameservers:
+                among = self.nameservers
+                continue
+            log.debug("No nameserver available, waiting %.3fs", wait)
+            time.sleep(wait)
+    
+    def _probeZone(self, ipint, prefixlen):
+        """
+        Asks whether anything exists under the reverse zone of ipint's /prefixlen. Returns False when the zone name is
+        NXDOMAIN, which means there is not a single PTR in there, True when it exists, and None when no nameserver
+        gave a clear answer.
+        """
+        tried = []
+        while True:
+            nameserver = self._pickNameserver(exclude=tried)
             start = datetime.datetime.now()
-            data = self.resolver.query(addr, "PTR", tcp=self.use_tcp)[0].to_text()
-            duration = datetime.datetime.now() - start
-            self.nameserver_stats[self.cur_nameserver]["tot_duration"] += duration
-            self.jobstats["tot_duration"] += duration
-            self.jobstats["resolvecnt"] += 1
-            self.nameserver_stats[self.cur_nameserver]["resolvecnt"] += 1            
-        except dns.resolver.NXDOMAIN:
-            log.debug("%s -> NXDOMAIN", ipAddress)
-            data = "NXDOMAIN"
-            duration = datetime.datetime.now() - start
-            self.nameserver_stats[self.cur_nameserver]["resolvecnt"] += 1
-            self.nameserver_stats[self.cur_nameserver]["nxdcnt"] += 1
-            self.jobstats["resolvecnt"] += 1
+            try:
+                wire = self._transport.query(ipint, nameserver, self.scheduler.timeout(nameserver), tcp=self.use_tcp, prefixlen=prefixlen)
+            except Exception as exc:
+                wire = exc
+            answer = self._zoneAnswer(wire, nameserver, ipint, prefixlen, start)
+            if answer is not None or len(tried) >= self.retries:
+                return answer
+            tried.append(nameserver)
+    
+    def _zoneAnswer(self, wire, nameserver, ipint, prefixlen, start):
+        """
+        Books the reply (or exception) of a zone probe with the scheduler and turns it into _probeZone()'s answer.
+        """
+        self.jobstats["probecnt"] += 1
+        answer = None
+        if isinstance(wire, dns.exception.Timeout):
+            data = "TIMEOUT"
+        elif isinstance(wire, (socket.error, EOFError)):
+            data = "ERROR"
+        elif isinstance(wire, Exception):
+            raise wire
+        else:
+            try:
+                rcode = dns.message.from_wire(wire).rcode()
+            except dns.exception.FormError:
+                rcode = None
+            data = dns.rcode.to_text(rcode) if rcode is not None else "ERROR"
+            if rcode == dns.rcode.NXDOMAIN:
+                answer = False
+            elif rcode == dns.rcode.NOERROR:
+                answer = True
+        self._report(nameserver, start, data, probe=True, late=isinstance(wire, transport.LateTimeout))
+        log.debug("Zone %s/%d @%s: %s", handy.intToIp(ipint), prefixlen, nameserver, data)
+        return answer
+    
+    def _zonePlan(self, ipfrom, ipto):
+        """
+        Probes the /16 and /24 reverse zones of [ipfrom, ipto) and returns it as (from, to, delegated) ranges.
+        Only the /24s of a /16 that exists get probed. Undelegated ranges need not be queried address by address.
+        """
+        if not self.probe_zones:
+            return [(ipfrom, ipto, True)]
+        plan = []
+        for (zonefrom, zoneto) in _zoneSlices(ipfrom, ipto, 16):
+            if self._probeZone(zonefrom, 16) is False:
+                plan.append((zonefrom, zoneto, False))
+                continue
+            for (subfrom, subto) in _zoneSlices(zonefrom, zoneto, 24):
+                plan.append((subfrom, subto, self._probeZone(subfrom, 24) is not False))
+        return _mergePlan(plan)
+    
+    def _countResolved(self, nameserver, duration, nxdomain=False):
+        nsstats = self.nameserver_stats[nameserver]
+        nsstats["resolvecnt"] += 1
+        nsstats["tot_duration"] += duration
+        self.jobstats["resolvecnt"] += 1
+        self.jobstats["tot_duration"] += duration
+        if nxdomain:
+            nsstats["nxdcnt"] += 1
             self.jobstats["nxdcnt"] += 1
-            self.nameserver_stats[self.cur_nameserver]["tot_duration"] += duration
-            self.jobstats["tot_duration"] += duration
-        except Timeout as exc: #no answer within lifetime. This is often not the fault of the open resolver. 
-            log.warning("Timeout occured @%s querying %s", self.cur_nameserver, addr)
-            self.nameserver_stats[self.cur_nameserver]["timeoutcnt"] += 1
+        return
+    
+    def _handleFailure(self, exc, nameserver, addr, start):
+        """
+        Books a failed lookup in the job and nameserver stats and returns the string that gets stored instead of a PTR.
+        NXDOMAIN and NODATA count as proper answers. Anything unexpected is re-raised.
+        """
+        if isinstance(exc, dns.resolver.NXDOMAIN):
+            log.debug("%s -> NXDOMAIN", addr)
+            self._countResolved(nameserver, datetime.datetime.now() - start, nxdomain=True)
+            return "NXDOMAIN"
+        if isinstance(exc, dns.resolver.NoAnswer):
+            log.debug("%s -> NODATA", addr)
+            self._countResolved(nameserver, datetime.datetime.now() - start)
+            return "NODATA"
+        if isinstance(exc, Timeout): #no answer within lifetime. This is often not the fault of the open resolver. 
+            log.warning("Timeout occured @%s querying %s", nameserver, addr)
+            self.nameserver_stats[nameserver]["timeoutcnt"] += 1
             self.jobstats["timeoutcnt"] += 1
-            data = "TIMEOUT"
-        except CommException: 
-            log.warning("CommuException occured @%s querying %s", self.cur_nameserver, addr)
-            self.nameserver_stats[self.cur_nameserver]["errcnt"] += 1
+            return "TIMEOUT"
+        if isinstance(exc, CommException):
+            log.warning("CommuException occured @%s querying %s", nameserver, addr)
+            self.nameserver_stats[nameserver]["errcnt"] += 1
             self.jobstats["errcnt"] += 1
-            data = "ERROR"
-            if self.nameserver_stats[self.cur_nameserver]["errcnt"] > LocalWorker.COMMERR_TRESH:
-                log.warning("Comm error count for %s exceeded threshold", self.cur_nameserver)
-                self._switchDNS()
-        except SERVFAIL:
-            log.warning("SERVFAIL received @%s querying %s", self.cur_nameserver, addr)
-            self.nameserver_stats[self.cur_nameserver]["servfailcnt"] += 1
+            return "ERROR"
+        if isinstance(exc, SERVFAIL):
+            log.warning("SERVFAIL received @%s querying %s", nameserver, addr)
+            self.nameserver_stats[nameserver]["servfailcnt"] += 1
             self.jobstats["servfailcnt"] += 1
-            data = "SERVFAIL"
-        except Exception as exc:
-            log.error("Uncaught exception: %s", repr(exc))
-            raise exc
-        
-        log.debug("Got %s", data)
-        return data
+            return "SERVFAIL"
+        log.error("Uncaught exception: %s", repr(exc))
+        raise exc
     
-    def query(self, qname, nameserver, tcp=False):
+    def _checkResponse(self, wire, nameserver, direct=False, lookup=True):
         """
-        Rip from the dns.resolver.query so that I can differntiate between SERVFAIL responses and connection problems. 
+        Turns a reply into an Answer, or the exception for what went wrong. With direct, the reply is from an
+        authoritative server and can be a referral (see delegation, also for lookup).
         """
-        source_port=0
-        source=None
-        qname = dns.name.from_text(qname, None)
-        rdtype = dns.rdatatype.from_text("PTR")
-        rdclass = dns.rdataclass.from_text(dns.rdataclass.IN)
-        request = dns.message.make_query(qname, rdtype, rdclass)
-        request.use_edns(self.resolver.edns, self.resolver.ednsflags, self.resolver.payload)
-        if self.resolver.flags is not None:
-            request.flags = self.resolver.flags
-        response = None
-        timeout = self.resolver.timeout
-        try:
-            if tcp:
-                response = dns.query.tcp(request, nameserver,
-                                         timeout, self.resolver.port,
-                                         source=source,
-                                         source_port=source_port)
-            else:
-                response = dns.query.udp(request, nameserver,
-                                         timeout, self.resolver.port,
-                                         source=source,
-                                         source_port=source_port)
-                if response.flags & dns.flags.TC:
-                    # Response truncated; retry with TCP.
-                    timeout = self.resolver.timeout
-                    response = dns.query.tcp(request, nameserver,
-                                           timeout, self.resolver.port,
-                                           source=source,
-                                           source_port=source_port)
-        
-        except (socket.error, dns.query.UnexpectedSource, dns.exception.FormError, EOFError):
-            # These all indicate comm problem with this nameserver. 
-            raise CommException
-            
+        response = self.delegations.check(wire, lookup=lookup) if direct else None
+        if response is None:
+            try:
+                response = dns.message.from_wire(wire)
+            except dns.exception.FormError:
+                raise CommException
         rcode = response.rcode()
-        if rcode == dns.rcode.YXDOMAIN:
-            raise dns.resolver.YXDOMAIN
         if rcode == dns.rcode.NXDOMAIN:
             raise dns.resolver.NXDOMAIN
         if rcode == dns.rcode.SERVFAIL:
             raise SERVFAIL
-                
-        answer = dns.resolver.Answer(qname, rdtype, rdclass, response, True)
+        if rcode != dns.rcode.NOERROR:
+            # REFUSED (a resolver throttling us, most likely), NOTIMP, FORMERR, ...: worth asking another one
+            raise CommException
+        qname = response.question[0].name
+        answer = dns.resolver.Answer(qname, dns.rdatatype.PTR, dns.rdataclass.IN, response, nameserver)
+        if answer.rrset is None:
+            raise dns.resolver.NoAnswer(response=response)
         return answer
-        
-    def _switchDNS(self):
-        if self.cur_nameserver:
-            log.info("Abandoning nameserver %s, stats: %s", self.cur_nameserver, repr(self.nameserver_stats[self.cur_nameserver]))
-            self.nameserver_stats[self.cur_namserver]["good"] = False
-        available = [ns for ns in self.nameserver_stats if self.nameserver_stats[ns]["good"]]
-        if not len(available):
-            log.warning("No more available nameservers")
-            raise Exception("No more available nameservers")
-        
-        self.cur_nameserver = available[0]
-        self.nameserver_stats[self.cur_nameserver].update({"timeoutcnt":0, 
-                         "resolvecnt":0,
-                         "nxdcnt":0,
-                         "tot_duration":datetime.timedelta(0),
-                         "errcnt":0})
-        log.info("Switched to nameserver %s", self.cur_nameserver)
-        return True
+    
+    def query(self, ipint, nameserver, tcp=False, direct=False):
+        """
+        Rip from the dns.resolver.query so that I can differntiate between SERVFAIL responses and connection problems. 
+        Goes through the worker's long-lived sockets instead of a fresh socket per lookup.
+        """
+        try:
+            wire = self._transport.query(ipint, nameserver, self.scheduler.timeout(nameserver), tcp=tcp)
+        except (socket.error, EOFError):
+            # These all indicate comm problem with this nameserver. 
+            raise CommException
+        return self._checkResponse(wire, nameserver, direct=direct)
         
     def __repr__(self):
         raise NotImplementedError()
@@ -178,48 +430,111 @@ class Worker():
 class LocalWorker(Worker, threading.Thread):
     workers = []
     SMAX_RESULTBATCH = 1024
+    # Seconds to wait for a job before checking whether to stop
+    FETCH_TIMEOUT = 10
     
-    def __init__(self, c2server, nameservers=None, use_tcp=False, **kwargs):
+    def __init__(self, c2server, nameservers=None, use_tcp=False, port=None, ns_qps=None, retries=Worker.RETRIES, probe_zones=True, limiter=None,
+                 recursive=False, roots=None, **kwargs):
         threading.Thread.__init__(self, daemon=False, **kwargs)
-        Worker.__init__(self, nameservers=nameservers, use_tcp=use_tcp)
+        Worker.__init__(self, nameservers=nameservers, use_tcp=use_tcp, port=port, ns_qps=ns_qps, retries=retries, probe_zones=probe_zones,
+                        limiter=limiter, recursive=recursive, roots=roots)
         LocalWorker.workers.append(self)
         self._c2server = c2server
         return
         
     def run(self):
         log.info("Worker started: %s",repr(self))
-        self.work()
+        try:
+            self.work()
+        finally:
+            self._transport.close()
         
     def _fetchJob(self):
         log.info("fetching new job...")
-        self.current_job = self._c2server.retrieveNewJob()
-        self.jobstats = {"timeoutcnt":0, 
-                         "resolvecnt":0,
-                         "servfailcnt":0,
-                         "nxdcnt":0,
-                         "tot_duration":datetime.timedelta(0),
-                         "errcnt":0}
+        self.current_job = None
+        while not self._stopping.is_set():
+            self.current_job = self._c2server.retrieveNewJob(owner=self.name, timeout=LocalWorker.FETCH_TIMEOUT)
+            if self.current_job:
+                break
+        self.jobstats = Worker._newStats()
+        self.digest = None
+        if self.current_job:
+            self.digest = JobDigest(self.current_job.ipfrom, self.current_job.ipto)
+            resumeat = self._resumePoint()
+            if resumeat > self.current_job.ipfrom:
+                self.digest.resume(self.current_job.digest, self.current_job.ptr_count, resumeat)
         log.info("Got new job: %s", repr(self.current_job))
         return self.current_job
     
+    def _releaseJob(self):
+        log.info("Giving back unfinished job %s", repr(self.current_job))
+        self._c2server.releaseJob(self.current_job)
+        self.current_job = None
+        return
+    
     def _workJob(self):
+        """
+        Sweeps the current job from its resume point on. Returns False if the worker was stopped before the end.
+        """
         self.current_job.started = datetime.datetime.now()
-        log.info("Working %s", repr(self.current_job))
+        resumeat = self._resumePoint()
+        if resumeat > self.current_job.ipfrom:
+            log.info("Resuming %s at %s", repr(self.current_job), handy.intToIp(resumeat))
+        else:
+            log.info("Working %s", repr(self.current_job))
         results = []
-        for i in range(self.current_job.ipfrom, self.current_job.ipto):
-            ipaddr = handy.intToIp(i)
-            res = self._resolveIP(ipaddr)
-            results.append((i, res))
+        failed = []
+        for (rangefrom, rangeto, delegated) in self._zonePlan(resumeat, self.current_job.ipto):
+            if not delegated:
+                log.info("Skipping undelegated %s-%s", handy.intToIp(rangefrom), handy.intToIp(rangeto - 1))
+                self.jobstats["skipcnt"] += rangeto - rangefrom
+            for i in range(rangefrom, rangeto):
+                res = self._resolveIP(handy.intToIp(i)) if delegated else "NXDOMAIN"
+                results.append((i, res))
+                self.digest.add(i, res)
+                if res in Worker.RETRY_ON:
+                    failed.append((i, res))
+                if len(results) >= LocalWorker.SMAX_RESULTBATCH or self._stopping.is_set():
+                    self._sendResults(results, checkpoint=i + 1)
+                    results = []
+                    if self._stopping.is_set():
+                        log.info("Stopped at %s", handy.intToIp(i + 1))
+                        return False
+        self._sendResults(results, checkpoint=self.current_job.ipto)
+        self._retryFailed(failed)
+        log.info("Work done!")
+        return True
+    
+    def _retryFailed(self, failed):
+        """
+        Gives the addresses of the job that timed out or failed one more go, now that the nameservers' timeouts have settled.
+        Only the ones that got an answer this time are sent again, over the results stored for them before.
+        failed holds (ipint, result) tuples.
+        """
+        if not failed:
+            return
+        log.info("Retrying %d failed addresses...", len(failed))
+        results = []
+        for (i, old) in failed:
+            res = self._resolveIP(handy.intToIp(i), retries=0)
+            if res not in Worker.RETRY_ON:
+                results.append((i, res))
+                self.digest.add(i, res, old=old)
             if len(results) >= LocalWorker.SMAX_RESULTBATCH:
                 self._sendResults(results)
                 results = []
-        self._sendResults(results)
-        log.info("Work done!")
-        return True
+        if results:
+            self._sendResults(results)
+        return
     
-    def _sendResults(self, results):
+    def _sendResults(self, results, checkpoint=None):
+        """
+        Sends a batch of results. With a checkpoint, all addresses of the job before it have their result in this or
+        an earlier batch.
+        """
         log.info("Sending %d results to server... jobstats:%s", len(results), repr(self.jobstats))
-        self._c2server.storeResults(results)
+        self._c2server.storeResults(results, job=self.current_job, checkpoint=checkpoint)
+        self._c2server.renewLease(self.current_job)
         log.info("Results sent!")
         return True
     
@@ -228,6 +543,12 @@ class LocalWorker(Worker, threading.Thread):
         self.current_job.nameserver = self.cur_nameserver
         self.current_job.error_count = self.jobstats["errcnt"] + self.jobstats["timeoutcnt"] + self.jobstats["servfailcnt"]
         self.current_job.nxdomain_count = self.jobstats["nxdcnt"]
+        self.current_job.skipped_count = self.jobstats["skipcnt"]
+        self.current_job.ptr_count = self.digest.ptr_count
+        self.current_job.digest = self.digest.pack()
+        log.info("Nameservers: %s", repr(self.scheduler.summary(learned=False)))
+        if self.scheduler.limiter:
+            log.info("Rate limits: %s", repr(self.scheduler.limiter.summary()))
         log.info("Sending finished job %s to server...", self.current_job)
         self._c2server.finishJob(self.current_job)
         self.current_job = None
@@ -235,4 +556,252 @@ class LocalWorker(Worker, threading.Thread):
     
     def __repr__(self):
         return "<LocalWorker(nameserver={}, name={}, use_tcp={:b})".format(self.cur_nameserver, self.name, self.use_tcp)
-        
\ No newline at end of file
+
+
+class AsyncLocalWorker(LocalWorker):
+    """
+    LocalWorker that keeps a window of PTR queries in flight on its own asyncio event loop instead of resolving one address at a time.
+    Queries are spread over the nameservers by the scheduler, each capped at ns_concurrency outstanding queries.
+    Results are handed to the server in ip order, in the same (ipint, ptr) batches as LocalWorker.
+    """
+    WINDOW = 1024
+    NS_CONCURRENCY = 256
+    
+    def __init__(self, c2server, nameservers=None, use_tcp=False, window=WINDOW, ns_concurrency=NS_CONCURRENCY, **kwargs):
+        LocalWorker.__init__(self, c2server, nameservers=nameservers, use_tcp=use_tcp, **kwargs)
+        self.window = window
+        self.ns_concurrency = ns_concurrency
+        self._ns_semaphores = None
+        self._loop = None
+        self._asynctransport = None
+        return
+    
+    def run(self):
+        log.info("Worker started: %s",repr(self))
+        # One loop for the worker's lifetime, so the transport's sockets outlive the jobs
+        self._loop = asyncio.new_event_loop()
+        self._asynctransport = transport.AsyncTransport(port=self.resolver.port, rtt=self.scheduler.measured)
+        try:
+            self.work()
+        finally:
+            self._loop.run_until_complete(self._asynctransport.close())
+            self._loop.run_until_complete(self._loop.shutdown_default_executor())
+            self._loop.close()
+    
+    def _workJob(self):
+        self.current_job.started = datetime.datetime.now()
+        log.info("Working %s from %s with %d queries in flight", repr(self.current_job), handy.intToIp(self._resumePoint()), self.window)
+        if not self._loop.run_until_complete(self._workJobAsync()):
+            return False
+        log.info("Work done!")
+        return True
+    
+    async def _workJobAsync(self):
+        self._ns_semaphores = {ns:asyncio.Semaphore(self.ns_concurrency) for ns in self.nameservers}
+        window = asyncio.Semaphore(self.window)
+        tasks = set()
+        done = {}
+        results = []
+        failed = []
+        nextip = self._resumePoint()
+        stopped = False
+        
+        async def resolve(ipint):
+            try:
+                done[ipint] = await self._resolveIPAsync(ipint)
+            except Exception as exc:
+                # Every address needs a result, or the ones after it are never sent
+                log.exception("Resolving %s failed: %s", handy.intToIp(ipint), repr(exc))
+                self.jobstats["errcnt"] += 1
+                done[ipint] = "ERROR"
+            finally:
+                window.release()
+            if done[ipint] in Worker.RETRY_ON:
+                failed.append((ipint, done[ipint]))
+        
+        for (rangefrom, rangeto, delegated) in await self._zonePlanAsync(nextip, self.current_job.ipto):
+            if not delegated:
+                log.info("Skipping undelegated %s-%s", handy.intToIp(rangefrom), handy.intToIp(rangeto - 1))
+                self.jobstats["skipcnt"] += rangeto - rangefrom
+            for i in range(rangefrom, rangeto):
+                if delegated:
+                    await window.acquire()
+                    task = asyncio.ensure_future(resolve(i))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                else:
+                    done[i] = "NXDOMAIN"
+                # Move the contiguous run of answered addresses over to the results, so batches go out in ip order
+                while nextip in done:
+                    results.append((nextip, done.pop(nextip)))
+                    self.digest.add(*results[-1])
+                    nextip += 1
+                if len(results) >= LocalWorker.SMAX_RESULTBATCH:
+                    await self._sendResultsAsync(results, checkpoint=nextip)
+                    results = []
+                stopped = self._stopping.is_set()
+                if stopped:
+                    break
+            if stopped:
+                break
+        # When stopping, the queries in flight are still seen through, so nothing gets thrown away
+        if tasks:
+            await asyncio.gather(*tasks)
+        while nextip in done:
+            results.append((nextip, done.pop(nextip)))
+            self.digest.add(*results[-1])
+            nextip += 1
+        await self._sendResultsAsync(results, checkpoint=nextip)
+        if stopped:
+            log.info("Stopped at %s", handy.intToIp(nextip))
+            return False
+        if nextip < self.current_job.ipto:
+            log.error("No results after %s, giving the job back", handy.intToIp(nextip))
+            return False
+        await self._retryFailedAsync(sorted(failed))
+        return True
+    
+    async def _retryFailedAsync(self, failed):
+        """
+        Same as _retryFailed(), with a window of retries in flight.
+        """
+        if not failed:
+            return
+        log.info("Retrying %d failed addresses...", len(failed))
+        window = asyncio.Semaphore(self.window)
+        
+        async def resolve(ipint, old):
+            async with window:
+                try:
+                    return (ipint, old, await self._resolveIPAsync(ipint, retries=0))
+                except Exception as exc:
+                    # Keeps the result stored the first time
+                    log.exception("Retrying %s failed: %s", handy.intToIp(ipint), repr(exc))
+                    return (ipint, old, old)
+        
+        answered = []
+        for (i, old, res) in await asyncio.gather(*[resolve(i, old) for (i, old) in failed]):
+            if res not in Worker.RETRY_ON:
+                answered.append((i, res))
+                self.digest.add(i, res, old=old)
+        for offset in range(0, len(answered), LocalWorker.SMAX_RESULTBATCH):
+            await self._sendResultsAsync(answered[offset:offset + LocalWorker.SMAX_RESULTBATCH])
+        return
+    
+    async def _sendResultsAsync(self, results, checkpoint=None):
+        """
+        _sendResults() in a thread, as it blocks (on a full result queue, the lease update, the C2 server's api) and the
+        queries in flight should not wait for it. Awaited, so batches still go out one after the other.
+        """
+        return await self._loop.run_in_executor(None, self._sendResults, results, checkpoint)
+    
+    def _forgetNameserver(self, nameserver):
+        LocalWorker._forgetNameserver(self, nameserver)
+        # Queries holding it keep their reference
+        if self._ns_semaphores:
+            self._ns_semaphores.pop(nameserver, None)
+        return
+    
+    def _nsSemaphore(self, nameserver):
+        # Authoritative servers come up as they are learned
+        semaphore = self._ns_semaphores.get(nameserver)
+        if semaphore is None:
+            semaphore = self._ns_semaphores[nameserver] = asyncio.Semaphore(self.ns_concurrency)
+        return semaphore
+    
+    async def _pickNameserverAsync(self, exclude=(), among=None):
+        among = self._among(among)
+        while True:
+            (nameserver, wait) = self.scheduler.acquire(exclude=exclude, among=among)
+            if nameserver:
+                self.cur_nameserver = nameserver
+                return nameserver
+            if wait > Worker.DIRECT_WAIT and among is not self.nameservers:
+                among = self.nameservers
+                continue
+            await asyncio.sleep(wait)
+    
+    async def _probeZoneAsync(self, ipint, prefixlen):
+        """
+        Same as _probeZone(), on the worker's event loop.
+        """
+        tried = []
+        while True:
+            nameserver = await self._pickNameserverAsync(exclude=tried)
+            async with self._nsSemaphore(nameserver):
+                start = datetime.datetime.now()
+                try:
+                    wire = await self._asynctransport.query(ipint, nameserver, self.scheduler.timeout(nameserver), tcp=self.use_tcp, prefixlen=prefixlen)
+                except Exception as exc:
+                    wire = exc
+                answer = self._zoneAnswer(wire, nameserver, ipint, prefixlen, start)
+            if answer is not None or len(tried) >= self.retries:
+                return answer
+            tried.append(nameserver)
+    
+    async def _zonePlanAsync(self, ipfrom, ipto):
+        """
+        Same as _zonePlan(), with the /24 probes of a /16 in flight at the same time.
+        """
+        if not self.probe_zones:
+            return [(ipfrom, ipto, True)]
+        plan = []
+        for (zonefrom, zoneto) in _zoneSlices(ipfrom, ipto, 16):
+            if await self._probeZoneAsync(zonefrom, 16) is False:
+                plan.append((zonefrom, zoneto, False))
+                continue
+            subzones = list(_zoneSlices(zonefrom, zoneto, 24))
+            answers = await asyncio.gather(*[self._probeZoneAsync(subfrom, 24) for (subfrom, subto) in subzones])
+            plan.extend((subfrom, subto, answer is not False) for ((subfrom, subto), answer) in zip(subzones, answers))
+        return _mergePlan(plan)
+    
+    async def queryAsync(self, ipint, nameserver, tcp=False, direct=False):
+        """
+        Same as query(), but on the worker's event loop so many lookups can be in flight at once.
+        """
+        try:
+            wire = await self._asynctransport.query(ipint, nameserver, self.scheduler.timeout(nameserver), tcp=tcp)
+        except (socket.error, EOFError):
+            raise CommException
+        try:
+            return self._checkResponse(wire, nameserver, direct=direct, lookup=False)
+        except delegation.MissingGlue as exc:
+            # Looked up in threads, not to block the loop
+            loop = asyncio.get_running_loop()
+            await asyncio.gather(*[loop.run_in_executor(None, self.delegations.hostAddresses, host) for host in exc.hosts])
+        return self._checkResponse(wire, nameserver, direct=direct, lookup=False)
+    
+    async def _resolveIPAsync(self, ipint, retries=None):
+        addr = handy.intToIp(ipint)
+        log.debug("Resolving %s...", addr)
+        retries = self.retries if retries is None else retries
+        tried = []
+        direct = self.delegations is not None
+        referrals = 0
+        while True:
+            nameserver = await self._pickNameserverAsync(exclude=tried, among=self.delegations.servers(ipint) if direct else None)
+            async with self._nsSemaphore(nameserver):
+                start = datetime.datetime.now()
+                late = False
+                try:
+                    data = (await self.queryAsync(ipint, nameserver, tcp=self.use_tcp, direct=direct))[0].to_text()
+                except (delegation.Referral, delegation.Unresolvable) as exc:
+                    direct = self._followReferral(exc, nameserver, addr, start, referrals)
+                    referrals += 1
+                    continue
+                except Exception as exc:
+                    data = self._handleFailure(exc, nameserver, addr, start)
+                    late = isinstance(exc, transport.LateTimeout)
+                else:
+                    self._countResolved(nameserver, datetime.datetime.now() - start)
+                self._report(nameserver, start, data, late=late)
+            if data not in Worker.RETRY_ON or len(tried) >= retries:
+                break
+            tried.append(nameserver)
+            self.jobstats["retrycnt"] += 1
+        
+        log.debug("Got %s", data)
+        return data
+    
+    def __repr__(self):
+        return "<AsyncLocalWorker(window={}, name={}, use_tcp={:b})".format(self.window, self.name, self.use_tcp)
@@ -0,0 +1,173 @@
+"""
+The C2Server on temporary SQLite dbs.
+"""
+import datetime
+import ipaddress
+import time
+
+import pytest
+
+from rdnsmonitor import JobdbSession, ResultdbSession
+from rdnsmonitor import handy
+from rdnsmonitor import monitor
+from rdnsmonitor import storage
+from rdnsmonitor.dbobjects import Job
+
+START_IP = 2**24
+ADDRESSES = 512
+
+
+def _makeServer(tmp_path, addresses=ADDRESSES, **config):
+    return monitor.C2Server(newjobsdb=True,
+                            jobsdb_url="sqlite:///" + str(tmp_path / "jobs.db"),
+                            resultsdb_url="sqlite:///" + str(tmp_path / "results.db"),
+                            start_ip=handy.intToIp(START_IP), end_ip=handy.intToIp(START_IP + addresses),
+                            block_size=ADDRESSES // 2, exclude="", **config)
+
+
+def _stop(server):
+    server.shutdown()
+    JobdbSession.remove()
+    ResultdbSession.remove()
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = _makeServer(tmp_path)
+    yield server
+    _stop(server)
+
+
+def test_job_blocks(tmp_path):
+    # Overlapping, unaligned, adjoining, right before the space and across its end
+    exclude = ["0.255.255.0/24", "1.0.1.0/24", "1.0.1.128/25", "1.0.3.7/32", "1.0.3.8/29", "1.0.7.0/24", "1.0.8.0/24", "1.0.15.0/24"]
+    server = monitor.C2Server(newjobsdb=True,
+                              jobsdb_url="sqlite:///" + str(tmp_path / "jobs.db"),
+                              resultsdb_url="sqlite:///" + str(tmp_path / "results.db"),
+                              start_ip=handy.intToIp(START_IP), end_ip=handy.intToIp(START_IP + 4000),
+                              block_size=100, exclude=",".join(exclude))
+    try:
+        blocks = JobdbSession().query(Job.ipfrom, Job.ipto).order_by(Job.ipfrom).all()
+    finally:
+        _stop(server)
+    networks = [ipaddress.ip_network(cidr) for cidr in exclude]
+    allowed = [ipint for ipint in range(START_IP, START_IP + 4000) if not any(ipaddress.ip_address(ipint) in net for net in networks)]
+    covered = [ipint for (ipfrom, ipto) in blocks for ipint in range(ipfrom, ipto)]
+    # Every allowed address exactly once, in order, and nothing else
+    assert covered == allowed
+    for (ipfrom, ipto) in blocks:
+        assert ipfrom < ipto
+        # within one block_size block, counted from start_ip
+        assert (ipfrom - START_IP) // 100 == (ipto - 1 - START_IP) // 100
+
+
+def _store(server, job, ipfrom, ipto, checkpoint=True):
+    server.storeResults([(ipint, "NXDOMAIN") for ipint in range(ipfrom, ipto)], job=job, checkpoint=ipto if checkpoint else None)
+    server._resultwriter.flush()
+
+
+def _checkpoint(server, job):
+    return JobdbSession().query(Job.checkpoint, Job.lease_owner).filter(Job.id == job.id).one()
+
+
+def _lease(server, job):
+    session = JobdbSession()
+    session.query(Job).filter(Job.id == job.id).update({"lease_owner":job.lease_owner})
+    session.commit()
+
+
+def test_lost_batch(server, monkeypatch):
+    job = server.retrieveNewJob(owner="tester", timeout=1)
+    write = storage.writeResults
+    def failing(engine, rows, batch_size):
+        if any(ipint == job.ipfrom + 128 for (ipint, result) in rows):
+            raise IOError("disk full")
+        return write(engine, rows, batch_size)
+    monkeypatch.setattr(storage, "writeResults", failing)
+    _store(server, job, job.ipfrom, job.ipfrom + 128)
+    _store(server, job, job.ipfrom + 128, job.ipfrom + 192)
+    _store(server, job, job.ipfrom + 192, job.ipto)
+    assert _checkpoint(server, job) == (job.ipfrom + 128, job.lease_owner)
+    job.started = job.completed = job.retrieved
+    assert not server.finishJob(job)
+    assert _checkpoint(server, job) == (job.ipfrom + 128, None)
+    # Done again, by the next worker to get it
+    monkeypatch.setattr(storage, "writeResults", write)
+    job.lease_owner = "tester2"
+    _lease(server, job)
+    _store(server, job, job.ipfrom + 128, job.ipto)
+    assert server.finishJob(job)
+    assert monitor.jobCounts(server._jobsdb)["completed"] == 1
+
+
+def test_lost_retries(server, monkeypatch):
+    job = server.retrieveNewJob(owner="tester", timeout=1)
+    _store(server, job, job.ipfrom, job.ipto)
+    monkeypatch.setattr(storage, "writeResults", lambda engine, rows, batch_size: 1 / 0)
+    _store(server, job, job.ipfrom + 10, job.ipfrom + 20, checkpoint=False)
+    # The checkpoint goes back to before them
+    assert _checkpoint(server, job) == (job.ipfrom + 10, job.lease_owner)
+    assert not server.finishJob(job)
+
+
+def _queued(server, count):
+    deadline = time.monotonic() + 5
+    while server._jobqueue.qsize() < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return [job.id for job in list(server._jobqueue.queue)]
+
+
+def test_lapsed_claims(tmp_path, caplog):
+    server = _makeServer(tmp_path, addresses=32 * ADDRESSES // 2, lease_time=1, job_prefetch=8)
+    try:
+        first = _queued(server, 8)
+        # The claims on the queued jobs run out before any worker comes along
+        time.sleep(1.1)
+        server.watchdog()
+        assert "expired lease" not in caplog.text
+        taken = [server.retrieveNewJob(owner="tester", timeout=1).id for _ in range(4)]
+        queued = _queued(server, 8)
+        assert taken == first[:4]
+        assert queued[:4] == first[4:]
+        assert len(set(queued)) == 8 and not set(queued) & set(taken)
+    finally:
+        _stop(server)
+
+
+def test_finish_not_leased(server):
+    job = server.retrieveNewJob(owner="tester", timeout=1)
+    job.lease_owner = "someone else"
+    job.started = job.completed = job.retrieved
+    assert not server.finishJob(job)
+    assert monitor.jobCounts(server._jobsdb)["completed"] == 0
+
+
+def test_lease_token(server):
+    job = server.retrieveNewJob(owner="Worker1", timeout=1)
+    assert job.lease_owner.startswith("Worker1/")
+    # Another Worker1, somewhere else
+    other = Job(id=job.id, lease_owner="Worker1")
+    assert not server.renewLease(other)
+    assert server.renewLease(job)
+
+
+def test_reset_due(server):
+    # The prefetcher would reset the jobs itself
+    server._stopping.set()
+    server._refill.set()
+    server._prefetcher.join(5)
+    now = datetime.datetime.now()
+    session = JobdbSession()
+    (first, second) = [job.id for job in session.query(Job).order_by(Job.id)]
+    # Finished before due dates were kept, and finished with one
+    session.query(Job).filter(Job.id == first).update({"completed":now - datetime.timedelta(days=2), "due":None})
+    session.query(Job).filter(Job.id == second).update({"completed":now - datetime.timedelta(days=3), "due":now - datetime.timedelta(days=1)})
+    session.commit()
+    monitor._backfillDue(server._jobsdb)
+    assert session.query(Job.due).filter(Job.id == first).scalar() == now - datetime.timedelta(days=2)
+    # The most overdue first, and reset jobs are not due anymore
+    assert server._resetOldJobs(1) == 1
+    assert session.query(Job.completed, Job.due).filter(Job.id == first).one() == (None, None)
+    assert session.query(Job.completed).filter(Job.id == second).scalar() is not None
+    assert monitor.jobCounts(server._jobsdb)["due"] == 1
+    session.close()
@@ -0,0 +1,54 @@
+"""
+The nameserver scheduler, on made up outcomes.
+"""
+from rdnsmonitor.nsscheduler import NameserverScheduler
+
+NAMESERVERS = ["10.0.0.1", "10.0.0.2", "10.0.0.3"]
+
+
+def test_all_failing():
+    scheduler = NameserverScheduler(NAMESERVERS)
+    for _ in range(10 * NameserverScheduler.MIN_SAMPLES):
+        for ns in NAMESERVERS:
+            scheduler.report(ns, 1.0, "TIMEOUT")
+    assert len(scheduler.healthy()) == 1
+    for _ in range(10):
+        assert scheduler.acquire() == (scheduler.healthy()[0], 0)
+
+
+def test_all_comm_errors():
+    scheduler = NameserverScheduler(NAMESERVERS, commerr_tresh=3)
+    for _ in range(10):
+        for ns in NAMESERVERS:
+            scheduler.report(ns, 0.01, "ERROR")
+    assert len(scheduler.healthy()) == 1
+
+
+def test_learned_failing():
+    # Authoritative servers are not kept around for the queries' sake: the configured nameservers take over
+    scheduler = NameserverScheduler(NAMESERVERS[:1])
+    scheduler.acquire(among=NAMESERVERS[1:])
+    for _ in range(NameserverScheduler.MIN_SAMPLES):
+        for ns in NAMESERVERS[1:]:
+            scheduler.report(ns, 1.0, "TIMEOUT")
+    assert scheduler.healthy() == NAMESERVERS[:1]
+
+
+def test_retry_with_one_benched():
+    scheduler = NameserverScheduler(NAMESERVERS[:2])
+    for _ in range(NameserverScheduler.MIN_SAMPLES):
+        scheduler.report(NAMESERVERS[0], 1.0, "TIMEOUT")
+    assert scheduler.healthy() == NAMESERVERS[1:2]
+    # The retry of a query that failed on the healthy one goes there again, rather than wait for the benched one
+    assert scheduler.acquire(exclude=NAMESERVERS[1:2]) == (NAMESERVERS[1], 0)
+
+
+def test_timeout():
+    scheduler = NameserverScheduler(NAMESERVERS)
+    assert scheduler.timeout(NAMESERVERS[0]) == scheduler.max_timeout
+    for _ in range(100):
+        scheduler.measured(NAMESERVERS[0], 0.3)
+    # Steady round trips: twice SRTT
+    assert abs(scheduler.timeout(NAMESERVERS[0]) - 0.6) < 0.01
+    scheduler.measured(NAMESERVERS[1], 0.001)
+    assert scheduler.timeout(NAMESERVERS[1]) == NameserverScheduler.MIN_TIMEOUT
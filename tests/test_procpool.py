@@ -0,0 +1,34 @@
+"""
+The pipe between a worker process's C2 proxy and the parent's C2Server.
+"""
+import multiprocessing
+import threading
+
+import pytest
+
+from rdnsmonitor import procpool
+from rdnsmonitor.dbobjects import Job
+
+
+class FailingServer(object):
+
+    def storeResults(self, results, job=None, checkpoint=None):
+        raise IOError("result queue closed")
+
+    def renewLease(self, job):
+        return True
+
+
+def test_store_error():
+    (parent, child) = multiprocessing.Pipe()
+    server = threading.Thread(target=procpool._serve, args=(FailingServer(), parent), daemon=True)
+    server.start()
+    proxy = procpool._PipeC2Proxy(child)
+    job = Job(id=1, ipfrom=2**24, ipto=2**24 + 256, lease_owner="Worker1/token")
+    with pytest.raises(IOError):
+        proxy.storeResults([(2**24, "NXDOMAIN")], job=job, checkpoint=2**24 + 1)
+    # and the parent is still serving
+    assert proxy.renewLease(job) is True
+    child.close()
+    server.join(5)
+    assert not server.is_alive()
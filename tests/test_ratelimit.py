@@ -0,0 +1,98 @@
+"""
+RateLimiter and its token buckets, on a clock the tests step by hand.
+"""
+import pytest
+
+from rdnsmonitor import ratelimit
+from rdnsmonitor.nsscheduler import NameserverScheduler
+from rdnsmonitor.ratelimit import RateLimiter
+
+NS = ["192.0.2.1", "192.0.2.2"]
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def step(self, seconds):
+        self.now += seconds
+        return
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+def test_shared_bucket(clock):
+    limiter = RateLimiter(qps=4, burst=2, nameservers=NS, clock=clock)
+    assert limiter.acquire(NS[0]) == 0
+    assert limiter.acquire(NS[1]) == 0
+    # Both servers drew from the one bucket
+    assert limiter.acquire(NS[0]) == 0.25
+    clock.step(0.125)
+    assert limiter.acquire(NS[1]) == 0.125
+    clock.step(0.125)
+    assert limiter.acquire(NS[1]) == 0
+    assert limiter.acquire(NS[0]) == 0.25
+    # Saving up stops at burst
+    clock.step(10)
+    assert [limiter.acquire(NS[0]) for _ in range(3)] == [0, 0, 0.25]
+
+
+def test_nameserver_buckets(clock):
+    limiter = RateLimiter(qps=4, ns_qps=2, burst=1, nameservers=NS, clock=clock)
+    assert limiter.acquire(NS[0]) == 0
+    assert limiter.acquire(NS[0]) == 0.5
+    # The other server has a bucket of its own, but the global one is empty
+    assert limiter.acquire(NS[1]) == 0.25
+    clock.step(0.25)
+    # and a query held back by the global bucket gave the server's token back
+    assert limiter.acquire(NS[1]) == 0
+    assert limiter.acquire(NS[0]) == 0.25
+    clock.step(0.25)
+    assert limiter.acquire(NS[0]) == 0
+
+
+def test_backoff(clock):
+    limiter = RateLimiter(ns_qps=100, burst=1, nameservers=NS, clock=clock)
+    for _ in range(100):
+        limiter.report(NS[0], "TIMEOUT")
+    # Halved only once per BACKOFF_INTERVAL
+    assert limiter.summary() == {"all":"100%", NS[0]:"50%"}
+    clock.step(ratelimit.TokenBucket.BACKOFF_INTERVAL)
+    limiter.report(NS[0], "ERROR")
+    assert limiter.summary() == {"all":"100%", NS[0]:"25%"}
+    assert limiter.acquire(NS[0]) == 0
+    assert limiter.acquire(NS[0]) == pytest.approx(1 / 25)
+    # Not a bit back while the errors are still between half the threshold and the threshold
+    for _ in range(50):
+        limiter.report(NS[0], "NXDOMAIN")
+    assert limiter.summary() == {"all":"100%", NS[0]:"25%"}
+    for _ in range(100):
+        limiter.report(NS[0], "NXDOMAIN")
+    factor = float(limiter.summary()[NS[0]].rstrip("%"))
+    assert 25 < factor < 100
+    for _ in range(200):
+        limiter.report(NS[0], "NXDOMAIN")
+    assert limiter.summary() == {"all":"100%"}
+    assert limiter.acquire(NS[1]) == 0
+
+
+def test_learned_labels(monkeypatch):
+    monkeypatch.setattr(ratelimit.WAITS, "_values", {})
+    monkeypatch.setattr(ratelimit.BACKOFFS, "_values", {})
+    limiter = RateLimiter(ns_qps=1, nameservers=["192.0.2.1"])
+    scheduler = NameserverScheduler(["192.0.2.1"], limiter=limiter)
+    # Two authoritative servers, learned on the way
+    for ns in ["192.0.2.1", "198.51.100.1", "198.51.100.2"]:
+        assert scheduler.acquire(among=[ns])[0] == ns
+        assert scheduler.acquire(among=[ns])[0] is None
+        for _ in range(100):
+            scheduler.report(ns, 0.1, "TIMEOUT")
+    assert set(ratelimit.WAITS._values) == {("192.0.2.1",), (ratelimit.AUTHORITATIVE,)}
+    assert set(ratelimit.BACKOFFS._values) == {("192.0.2.1",), (ratelimit.AUTHORITATIVE,)}
@@ -0,0 +1,106 @@
+"""
+Smoke test of remote mode on localhost: a C2Api in front of a C2Server with temporary SQLite dbs, and a client or a
+RemoteWorker (against the benchmarks' fake DNS server) going through lease, results and finish.
+"""
+import os
+import sys
+import time
+
+import dns.resolver
+import pytest
+
+from rdnsmonitor import JobdbSession, ResultdbSession
+from rdnsmonitor import handy
+from rdnsmonitor import monitor
+from rdnsmonitor import remote
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "benchmarks"))
+from fakedns import FakeDNSServer, freePort
+
+START_IP = 2**24
+ADDRESSES = 512
+
+
+@pytest.fixture
+def api(tmp_path, monkeypatch):
+    # Workers that ask for a job when there is none should not wait long for that
+    monkeypatch.setattr(remote, "LEASE_WAIT", 1)
+    # and a failing call should fail the test rather than be retried for minutes
+    monkeypatch.setattr(remote.C2Client, "RETRIES", 1)
+    server = monitor.C2Server(newjobsdb=True,
+                              jobsdb_url="sqlite:///" + str(tmp_path / "jobs.db"),
+                              resultsdb_url="sqlite:///" + str(tmp_path / "results.db"),
+                              start_ip=handy.intToIp(START_IP), end_ip=handy.intToIp(START_IP + ADDRESSES),
+                              block_size=ADDRESSES // 2, exclude="")
+    api = remote.C2Api(server, host="127.0.0.1", port=freePort())
+    api.start()
+    api.url = "http://127.0.0.1:{:d}".format(api._httpd.server_address[1])
+    yield api
+    api.stop()
+    server.shutdown()
+    # The sessions are per process: unbind them from this test's dbs
+    JobdbSession.remove()
+    ResultdbSession.remove()
+
+
+def _stored(server):
+    server._resultwriter.close()
+    return server._resultwriter.stored + server._resultwriter.unchanged
+
+
+def test_client(api):
+    client = remote.C2Client(api.url)
+    job = client.retrieveNewJob(owner="tester", timeout=1)
+    assert job.ipfrom == START_IP
+    results = [(ipint, "NXDOMAIN" if ipint % 2 else "host{:d}.example.".format(ipint)) for ipint in range(job.ipfrom, job.ipto)]
+    assert client.uploadResults(job, results, checkpoint=job.ipto)
+    job.completed = job.started = job.retrieved
+    assert client.finishJob(job)
+    assert _stored(api.c2server) == len(results)
+
+
+def test_client_other_lease(api):
+    client = remote.C2Client(api.url)
+    job = client.retrieveNewJob(owner="Worker1", timeout=1)
+    # A Worker1 on another host
+    job.lease_owner = "Worker1"
+    assert not client.uploadResults(job, [(job.ipfrom, "NXDOMAIN")], checkpoint=job.ipfrom + 1)
+    job.completed = job.started = job.retrieved
+    assert not client.finishJob(job)
+    assert _stored(api.c2server) == 0
+
+
+def test_worker(api):
+    fake = FakeDNSServer(["127.0.0.1"], latency=0.001)
+    fake.start()
+    resolver = dns.resolver.default_resolver
+    dns.resolver.default_resolver = dns.resolver.Resolver(configure=False)
+    dns.resolver.default_resolver.nameservers = ["127.0.0.1"]
+    try:
+        worker = remote.RemoteWorker(api.url, name="Worker1", nameservers=[], port=fake.port)
+        worker.start()
+        deadline = time.monotonic() + 60
+        while monitor.jobCounts(api.c2server._jobsdb)["completed"] < 2 and time.monotonic() < deadline:
+            time.sleep(0.2)
+        worker.stop()
+        worker.join()
+    finally:
+        dns.resolver.default_resolver = resolver
+        fake.stop()
+    assert monitor.jobCounts(api.c2server._jobsdb)["completed"] == 2
+    assert _stored(api.c2server) == ADDRESSES
+
+
+def test_restart_after_sweep(api):
+    """
+    A server restarted when every job is completed and none is due yet must not add the job space again.
+    """
+    server = api.c2server
+    client = remote.C2Client(api.url)
+    for _ in range(2):
+        job = client.retrieveNewJob(owner="tester", timeout=1)
+        job.completed = job.started = job.retrieved
+        client.finishJob(job)
+    assert monitor.jobCounts(server._jobsdb)["completed"] == 2
+    server._initJobsDb(False)
+    assert monitor.jobCounts(server._jobsdb) == {"jobs":2, "completed":2, "open":0, "leased":0, "due":0}
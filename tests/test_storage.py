@@ -0,0 +1,96 @@
+"""
+writeResults() repainting status ranges, and what it records in ptrchanges, on a temporary SQLite results db.
+"""
+import datetime
+
+import pytest
+import sqlalchemy
+from sqlalchemy import select
+
+from rdnsmonitor import storage
+from rdnsmonitor.dbobjects import ResultBase, PTRChange, StatusRange, decodeResult
+
+SWEEPS = [datetime.datetime(2024, 1, day) for day in range(1, 6)]
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = sqlalchemy.create_engine("sqlite:///" + str(tmp_path / "results.db"))
+    ResultBase.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+def _write(engine, ipfrom, ipto, result, seen):
+    return storage.writeResults(engine, [(ipint, result) for ipint in range(ipfrom, ipto)], 100, seen=seen)
+
+def _ranges(engine):
+    table = StatusRange.__table__
+    with engine.connect() as conn:
+        return [(ipfrom, ipto, decodeResult(status, None), first_seen)
+                for (ipfrom, ipto, status, first_seen) in conn.execute(select(table.c.ipfrom, table.c.ipto, table.c.status, table.c.first_seen)
+                                                                        .order_by(table.c.ipfrom))]
+
+def _changes(engine):
+    table = PTRChange.__table__
+    with engine.connect() as conn:
+        return [(ip, ipto, decodeResult(status, ptr), first_seen, last_seen)
+                for (ip, ipto, status, ptr, first_seen, last_seen) in conn.execute(select(table.c.ip, table.c.ipto, table.c.status, table.c.ptr,
+                                                                                          table.c.first_seen, table.c.last_seen)
+                                                                                   .order_by(table.c.id))]
+
+
+def test_overlapping_writes(engine):
+    _write(engine, 100, 200, "NXDOMAIN", SWEEPS[0])
+    _write(engine, 150, 160, "TIMEOUT", SWEEPS[1])
+    assert _ranges(engine) == [(100, 150, "NXDOMAIN", SWEEPS[0]), (150, 160, "TIMEOUT", SWEEPS[1]), (160, 200, "NXDOMAIN", SWEEPS[0])]
+    # Over both ends of the hole
+    _write(engine, 140, 170, "SERVFAIL", SWEEPS[2])
+    assert _ranges(engine) == [(100, 140, "NXDOMAIN", SWEEPS[0]), (140, 170, "SERVFAIL", SWEEPS[2]), (170, 200, "NXDOMAIN", SWEEPS[0])]
+    assert _changes(engine) == [(150, 160, "NXDOMAIN", SWEEPS[0], SWEEPS[1]),
+                                (140, 150, "NXDOMAIN", SWEEPS[0], SWEEPS[2]),
+                                (150, 160, "TIMEOUT", SWEEPS[1], SWEEPS[2]),
+                                (160, 170, "NXDOMAIN", SWEEPS[0], SWEEPS[2])]
+    assert storage.lookupResults(engine, 139, 141) == [(139, "NXDOMAIN"), (140, "SERVFAIL")]
+
+
+def test_joining_neighbours(engine):
+    _write(engine, 0, 10, "NXDOMAIN", SWEEPS[0])
+    _write(engine, 20, 30, "NXDOMAIN", SWEEPS[1])
+    _write(engine, 10, 20, "TIMEOUT", SWEEPS[1])
+    assert [r[:3] for r in _ranges(engine)] == [(0, 10, "NXDOMAIN"), (10, 20, "TIMEOUT"), (20, 30, "NXDOMAIN")]
+    # Filling the gap joins all three, since the earliest of them
+    _write(engine, 10, 20, "NXDOMAIN", SWEEPS[2])
+    assert _ranges(engine) == [(0, 30, "NXDOMAIN", SWEEPS[0])]
+    assert _changes(engine) == [(10, 20, "TIMEOUT", SWEEPS[1], SWEEPS[2])]
+
+
+def test_range_edges(engine):
+    _write(engine, 100, 200, "NXDOMAIN", SWEEPS[0])
+    # Right after and right before the range extend it
+    _write(engine, 200, 201, "NXDOMAIN", SWEEPS[1])
+    _write(engine, 99, 100, "NXDOMAIN", SWEEPS[1])
+    assert _ranges(engine) == [(99, 201, "NXDOMAIN", SWEEPS[0])]
+    # The first and the last address cut off one
+    _write(engine, 99, 100, "TIMEOUT", SWEEPS[2])
+    _write(engine, 200, 201, "ERROR", SWEEPS[2])
+    assert _ranges(engine) == [(99, 100, "TIMEOUT", SWEEPS[2]), (100, 200, "NXDOMAIN", SWEEPS[0]), (200, 201, "ERROR", SWEEPS[2])]
+    # and the same status again changes nothing
+    _write(engine, 100, 101, "NXDOMAIN", SWEEPS[3])
+    _write(engine, 199, 200, "NXDOMAIN", SWEEPS[3])
+    assert _ranges(engine)[1] == (100, 200, "NXDOMAIN", SWEEPS[0])
+    assert _changes(engine) == [(99, 100, "NXDOMAIN", SWEEPS[0], SWEEPS[2]), (200, 201, "NXDOMAIN", SWEEPS[0], SWEEPS[2])]
+
+
+def test_changes(engine):
+    _write(engine, 0, 10, "NXDOMAIN", SWEEPS[0])
+    storage.writeResults(engine, [(4, "a.example."), (5, "b.example.")], 100, seen=SWEEPS[1])
+    assert [r[:3] for r in _ranges(engine)] == [(0, 4, "NXDOMAIN"), (6, 10, "NXDOMAIN")]
+    # A changed PTR, and a PTR that is gone (the result writer leaves out results that did not change, see ChangeIndex)
+    storage.writeResults(engine, [(5, "c.example.")], 100, seen=SWEEPS[2])
+    storage.writeResults(engine, [(5, "NXDOMAIN")], 100, seen=SWEEPS[3])
+    assert _changes(engine) == [(4, 6, "NXDOMAIN", SWEEPS[0], SWEEPS[1]),
+                                (5, None, "b.example.", SWEEPS[1], SWEEPS[2]),
+                                (5, None, "c.example.", SWEEPS[2], SWEEPS[3])]
+    assert [r[:3] for r in _ranges(engine)] == [(0, 4, "NXDOMAIN"), (5, 10, "NXDOMAIN")]
+    assert storage.lookupResults(engine, 3, 6) == [(3, "NXDOMAIN"), (4, "a.example."), (5, "NXDOMAIN")]
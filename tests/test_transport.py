@@ -0,0 +1,85 @@
+"""
+The transports against nameservers that never answer, or the benchmarks' fake DNS server.
+"""
+import asyncio
+import os
+import socket
+import sys
+import time
+
+import dns.exception
+import pytest
+
+from rdnsmonitor import transport
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "benchmarks"))
+from fakedns import FakeDNSServer
+
+NAMESERVERS = ["127.0.0.{}".format(i) for i in range(1, 5)]
+
+
+@pytest.fixture
+def port():
+    # Takes the queries, never answers
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("0.0.0.0", 0))
+    yield sock.getsockname()[1]
+    sock.close()
+
+
+def test_async_channels(port):
+    async def run():
+        channels = transport.AsyncTransport(port=port, max_channels=2)
+        for ns in NAMESERVERS:
+            with pytest.raises(dns.exception.Timeout):
+                await channels.query(2**24, ns, 0.01)
+        kept = list(channels._channels)
+        await channels.close()
+        return kept
+    assert asyncio.run(run()) == NAMESERVERS[-2:]
+
+
+def test_blocking_sockets(port):
+    channels = transport.BlockingTransport(port=port, max_channels=2)
+    for ns in NAMESERVERS:
+        with pytest.raises(dns.exception.Timeout):
+            channels.query(2**24, ns, 0.01)
+    assert list(channels._udp) == NAMESERVERS[-2:]
+    channels.close()
+
+
+def test_rtt():
+    fake = FakeDNSServer(["127.0.0.1"], latency=0.02)
+    fake.start()
+    measured = []
+    async def run():
+        channels = transport.AsyncTransport(port=fake.port, rtt=lambda ns, rtt: measured.append((ns, rtt)))
+        await channels.query(2**24, "127.0.0.1", 1, tcp=True)
+        await channels.query(2**24, "127.0.0.1", 1)
+        await channels.close()
+    try:
+        asyncio.run(run())
+        blocking = transport.BlockingTransport(port=fake.port, rtt=lambda ns, rtt: measured.append((ns, rtt)))
+        blocking.query(2**24, "127.0.0.1", 1)
+        blocking.close()
+    finally:
+        fake.stop()
+    assert [ns for (ns, rtt) in measured] == ["127.0.0.1"] * 3
+    assert all(0.02 <= rtt < 0.5 for (ns, rtt) in measured)
+
+
+def test_late_timeout(port):
+    async def run():
+        channels = transport.AsyncTransport(port=port)
+        queries = [asyncio.ensure_future(channels.query(2**24, "127.0.0.1", 0.05)) for _ in range(2)]
+        # Sent, and waiting
+        await asyncio.sleep(0.01)
+        # The loop is held up past the timeouts
+        time.sleep(0.05 + 2 * transport.LOOP_LATE)
+        results = await asyncio.gather(*queries, return_exceptions=True)
+        ontime = await asyncio.gather(channels.query(2**24, "127.0.0.1", 0.05), return_exceptions=True)
+        await channels.close()
+        return (results, ontime)
+    (results, ontime) = asyncio.run(run())
+    assert all(isinstance(exc, transport.LateTimeout) for exc in results)
+    assert type(ontime[0]) is dns.exception.Timeout
@@ -0,0 +1,163 @@
+"""
+The workers against a stand-in C2 server, with the lookups themselves replaced.
+"""
+import asyncio
+import datetime
+import threading
+
+import dns.message
+import dns.rcode
+import dns.resolver
+import dns.rrset
+import pytest
+
+from rdnsmonitor.dbobjects import Job
+from rdnsmonitor import delegation
+from rdnsmonitor import work
+
+IPFROM = 2**24
+ADDRESSES = 4096
+BROKEN = IPFROM + 100
+
+
+class StubServer(object):
+    """
+    Hands out one job and keeps what comes back.
+    """
+
+    def __init__(self):
+        self.jobs = [Job(id=1, ipfrom=IPFROM, ipto=IPFROM + ADDRESSES)]
+        self.results = {}
+        self.finished = []
+        self.released = []
+        self.threads = set()
+
+    def retrieveNewJob(self, owner=None, timeout=None):
+        return self.jobs.pop() if self.jobs else None
+
+    def storeResults(self, results, job=None, checkpoint=None):
+        self.results.update(results)
+        self.threads.add(threading.get_ident())
+
+    def renewLease(self, job):
+        return True
+
+    def finishJob(self, job):
+        self.finished.append(job)
+        return True
+
+    def releaseJob(self, job):
+        self.released.append(job)
+        return True
+
+
+class BrokenAsyncWorker(work.AsyncLocalWorker):
+    """
+    Answers every address with a PTR, but blows up on BROKEN.
+    """
+
+    async def _resolveIPAsync(self, ipint, retries=None):
+        if ipint == BROKEN:
+            raise IndexError("no answer")
+        return "host{:d}.example.".format(ipint)
+
+    def _fetchJob(self):
+        # Once: the stub has no more jobs, and waiting for one would take FETCH_TIMEOUT
+        if self._c2server.jobs:
+            return super()._fetchJob()
+        self.current_job = None
+        return None
+
+
+@pytest.fixture(autouse=True)
+def resolver(monkeypatch):
+    fake = dns.resolver.Resolver(configure=False)
+    fake.nameservers = ["127.0.0.1"]
+    monkeypatch.setattr(dns.resolver, "default_resolver", fake)
+
+
+def test_async_failed_lookup():
+    server = StubServer()
+    worker = BrokenAsyncWorker(server, nameservers=[], probe_zones=False, window=64)
+    worker.start()
+    worker.join()
+    assert len(server.results) == ADDRESSES
+    assert server.results[BROKEN] == "ERROR"
+    assert len(server.finished) == 1
+    # Not from the event loop
+    assert worker.ident not in server.threads
+
+
+def _reply(rcode=dns.rcode.NOERROR, answers=()):
+    query = dns.message.make_query("4.3.2.1.in-addr.arpa.", "PTR")
+    response = dns.message.make_response(query)
+    response.set_rcode(rcode)
+    for (name, rdtype, text) in answers:
+        response.answer.append(dns.rrset.from_text(name, 3600, "IN", rdtype, text))
+    return response.to_wire()
+
+
+@pytest.mark.parametrize("wire, expected", [
+    (_reply(answers=[("4.3.2.1.in-addr.arpa.", "PTR", "host.example.")]), "host.example."),
+    # RFC 2317: the CNAME is followed to the PTR
+    (_reply(answers=[("4.3.2.1.in-addr.arpa.", "CNAME", "4.0-63.3.2.1.in-addr.arpa."),
+                     ("4.0-63.3.2.1.in-addr.arpa.", "PTR", "host.example.")]), "host.example."),
+    (_reply(), "NODATA"),
+    (_reply(answers=[("4.3.2.1.in-addr.arpa.", "CNAME", "4.0-63.3.2.1.in-addr.arpa.")]), "NODATA"),
+    (_reply(dns.rcode.NXDOMAIN), "NXDOMAIN"),
+    (_reply(dns.rcode.SERVFAIL), "SERVFAIL"),
+    (_reply(dns.rcode.REFUSED), "ERROR"),
+    (_reply(dns.rcode.NOTIMP), "ERROR"),
+    (b"\x00", "ERROR"),
+])
+def test_check_response(wire, expected):
+    worker = work.LocalWorker(StubServer(), nameservers=[])
+    try:
+        data = worker._checkResponse(wire, "127.0.0.1")[0].to_text()
+    except Exception as exc:
+        data = worker._handleFailure(exc, "127.0.0.1", "1.2.3.4", datetime.datetime.now())
+    assert data == expected
+
+def test_forget_authoritative(monkeypatch):
+    monkeypatch.setattr(work.NameserverScheduler, "MAX_LEARNED", 2)
+    worker = work.AsyncLocalWorker(StubServer(), nameservers=["127.0.0.1"])
+    worker._ns_semaphores = {}
+    for ns in ("10.0.0.1", "10.0.0.2", "10.0.0.3"):
+        worker.scheduler.acquire(among=[ns])
+        worker._nsSemaphore(ns)
+        worker._report(ns, datetime.datetime.now(), "NXDOMAIN")
+    assert "10.0.0.1" not in worker.scheduler.summary()
+    assert set(worker.scheduler.summary(learned=False)) == set(worker.nameservers)
+    assert set(worker._ns_semaphores) == {"10.0.0.2", "10.0.0.3"}
+    assert "10.0.0.1" not in worker.nameserver_stats
+    labels = {labels[0] for labels in work.QUERIES._values}
+    assert work.AUTHORITATIVE in labels and "10.0.0.1" not in labels
+
+
+class StubTransport(object):
+
+    def __init__(self, wire):
+        self.wire = wire
+
+    async def query(self, ipint, nameserver, timeout, tcp=False):
+        return self.wire
+
+
+def test_referral_without_glue(monkeypatch):
+    response = dns.message.from_wire(_reply())
+    response.authority.append(dns.rrset.from_text("1.in-addr.arpa.", 3600, "IN", "NS", "ns.example."))
+    threads = []
+    def resolve(host, rdtype, lifetime=None):
+        threads.append(threading.get_ident())
+        raise dns.resolver.NXDOMAIN
+    monkeypatch.setattr(dns.resolver, "resolve", resolve)
+    worker = work.AsyncLocalWorker(StubServer(), nameservers=["127.0.0.1"])
+    worker.delegations = delegation.DelegationCache()
+    worker._asynctransport = StubTransport(response.to_wire())
+    async def query():
+        with pytest.raises(delegation.Unresolvable) as exc:
+            await worker.queryAsync(IPFROM, "127.0.0.1", direct=True)
+        return (exc.value, threading.get_ident())
+    (exc, loopthread) = asyncio.run(query())
+    assert not isinstance(exc, delegation.MissingGlue)
+    assert len(threads) == 1 and threads[0] != loopthread